@@ -0,0 +1,332 @@
+"""
+Benchmark cl-export end to end on synthetic data.
+
+Each case generates a synthetic annotation file with cl-synth, and a
+header-only atlas for its CCF geometry; cl-export only reads the atlas
+geometry. The case is then exported twice in separate processes, once with
+--model and once with --labelmap, recording the wall time, the peak resident
+memory and the output size of each.
+
+Cases vary one group of parameters at a time from a base case: the atlas
+geometry and direction matrix, the number of annotations, the control points
+per curve, the curve thickness and the representation type. Inputs are
+generated from a fixed seed, so results are comparable between runs and
+machines; the times and memory of course are not comparable between machines.
+
+Compare a run against a stored baseline to judge a change:
+
+    python benchmarks/export_benchmark.py --baseline benchmarks/baseline.json
+
+and store a new baseline with --save. Extra cl-export arguments, ex. to
+compare engines, follow '--':
+
+    python benchmarks/export_benchmark.py --save numpy.json -- --engine numpy
+"""
+
+import argparse
+import dataclasses
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+from cl_convert import converters
+from cl_synth import synth
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SEED = 0
+
+
+@dataclass(frozen=True)
+class Case:
+    geometry: str = "ccf25"
+    direction: str = "identity"
+    curves: int = 100
+    points: int = 8
+    thickness: float = 50.0
+    representation: str = "spline"
+
+    @property
+    def name(self) -> str:
+        return "{}-{}-c{}-p{}-t{:g}-{}".format(
+            self.geometry, self.direction, self.curves, self.points, self.thickness, self.representation
+        )
+
+
+# Each group of parameters is swept together, as a product, with the others at the base case.
+SUITES = {
+    "quick": [
+        {"geometry": ["ccf100", "ccf50", "ccf25"], "direction": ["identity", "oblique"]},
+        {"curves": [10, 100, 300]},
+        {"points": [4, 8, 32]},
+        {"thickness": [25.0, 50.0, 200.0]},
+        {"representation": ["spline", "polyline"]},
+    ],
+    "full": [
+        {"geometry": ["ccf100", "ccf50", "ccf25", "ccf10"], "direction": ["identity", "oblique"]},
+        {"curves": [10, 100, 1000]},
+        {"points": [4, 8, 32, 64]},
+        {"thickness": [25.0, 50.0, 200.0, 500.0]},
+        {"representation": ["spline", "polyline"]},
+    ],
+}
+
+RUNS = ("model", "labelmap")
+
+
+def suite_cases(suite: str, base: Case = Case()) -> List[Case]:
+    cases = []
+    for group in SUITES[suite]:
+        for values in itertools.product(*group.values()):
+            case = dataclasses.replace(base, **dict(zip(group, values)))
+            if case not in cases:
+                cases.append(case)
+    return cases
+
+
+def write_annotation(case: Case, path: Path):
+    geometry = synth.Geometry.ccf(case.geometry, case.direction)
+    doc = synth.generate_document(
+        np.random.default_rng(SEED),
+        geometry,
+        curves=case.curves,
+        points=case.points,
+        thickness=(case.thickness, case.thickness),
+        representation=case.representation,
+        pir=True,
+    )
+
+    _, converter = converters.find_latest("")
+    with open(path, "w") as f:
+        json.dump(converter.specialize(doc), f)
+
+
+def write_atlas_header(case: Case, path: Path):
+    geometry = synth.Geometry.ccf(case.geometry, case.direction)
+    synth.write_nrrd(path, geometry, np.uint8, iter(()), compress=False)
+
+
+def measure(command: List[str], log: Path) -> Tuple[float, Optional[float]]:
+    """Run ``command``; returns its wall time in seconds, and its peak resident memory in MiB where available.
+
+    The output of the command goes to ``log``.
+    """
+
+    with open(log, "wb") as f:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=f, stderr=subprocess.STDOUT)
+
+        if resource is None:
+            returncode = process.wait()
+            rss = None
+        else:
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = returncode = os.waitstatus_to_exitcode(status)
+            # kilobytes on Linux, bytes on macOS.
+            rss = usage.ru_maxrss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)
+
+        seconds = time.perf_counter() - start
+
+    if returncode:
+        sys.stderr.write(log.read_text())
+        raise SystemExit("{} failed".format(" ".join(command)))
+
+    return seconds, rss
+
+
+def run_case(case: Case, workdir: Path, repeat: int, export_args: List[str]) -> Dict[str, dict]:
+    directory = workdir / case.name
+    directory.mkdir(parents=True, exist_ok=True)
+
+    annotation = directory / "annotation.json"
+    atlas = workdir / "atlas-{}-{}.nrrd".format(case.geometry, case.direction)
+    write_annotation(case, annotation)
+    if not atlas.exists():
+        write_atlas_header(case, atlas)
+
+    export = [sys.executable, "-m", "cl_export.export", str(annotation), "--pir"]
+    outputs = {
+        "model": (directory / "model.vtp", ["-m", str(directory / "model.vtp")]),
+        "labelmap": (directory / "labelmap.nrrd", ["-l", str(directory / "labelmap.nrrd"), "-a", str(atlas)]),
+    }
+
+    results = {}
+    for run in RUNS:
+        path, args = outputs[run]
+        samples = [measure(export + args + export_args, directory / (run + ".log")) for _ in range(repeat)]
+        rss = [sample[1] for sample in samples if sample[1] is not None]
+        results[run] = {
+            "seconds": statistics.median(sample[0] for sample in samples),
+            "rss_mb": max(rss) if rss else None,
+            "bytes": path.stat().st_size,
+        }
+
+    return results
+
+
+def machine() -> dict:
+    from vtkmodules.vtkCommonCore import vtkVersion
+    import SimpleITK as sitk
+
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "vtk": vtkVersion.GetVTKVersion(),
+        "simpleitk": sitk.Version.VersionString(),
+        "numpy": np.__version__,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Print each result against the baseline; returns the regressions, beyond ``tolerance``, as messages."""
+
+    regressions = []
+    row = "{:<48} {:<9} {:>9} {:>9} {:>9} {:>9}  {}"
+    print(row.format("case", "run", "seconds", "vs base", "rss (MiB)", "vs base", "output"))
+
+    for name, runs in results["cases"].items():
+        for run, result in runs.items():
+            base = baseline.get("cases", {}).get(name, {}).get(run)
+            if not base:
+                print(row.format(name, run, "{:.2f}".format(result["seconds"]), "-", _mb(result["rss_mb"]), "-", "new"))
+                continue
+
+            time_ratio = result["seconds"] / base["seconds"]
+            rss_ratio = result["rss_mb"] / base["rss_mb"] if result["rss_mb"] and base["rss_mb"] else None
+            output = "same size" if result["bytes"] == base["bytes"] else "{:+d} bytes".format(
+                result["bytes"] - base["bytes"]
+            )
+            print(
+                row.format(
+                    name,
+                    run,
+                    "{:.2f}".format(result["seconds"]),
+                    "{:.2f}x".format(time_ratio),
+                    _mb(result["rss_mb"]),
+                    "{:.2f}x".format(rss_ratio) if rss_ratio else "-",
+                    output,
+                )
+            )
+
+            if time_ratio > 1 + tolerance:
+                regressions.append("{} {}: {:.2f}x slower".format(name, run, time_ratio))
+            if rss_ratio and rss_ratio > 1 + tolerance:
+                regressions.append("{} {}: {:.2f}x more memory".format(name, run, rss_ratio))
+
+    return regressions
+
+
+def _mb(value: Optional[float]) -> str:
+    return "{:.0f}".format(value) if value is not None else "-"
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmark cl-export --model and --labelmap end to end on synthetic annotations and atlases.",
+        epilog="Arguments after '--' are passed to every cl-export run; ex. '-- --engine numpy -j 4'.",
+    )
+    parser.add_argument("--suite", choices=list(SUITES), default="quick", help="Cases to run. Defaults to quick.")
+    parser.add_argument(
+        "-k",
+        dest="pattern",
+        default=None,
+        help="Only run cases whose name contains this string; ex. 'ccf10' or 'polyline'.",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Run each export this many times and keep the median time. Defaults to 3.",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=None,
+        help="Results of a previous run to compare against; ex. 'benchmarks/baseline.json'.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative increase in time or memory over the baseline reported as a regression. Defaults to 0.2.",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        default=False,
+        help="Exit with an error if any case regressed against the baseline.",
+    )
+    parser.add_argument("--save", type=Path, default=None, help="Write the results to this JSON file.")
+    parser.add_argument(
+        "--workdir",
+        type=Path,
+        default=None,
+        help="Keep the generated inputs and outputs in this directory rather than a temporary one.",
+    )
+    parser.add_argument("--list", action="store_true", default=False, help="List the cases to run and exit.")
+
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    export_args = []
+    if "--" in argv:
+        index = argv.index("--")
+        argv, export_args = argv[:index], argv[index + 1:]
+
+    args = _parser().parse_args(argv)
+
+    cases = [case for case in suite_cases(args.suite) if not args.pattern or args.pattern in case.name]
+    if args.list:
+        for case in cases:
+            print(case.name)
+        return
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {"machine": machine(), "export_args": export_args, "cases": {}}
+
+    with tempfile.TemporaryDirectory() as temp:
+        workdir = args.workdir or Path(temp)
+        for case in cases:
+            print(case.name, file=sys.stderr)
+            results["cases"][case.name] = run_case(case, workdir, args.repeat, export_args)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    regressions = compare(results, baseline or {}, args.tolerance)
+    for regression in regressions:
+        print("regression: {}".format(regression), file=sys.stderr)
+
+    if args.check and regressions:
+        exit(-1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Check that importing cl-export stays fast.
+
+This runs tests/test_import_time.py, which imports each entry point in a fresh
+interpreter with ``python -X importtime`` and fails if its import time
+exceeds the budget, or if it imports any of the modules that are deferred to
+the code paths that need them. See that module for details.
+"""
+
+import argparse
+import os
+import sys
+
+from pathlib import Path
+
+import pytest
+
+TESTS = Path(__file__).resolve().parents[1].joinpath("tests", "test_import_time.py")
+
+
+def _parser():
+    parser = argparse.ArgumentParser(description="Check the import time and imported modules of cl-export.")
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=500,
+        help="Largest acceptable import time of each entry point, in milliseconds. Defaults to 500.",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="Number of imports to take the fastest of. Defaults to 5.",
+    )
+
+    return parser
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+
+    os.environ["CL_IMPORT_BUDGET_MS"] = str(args.budget)
+    os.environ["CL_IMPORT_REPEAT"] = str(args.repeat)
+
+    sys.exit(pytest.main(["-q", "-p", "no:cacheprovider", str(TESTS)]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Export annotations in memory, from Python rather than through 'cl-export'.
+
+Annotations are given as a normalized :py:class:`cl_convert.model.Document`,
+the data of an annotation file of any version as loaded from JSON, or a list
+of markups as from export.load_markups(). Nothing is written to disk, so
+pipelines that only need the labels do not write and read back full-size
+labelmaps::
+
+    from cl_convert import converters
+    from cl_export import api
+
+    version, document = converters.infer_normalize(data)
+    labels, geometry = api.rasterize(document, "ccf_annotation_25_contiguous.nrrd", pir=True)
+
+Labels are in (z, y, x) order, with the same values as exported labelmaps:
+annotation ``i`` of the document has label ``i + 1``, and later annotations
+win where they overlap. To rasterize into a memory-mapped array or a
+``.npy`` file, pass it as ``out``; ex. from numpy.lib.format.open_memmap().
+For a ``.npz`` sparse labelmap, use rasterize_sparse() and write the result.
+"""
+
+import os
+
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+import numpy as np
+
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+
+from cl_convert import converters
+from cl_convert import model
+from cl_export.cache import MeshCache
+from cl_export.cache import load_atlas_geometry
+from cl_export.export import build_model
+from cl_export.export import document_markups
+from cl_export.export import label_dtype
+from cl_export.export import paint_array
+from cl_export.export import rasterize_markups
+from cl_export.geometry import AtlasGeometry
+from cl_export.sparse import SparseLabelmap
+
+# A normalized document, the data of an annotation file, or its markups.
+Annotations = Union[model.Document, dict, List[dict]]
+
+
+def _markups(document: Annotations) -> List[dict]:
+    if isinstance(document, dict):
+        _, document = converters.infer_normalize(document)
+
+    if isinstance(document, model.Document):
+        return document_markups(document)
+
+    return list(document)
+
+
+def _geometry(atlas_geometry: Union[AtlasGeometry, str, os.PathLike]) -> AtlasGeometry:
+    if isinstance(atlas_geometry, AtlasGeometry):
+        return atlas_geometry
+
+    return load_atlas_geometry(atlas_geometry)
+
+
+def rasterize(
+    document: Annotations,
+    atlas_geometry: Union[AtlasGeometry, str, os.PathLike],
+    pir: bool = False,
+    engine: str = "vtk",
+    jobs: int = 1,
+    points_per_segment: Optional[int] = None,
+    mesh_cache: Optional[MeshCache] = None,
+    out: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, AtlasGeometry]:
+    """Rasterize the annotations of ``document`` into a labelmap with ``atlas_geometry``, or that of an atlas file.
+
+    The options are those of 'cl-export'; ``jobs`` worker processes rasterize the annotations, or all available cores
+    if 0. ``out`` is cleared and painted in place if given; it must have the (z, y, x) shape of the atlas and an integer
+    type that holds a label per annotation. Otherwise a new array of the smallest such type is returned; see
+    label_dtype().
+
+    :returns: (labels, geometry) — The (z, y, x) labels and the geometry they have.
+    """
+
+    markups = _markups(document)
+    geometry = _geometry(atlas_geometry)
+    shape = tuple(reversed(geometry.size))
+
+    if out is None:
+        labels = np.zeros(shape, dtype=label_dtype(len(markups)))
+    else:
+        if out.shape != shape:
+            raise ValueError("out has shape {}, not the atlas shape {}".format(out.shape, shape))
+        if not np.issubdtype(out.dtype, np.integer) or len(markups) > np.iinfo(out.dtype).max:
+            raise ValueError("{} annotations do not fit in a {} labelmap".format(len(markups), out.dtype))
+        labels = out
+        labels[...] = 0
+
+    blocks = rasterize_markups(
+        markups,
+        geometry,
+        pir,
+        jobs or os.cpu_count(),
+        engine,
+        points_per_segment=points_per_segment,
+        mesh_cache=mesh_cache,
+    )
+    for label, block in enumerate(blocks, 1):
+        paint_array(labels, block, label)
+
+    return labels, geometry
+
+
+def rasterize_sparse(
+    document: Annotations,
+    atlas_geometry: Union[AtlasGeometry, str, os.PathLike],
+    pir: bool = False,
+    engine: str = "vtk",
+    jobs: int = 1,
+    points_per_segment: Optional[int] = None,
+    mesh_cache: Optional[MeshCache] = None,
+) -> SparseLabelmap:
+    """Rasterize the annotations of ``document`` into a sparse labelmap; see rasterize() and cl_export.sparse.
+
+    No dense image is allocated. The result converts to an array with SparseLabelmap.to_array(), and writes to a
+    ``.npz`` file with SparseLabelmap.write().
+    """
+
+    markups = _markups(document)
+    geometry = _geometry(atlas_geometry)
+
+    blocks = rasterize_markups(
+        markups,
+        geometry,
+        pir,
+        jobs or os.cpu_count(),
+        engine,
+        points_per_segment=points_per_segment,
+        mesh_cache=mesh_cache,
+    )
+    return SparseLabelmap.from_blocks(enumerate(blocks, 1), geometry, label_dtype(len(markups)))
+
+
+def build_meshes(
+    document: Annotations,
+    pir: bool = False,
+    points_per_segment: Optional[int] = None,
+    mesh_cache: Optional[MeshCache] = None,
+) -> List[vtkPolyData]:
+    """The model of each annotation of ``document``, in PIR space if ``pir`` is set; see export.build_model()."""
+
+    return [
+        build_model(markup, pir, points_per_segment=points_per_segment, mesh_cache=mesh_cache).GetOutputDataObject(0)
+        for markup in _markups(document)
+    ]
@@ -0,0 +1,388 @@
+import argparse
+import glob
+import os
+import sys
+
+from pathlib import Path
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from cl_export import profiling
+from cl_export.cache import MeshCache
+from cl_export.cache import load_atlas_geometry
+from cl_export.export import ENGINES
+from cl_export.export import allocate_labelmap
+from cl_export.export import export_labelmap
+from cl_export.export import export_model
+from cl_export.export import export_split_models
+from cl_export.export import export_sparse_labelmap
+from cl_export.export import export_zarr_labelmap
+from cl_export.export import label_dtype
+from cl_export.export import labelmap_dtype
+from cl_export.export import load_markups
+from cl_export.export import memory_size
+from cl_export.export import positive_int
+from cl_export.export import write_color_table
+from cl_export.geometry import AtlasGeometry
+from cl_export.meshes import MODEL_SUFFIXES
+from cl_export.meshes import is_model_path
+from cl_export.omezarr import is_zarr
+from cl_export.profiling import stage
+from cl_export.sparse import is_sparse
+
+
+def collect_annotations(patterns: List[str], manifest: Optional[Path]) -> List[Path]:
+    """Expand glob patterns and manifest entries into a list of annotation files.
+
+    Manifest entries are one path per line; blank lines and lines starting with ``#`` are ignored. Relative entries are
+    resolved against the directory containing the manifest.
+    """
+
+    paths = []
+
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            paths.extend(Path(p) for p in sorted(glob.glob(pattern, recursive=True)))
+        else:
+            paths.append(Path(pattern))
+
+    if manifest:
+        with open(manifest) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    paths.append(manifest.parent / line)
+
+    return paths
+
+
+def output_path(pattern: Optional[str], annotation_path: Path, index: int) -> Optional[Path]:
+    if not pattern:
+        return None
+
+    path = Path(pattern.format(
+        stem=annotation_path.stem,
+        name=annotation_path.name,
+        parent=annotation_path.parent,
+        index=index,
+    ))
+    path.parent.mkdir(exist_ok=True, parents=True)
+    return path
+
+
+# Per-process state for batch workers; set by _init_worker. The label image is allocated once per worker and reused
+# for every file it exports; it is only reallocated when a file needs a different label type. Sparse and OME-Zarr
+# labelmaps do not need one.
+_worker_geometry = None
+_worker_image = None
+_worker_args = None
+_worker_mesh_cache = None
+
+
+def _init_worker(geometry: Optional[AtlasGeometry], args: argparse.Namespace):
+    global _worker_geometry, _worker_image, _worker_args, _worker_mesh_cache
+    _worker_geometry = geometry
+    _worker_image = None
+    if geometry and not (is_sparse(args.labelmap_pattern) or is_zarr(args.labelmap_pattern)):
+        _worker_image = allocate_labelmap(geometry)
+    _worker_args = args
+    _worker_mesh_cache = MeshCache(args.mesh_cache_dir, args.mesh_cache_size) if args.mesh_cache_dir else None
+
+
+def _worker_labelmap(count: int):
+    """The worker's label image, reallocated unless it has the label type for ``count`` labels; see label_dtype()."""
+
+    global _worker_image
+    dtype = label_dtype(count)
+    if labelmap_dtype(_worker_image) != dtype:
+        _worker_image = None  # release the old image before allocating the new one
+        _worker_image = allocate_labelmap(_worker_geometry, dtype)
+    return _worker_image
+
+
+def _export_file(item: Tuple[int, Path]) -> Tuple[Path, Optional[str]]:
+    index, annotation_path = item
+    args = _worker_args
+
+    with profiling.context(file=str(annotation_path)), stage("export_file"):
+        try:
+            with stage("load_annotation"):
+                markups = load_markups(annotation_path)
+
+            model_path = output_path(args.model_pattern, annotation_path, index)
+            if model_path and args.split_models:
+                export_split_models(
+                    markups,
+                    model_path,
+                    args.pir,
+                    ascii=args.ascii,
+                    max_triangles=args.max_triangles,
+                    points_per_segment=args.points_per_segment,
+                    mesh_cache=_worker_mesh_cache,
+                )
+            elif model_path:
+                export_model(
+                    markups,
+                    model_path,
+                    args.pir,
+                    args.ascii,
+                    args.max_triangles,
+                    args.points_per_segment,
+                    _worker_mesh_cache,
+                )
+
+            labelmap_path = output_path(args.labelmap_pattern, annotation_path, index)
+            if labelmap_path and is_sparse(labelmap_path):
+                export_sparse_labelmap(
+                    markups,
+                    _worker_geometry,
+                    labelmap_path,
+                    args.pir,
+                    engine=args.engine,
+                    points_per_segment=args.points_per_segment,
+                    mesh_cache=_worker_mesh_cache,
+                )
+            elif labelmap_path and is_zarr(labelmap_path):
+                export_zarr_labelmap(
+                    markups,
+                    _worker_geometry,
+                    labelmap_path,
+                    args.pir,
+                    engine=args.engine,
+                    points_per_segment=args.points_per_segment,
+                    mesh_cache=_worker_mesh_cache,
+                )
+            elif labelmap_path:
+                export_labelmap(
+                    markups,
+                    _worker_labelmap(len(markups)),
+                    labelmap_path,
+                    args.pir,
+                    engine=args.engine,
+                    points_per_segment=args.points_per_segment,
+                    mesh_cache=_worker_mesh_cache,
+                )
+
+            lut_path = output_path(args.lut_pattern, annotation_path, index)
+            if lut_path:
+                write_color_table(markups, lut_path)
+        except Exception as e:
+            return annotation_path, "{}: {}".format(type(e).__name__, e)
+
+    return annotation_path, None
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog="cl-export batch",
+        description=(
+            "Export many Cell Locator annotation files against the same atlas. The atlas geometry is read once, and "
+            "each worker process reuses one label image for all the files it exports."
+        ),
+    )
+    parser.add_argument(
+        metavar="annotation",
+        dest="annotations",
+        nargs="*",
+        help="Input Cell Locator annotation files (JSON), of any version, or glob patterns; ex. 'specimens/**/*.json'.",
+    )
+    parser.add_argument(
+        "--manifest",
+        dest="manifest_path",
+        type=Path,
+        help="Text file listing input annotation files, one per line. Relative paths are relative to the manifest.",
+        default=None,
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        dest="model_pattern",
+        help=(
+            "Output path pattern for annotation models; ex. 'models/{stem}.vtk'. Available fields are {stem}, {name}, "
+            "{parent} and {index} of the input file. The format is given by the suffix; see 'cl-export -h'. If not "
+            "provided, model generation is skipped."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--split-models",
+        action="store_true",
+        dest="split_models",
+        help="If set, write one model per annotation rather than a single model per file. See 'cl-export -h'.",
+        default=False,
+    )
+    parser.add_argument(
+        "--max-triangles",
+        dest="max_triangles",
+        type=int,
+        help="If set, decimate each written model to about this many triangles.",
+        default=None,
+    )
+    parser.add_argument(
+        "--ascii",
+        action="store_true",
+        dest="ascii",
+        help="If set, write '.vtk', '.stl' and '.ply' models as text rather than binary.",
+        default=False,
+    )
+    parser.add_argument(
+        "-l",
+        "--labelmap",
+        dest="labelmap_pattern",
+        help=(
+            "Output path pattern for annotation labelmaps; ex. 'labels/{stem}.label.nrrd'. See --model for available "
+            "fields. If not provided, labelmap generation is skipped. Requires --atlas for spacing information. Use "
+            "a '.npz' suffix to write sparse labelmaps, or '.zarr' for OME-Zarr labelmaps."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--lut",
+        dest="lut_pattern",
+        help=(
+            "Output path pattern for Slicer color tables naming each label after its annotation; ex. "
+            "'labels/{stem}.ctbl'. See --model for available fields."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "-a",
+        "--atlas",
+        dest="atlas_path",
+        type=Path,
+        help="Atlas volume or labelmap. Used to set spacing/direction on the output labelmaps.",
+        default=None,
+    )
+    parser.add_argument(
+        "--no-atlas-cache",
+        action="store_false",
+        dest="atlas_cache",
+        help=(
+            "Always read the atlas geometry from the atlas file, rather than from the cache of atlas geometries. See "
+            "'cl-export -h'."
+        ),
+        default=True,
+    )
+    parser.add_argument(
+        "--pir",
+        action="store_true",
+        dest="pir",
+        help=(
+            "If set, read the annotations in PIR format rather than RAS. This should only be necessary for old-style "
+            "CCF annotations. "
+        ),
+        default=False,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        help=(
+            "Number of worker processes; each exports whole files. Use 0 to use all available cores. Each worker "
+            "holds one full-size label image."
+        ),
+        default=1,
+    )
+    parser.add_argument(
+        "--points-per-segment",
+        dest="points_per_segment",
+        type=positive_int,
+        help="Number of points to tessellate each curve segment with. See 'cl-export -h'.",
+        default=None,
+    )
+    parser.add_argument(
+        "--engine",
+        dest="engine",
+        choices=ENGINES,
+        help="Labelmap rasterization engine. See 'cl-export -h'. Defaults to 'vtk'.",
+        default="vtk",
+    )
+    parser.add_argument(
+        "--mesh-cache",
+        dest="mesh_cache_dir",
+        type=Path,
+        help=(
+            "Directory of cached annotation meshes, shared by all workers. Meshes are keyed by the annotation geometry "
+            "and tessellation settings, so unchanged annotations are not rebuilt on re-export. The directory may be "
+            "shared."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--mesh-cache-size",
+        dest="mesh_cache_size",
+        type=memory_size,
+        help="Size cap of the mesh cache; ex. '512M' or '2G'. Least recently used meshes are evicted first.",
+        default="1G",
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profile_path",
+        type=Path,
+        help=(
+            "Write a timeline of the export stages of every file and annotation, across all workers, to this Chrome "
+            "trace JSON file, and print the time and peak resident memory of each stage. See 'cl-export -h'."
+        ),
+        default=None,
+    )
+
+    return parser
+
+
+def main(argv=None):
+    parser = _parser()
+    args = parser.parse_args(argv)
+
+    if args.labelmap_pattern and not args.atlas_path:
+        print(
+            "--labelmap requires --atlas to determine output spacing/orientation.",
+            file=sys.stderr,
+        )
+        exit(-1)
+
+    if args.model_pattern and not is_model_path(args.model_pattern):
+        print(
+            "--model must end with one of {}.".format(", ".join(MODEL_SUFFIXES)),
+            file=sys.stderr,
+        )
+        exit(-1)
+
+    annotations = collect_annotations(args.annotations, args.manifest_path)
+    if not annotations:
+        print("No annotation files given.", file=sys.stderr)
+        exit(-1)
+
+    if args.profile_path:
+        profiling.start()
+
+    with stage("read_atlas"):
+        geometry = load_atlas_geometry(args.atlas_path, args.atlas_cache) if args.labelmap_pattern else None
+    items = list(enumerate(annotations))
+    jobs = min(args.jobs or os.cpu_count(), len(items))
+
+    if jobs <= 1:
+        _init_worker(geometry, args)
+        results = map(_export_file, items)
+        failures = [(path, error) for path, error in results if error]
+    else:
+        with profiling.pool(jobs, initializer=_init_worker, initargs=(geometry, args)) as pool:
+            results = profiling.imap(pool, _export_file, items, ordered=False)
+            failures = [(path, error) for path, error in results if error]
+
+    if args.profile_path:
+        events = profiling.stop()
+        profiling.write_trace(events, args.profile_path)
+        print(profiling.summarize(events), file=sys.stderr)
+
+    for path, error in failures:
+        print("{}: {}".format(path, error), file=sys.stderr)
+
+    if failures:
+        print("{} of {} files failed.".format(len(failures), len(items)), file=sys.stderr)
+        exit(-1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+On-disk caches, so that repeated exports skip work that was already done.
+
+MeshCache holds annotation meshes, so re-exports only rebuild what changed.
+
+Meshes are keyed by a hash of everything that determines them: the control
+points, ``orientation``, ``thickness`` and ``representationType`` of the
+markup, the tessellation settings and the PIR flag. Names and other
+properties do not affect the key, so renaming an annotation reuses its mesh.
+
+Each mesh is stored as an uncompressed binary VTK XML file. Reading a mesh
+marks it as recently used; once the cache exceeds its size cap, the least
+recently used meshes are evicted until it fits. Several processes may share a
+cache directory: files are written atomically, and a mesh evicted while
+being read is treated as a miss. Each process only rescans the directory once
+its own estimate of the cache size exceeds the cap, so a shared cache may
+briefly exceed it by what the other processes wrote since.
+
+GeometryCache holds the geometry of atlases, and the world to local
+transform derived from it, so that exports against the same atlas do not
+open it again; atlases are often on slow network filesystems. Entries are
+keyed by the resolved atlas path and are only used while the file size and
+modification time match.
+"""
+
+import dataclasses
+import hashlib
+import json
+import os
+import tempfile
+
+from pathlib import Path
+from typing import Dict
+from typing import Optional
+
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+
+from cl_export.geometry import AtlasGeometry
+
+# Part of every key; change it when the way meshes are built changes, to invalidate existing caches.
+CACHE_VERSION = 1
+
+CACHE_SUFFIX = ".vtp"
+
+# Most atlases remembered by a GeometryCache; the least recently added are forgotten first.
+MAX_GEOMETRIES = 64
+
+
+def geometry_key(markup: dict, pir: bool, spacing: Optional[float], points_per_segment: Optional[int]) -> str:
+    """Canonical hash of the geometry of a markup and the settings its mesh is built with."""
+
+    geometry = {
+        "version": CACHE_VERSION,
+        "points": [
+            [float(value) for value in control_point["position"]]
+            for control_point in markup["markup"]["controlPoints"]
+        ],
+        "orientation": [float(value) for value in markup["orientation"]],
+        "thickness": float(markup["thickness"]),
+        "representationType": markup["representationType"],
+        "spacing": float(spacing) if spacing else None,
+        "points_per_segment": points_per_segment,
+        "pir": bool(pir),
+    }
+
+    text = json.dumps(geometry, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class MeshCache:
+    """A directory of cached meshes, capped at ``max_bytes``.
+
+    Instances only hold the directory and cap, so they may be sent to worker processes.
+    """
+
+    def __init__(self, directory, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        # size of the cache as of the last scan, plus what was written since; None until the first scan.
+        self._size = None
+
+    def path(self, key: str) -> Path:
+        return self.directory / (key + CACHE_SUFFIX)
+
+    def get(self, key: str) -> Optional[vtkPolyData]:
+        path = self.path(key)
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        from vtkmodules.vtkIOXML import vtkXMLPolyDataReader
+
+        reader = vtkXMLPolyDataReader()
+        reader.SetFileName(str(path))
+        reader.Update()
+
+        polydata = reader.GetOutput()
+        if reader.GetErrorCode() or not polydata.GetNumberOfPoints():
+            return None
+
+        return polydata
+
+    def put(self, key: str, polydata: vtkPolyData):
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        fd, temp = tempfile.mkstemp(suffix=CACHE_SUFFIX, dir=self.directory, prefix=".")
+        os.close(fd)
+
+        from vtkmodules.vtkIOXML import vtkXMLPolyDataWriter
+
+        writer = vtkXMLPolyDataWriter()
+        writer.SetFileName(temp)
+        writer.SetInputData(polydata)
+        writer.SetDataModeToAppended()
+        writer.EncodeAppendedDataOff()
+        writer.SetCompressorTypeToNone()
+        writer.Write()
+
+        path = self.path(key)
+        os.replace(temp, path)
+
+        if self._size is not None:
+            self._size += path.stat().st_size
+        if self._size is None or self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used meshes until the cache fits in ``max_bytes``."""
+
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(CACHE_SUFFIX) and not entry.name.startswith("."):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        self._size = total
+
+
+def default_geometry_cache_path() -> Path:
+    """``$XDG_CACHE_HOME/cl-export/atlas-geometry.json``, or under ``~/.cache`` if XDG_CACHE_HOME is not set."""
+
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return Path(base) / "cl-export" / "atlas-geometry.json"
+
+
+class GeometryCache:
+    """A JSON file of atlas geometries; see the module documentation.
+
+    The cache is best effort: if it cannot be read or written, atlases are read directly.
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else default_geometry_cache_path()
+
+    def _read(self) -> Dict[str, dict]:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        if data.get("version") != CACHE_VERSION:
+            return {}
+        return data.get("atlases", {})
+
+    def _write(self, atlases: Dict[str, dict]):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd, temp = tempfile.mkstemp(suffix=".json", dir=self.path.parent, prefix=".")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"version": CACHE_VERSION, "atlases": atlases}, f)
+            os.replace(temp, self.path)
+        except OSError:
+            pass
+
+    def get(self, filename) -> AtlasGeometry:
+        """The geometry of the atlas ``filename``; from the cache if the file is unchanged, otherwise read from the
+        file and added to the cache.
+        """
+
+        key = str(Path(filename).resolve())
+        stat = os.stat(key)
+
+        atlases = self._read()
+        entry = atlases.get(key)
+        if entry and entry["bytes"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            geometry = AtlasGeometry(**{name: tuple(value) for name, value in entry["geometry"].items()})
+            # AtlasGeometry.world_to_local is a cached_property; fill it in from the cache.
+            geometry.__dict__["world_to_local"] = tuple(entry["world_to_local"])
+            return geometry
+
+        geometry = AtlasGeometry.from_file(key)
+
+        atlases.pop(key, None)
+        atlases[key] = {
+            "bytes": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "geometry": dataclasses.asdict(geometry),
+            "world_to_local": list(geometry.world_to_local),
+        }
+        for stale in list(atlases)[:-MAX_GEOMETRIES]:
+            del atlases[stale]
+        self._write(atlases)
+
+        return geometry
+
+
+def load_atlas_geometry(filename, cache: bool = True) -> AtlasGeometry:
+    """The geometry of the atlas ``filename``, through the default GeometryCache unless ``cache`` is False."""
+
+    return GeometryCache().get(filename) if cache else AtlasGeometry.from_file(filename)
@@ -0,0 +1,418 @@
+"""
+Count the annotation files covering each atlas voxel: 'cl-export density'.
+
+Each file counts once per voxel, however many of its annotations cover it,
+so with one file per specimen the result is the number of specimens
+annotated at each voxel. Optionally, a channel per annotation name counts
+the files whose annotations of that name cover each voxel; ex. a channel
+for every 'injection site'. Unnamed annotations only count in the total.
+
+Files are split into shards. Each worker process rasterizes the files of a
+shard and sums their coverage in its own counts, which are returned, within
+the bounding box of the shard's annotations, and added to the result. Memory
+is bounded by the number of workers and channels, not the number of files:
+about (jobs + 1) full-size count images per channel at most. Counts are
+uint16, or uint32 for more than 65535 files, so they cannot overflow.
+"""
+
+import argparse
+import math
+import os
+import sys
+
+from pathlib import Path
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+from cl_export import profiling
+from cl_export.batch import collect_annotations
+from cl_export.cache import MeshCache
+from cl_export.cache import load_atlas_geometry
+from cl_export.export import ENGINES
+from cl_export.export import load_markups
+from cl_export.export import markup_rasterizer
+from cl_export.export import memory_size
+from cl_export.export import positive_int
+from cl_export.geometry import AtlasGeometry
+from cl_export.geometry import Block
+from cl_export.nrrd import NRRD_SUFFIX
+from cl_export.nrrd import nrrd_header
+from cl_export.profiling import stage
+
+# Count types, smallest first.
+COUNT_TYPES = (np.dtype(np.uint16), np.dtype(np.uint32))
+
+# Shards per worker process; more shards balance the load better, but each returns its counts separately.
+SHARDS_PER_JOB = 4
+
+# Counts of a channel within a voxel extent, as in a Block.
+Partial = Tuple[List[int], np.ndarray]
+
+
+def count_dtype(files: int) -> np.dtype:
+    """The smallest count type that holds counts up to ``files``."""
+
+    for dtype in COUNT_TYPES:
+        if files <= np.iinfo(dtype).max:
+            return dtype
+
+    raise ValueError("Too many annotation files: {}".format(files))
+
+
+def extent_union(extent: Optional[List[int]], other: List[int]) -> List[int]:
+    """The smallest voxel extent that contains ``extent``, if any, and ``other``."""
+
+    if extent is None:
+        return list(other)
+
+    return [min(a, b) if i % 2 == 0 else max(a, b) for i, (a, b) in enumerate(zip(extent, other))]
+
+
+def union_block(blocks: List[Block]) -> Block:
+    """The voxels in any of ``blocks``, as a single block."""
+
+    if len(blocks) == 1:
+        return blocks[0]
+
+    extent = None
+    for block_extent, _ in blocks:
+        extent = extent_union(extent, block_extent)
+
+    x0, x1, y0, y1, z0, z1 = extent
+    mask = np.zeros((z1 - z0 + 1, y1 - y0 + 1, x1 - x0 + 1), dtype=bool)
+    for (bx0, bx1, by0, by1, bz0, bz1), block_mask in blocks:
+        mask[bz0 - z0:bz1 - z0 + 1, by0 - y0:by1 - y0 + 1, bx0 - x0:bx1 - x0 + 1] |= block_mask
+
+    return extent, mask
+
+
+def _region(extent: List[int]) -> Tuple[slice, slice, slice]:
+    x0, x1, y0, y1, z0, z1 = extent
+    return slice(z0, z1 + 1), slice(y0, y1 + 1), slice(x0, x1 + 1)
+
+
+class Coverage:
+    """Per-voxel counts of the files covering each voxel, in channels; see the module documentation.
+
+    Channel None is the total. Count images are allocated when a channel is first covered, and zeroed pages are only
+    backed by memory once written.
+    """
+
+    def __init__(self, geometry: AtlasGeometry, dtype: np.dtype):
+        self.shape = tuple(reversed(geometry.size))
+        self.dtype = dtype
+        self.counts: Dict[Optional[str], np.ndarray] = {}
+        # extent of the covered voxels of each channel.
+        self.extents: Dict[Optional[str], List[int]] = {}
+
+    def _channel(self, channel: Optional[str]) -> np.ndarray:
+        if channel not in self.counts:
+            self.counts[channel] = np.zeros(self.shape, dtype=self.dtype)
+        return self.counts[channel]
+
+    def add_block(self, channel: Optional[str], block: Block):
+        """Count the voxels of ``block`` once in ``channel``."""
+
+        extent, mask = block
+        self._channel(channel)[_region(extent)][mask] += 1
+        self.extents[channel] = extent_union(self.extents.get(channel), extent)
+
+    def add_file(self, markup_blocks: List[Tuple[dict, Optional[Block]]], by_name: bool):
+        """Count the voxels covered by the annotations of one file, once per channel."""
+
+        channels = {}
+        for markup, block in markup_blocks:
+            if block is None:
+                continue
+            channels.setdefault(None, []).append(block)
+            if by_name and markup.get("name"):
+                channels.setdefault(markup["name"], []).append(block)
+
+        for channel, blocks in channels.items():
+            self.add_block(channel, union_block(blocks))
+
+    def partials(self) -> Dict[Optional[str], Partial]:
+        """The counts of each channel within its covered extent."""
+
+        return {channel: (extent, self.counts[channel][_region(extent)]) for channel, extent in self.extents.items()}
+
+    def add_partial(self, channel: Optional[str], partial: Partial):
+        extent, counts = partial
+        self._channel(channel)[_region(extent)] += counts
+        self.extents[channel] = extent_union(self.extents.get(channel), extent)
+
+
+def write_counts(counts: np.ndarray, geometry: AtlasGeometry, path: Path):
+    """Write a count image with ``geometry``; NRRD files are written directly, other formats with SimpleITK."""
+
+    if path.suffix == NRRD_SUFFIX:
+        with open(path, "wb") as f:
+            f.write(nrrd_header(geometry, counts.dtype))
+            counts.tofile(f)
+        return
+
+    import SimpleITK as sitk
+
+    image = sitk.GetImageFromArray(counts)
+    image.SetOrigin(geometry.origin)
+    image.SetSpacing(geometry.spacing)
+    image.SetDirection(geometry.direction)
+    sitk.WriteImage(image, str(path))
+
+
+def channel_path(pattern: str, name: str, number: int = 1) -> Path:
+    """``pattern`` with '{name}' replaced by an annotation name, made safe for a file name, and numbered after the
+    first.
+    """
+
+    safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
+    if number > 1:
+        safe = "{}-{}".format(safe, number)
+    return Path(pattern.format(name=safe))
+
+
+def channel_paths(pattern: str, names: Iterable[str], reserved: Iterable[Path] = ()) -> Dict[str, Path]:
+    """The channel_path() of each name, in order, numbered so that no two names, nor a ``reserved`` path, share a file.
+
+    Names made safe can coincide; ex. 'L5/6' and 'L5_6'. Paths are compared ignoring case, as on case-insensitive file
+    systems.
+    """
+
+    taken = {str(path).casefold() for path in reserved}
+    paths = {}
+    for name in names:
+        number = 1
+        while str(channel_path(pattern, name, number)).casefold() in taken:
+            number += 1
+        paths[name] = channel_path(pattern, name, number)
+        taken.add(str(paths[name]).casefold())
+
+    return paths
+
+
+# Per-process state for density workers; set by _init_worker.
+_worker_geometry = None
+_worker_rasterize = None
+_worker_dtype = None
+_worker_args = None
+
+
+def _init_worker(geometry: AtlasGeometry, dtype: np.dtype, args: argparse.Namespace):
+    global _worker_geometry, _worker_rasterize, _worker_dtype, _worker_args
+    mesh_cache = MeshCache(args.mesh_cache_dir, args.mesh_cache_size) if args.mesh_cache_dir else None
+
+    _worker_geometry = geometry
+    _worker_rasterize = markup_rasterizer(geometry, args.pir, args.engine, args.points_per_segment, mesh_cache)
+    _worker_dtype = dtype
+    _worker_args = args
+
+
+def _accumulate_shard(paths: List[Path]) -> Tuple[Dict[Optional[str], Partial], List[Tuple[Path, str]]]:
+    """Sum the coverage of the files in ``paths``; returns the partial counts of each channel, and the failures."""
+
+    coverage = Coverage(_worker_geometry, _worker_dtype)
+    failures = []
+
+    for path in paths:
+        with profiling.context(file=str(path)), stage("accumulate_file"):
+            try:
+                with stage("load_annotation"):
+                    markups = load_markups(path)
+                blocks = [(markup, _worker_rasterize(markup)) for markup in markups]
+            except Exception as e:
+                failures.append((path, "{}: {}".format(type(e).__name__, e)))
+                continue
+
+            with stage("accumulate"):
+                coverage.add_file(blocks, _worker_args.name_pattern is not None)
+
+    return coverage.partials(), failures
+
+
+def _reduce(coverage: Coverage, results: Iterable) -> List[Tuple[Path, str]]:
+    """Add the partial counts of each shard to ``coverage``; returns the failures of all shards."""
+
+    failures = []
+    for partials, shard_failures in results:
+        with stage("reduce"):
+            for channel, partial in partials.items():
+                coverage.add_partial(channel, partial)
+        failures.extend(shard_failures)
+
+    return failures
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog="cl-export density",
+        description=(
+            "Count how many Cell Locator annotation files cover each atlas voxel, across many files, and write the "
+            "counts as an image with the atlas geometry."
+        ),
+    )
+    parser.add_argument(
+        metavar="annotation",
+        dest="annotations",
+        nargs="*",
+        help="Input Cell Locator annotation files (JSON) or glob patterns; ex. 'specimens/**/*.json'.",
+    )
+    parser.add_argument(
+        "--manifest",
+        dest="manifest_path",
+        type=Path,
+        help="Text file listing input annotation files, one per line. Relative paths are relative to the manifest.",
+        default=None,
+    )
+    parser.add_argument(
+        "-a",
+        "--atlas",
+        dest="atlas_path",
+        type=Path,
+        help="Atlas volume or labelmap. Used to set spacing/direction on the output image.",
+        required=True,
+    )
+    parser.add_argument(
+        "--no-atlas-cache",
+        action="store_false",
+        dest="atlas_cache",
+        help="Always read the atlas geometry from the atlas file. See 'cl-export -h'.",
+        default=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output_path",
+        type=Path,
+        help="Output count image; ex. 'density.nrrd'. Each voxel holds the number of files covering it.",
+        required=True,
+    )
+    parser.add_argument(
+        "--by-name",
+        dest="name_pattern",
+        help=(
+            "Output path pattern for a count image per annotation name, counting the files whose annotations of that "
+            "name cover each voxel; ex. 'density/{name}.nrrd'. Each name needs a full-size count image while "
+            "counting. Names that give the same file name are numbered; ex. 'L5/6' and 'L5_6' are written to "
+            "'density/L5_6.nrrd' and 'density/L5_6-2.nrrd'."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--pir",
+        action="store_true",
+        dest="pir",
+        help=(
+            "If set, read the annotations in PIR format rather than RAS. This should only be necessary for old-style "
+            "CCF annotations. "
+        ),
+        default=False,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        help=(
+            "Number of worker processes. Each sums the coverage of its own files, so memory grows with the number of "
+            "workers. Use 0 to use all available cores."
+        ),
+        default=1,
+    )
+    parser.add_argument(
+        "--engine",
+        dest="engine",
+        choices=ENGINES,
+        help="Rasterization engine. See 'cl-export -h'. Defaults to 'vtk'.",
+        default="vtk",
+    )
+    parser.add_argument(
+        "--points-per-segment",
+        dest="points_per_segment",
+        type=positive_int,
+        help="Number of points to tessellate each curve segment with. See 'cl-export -h'.",
+        default=None,
+    )
+    parser.add_argument(
+        "--mesh-cache",
+        dest="mesh_cache_dir",
+        type=Path,
+        help=(
+            "Directory of cached annotation meshes, as for 'cl-export'. Meshes are keyed by the annotation geometry "
+            "and tessellation settings, so unchanged annotations are not rebuilt. The directory may be shared."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--mesh-cache-size",
+        dest="mesh_cache_size",
+        type=memory_size,
+        help="Size cap of the mesh cache; ex. '512M' or '2G'. Least recently used meshes are evicted first.",
+        default="1G",
+    )
+
+    return parser
+
+
+def main(argv=None):
+    parser = _parser()
+    args = parser.parse_args(argv)
+
+    if args.name_pattern and "{name}" not in args.name_pattern:
+        print("--by-name must contain '{name}'.", file=sys.stderr)
+        exit(-1)
+
+    annotations = collect_annotations(args.annotations, args.manifest_path)
+    if not annotations:
+        print("No annotation files given.", file=sys.stderr)
+        exit(-1)
+
+    geometry = load_atlas_geometry(args.atlas_path, args.atlas_cache)
+    dtype = count_dtype(len(annotations))
+
+    jobs = min(args.jobs or os.cpu_count(), len(annotations))
+    size = math.ceil(len(annotations) / (jobs * SHARDS_PER_JOB)) if jobs > 1 else len(annotations)
+    shards = [annotations[i:i + size] for i in range(0, len(annotations), size)]
+
+    coverage = Coverage(geometry, dtype)
+    if jobs <= 1:
+        _init_worker(geometry, dtype, args)
+        failures = _reduce(coverage, map(_accumulate_shard, shards))
+    else:
+        with profiling.pool(jobs, initializer=_init_worker, initargs=(geometry, dtype, args)) as pool:
+            failures = _reduce(coverage, profiling.imap(pool, _accumulate_shard, shards, ordered=False))
+
+    total = coverage.counts.get(None)
+    if total is None:
+        total = np.zeros(coverage.shape, dtype=dtype)
+    write_counts(total, geometry, args.output_path)
+
+    names = sorted(channel for channel in coverage.counts if channel is not None)
+    for name, path in channel_paths(args.name_pattern, names, [args.output_path]).items():
+        if path != channel_path(args.name_pattern, name):
+            print(
+                "Writing the counts of {!r} to {}, as another name has its file name.".format(name, path),
+                file=sys.stderr,
+            )
+        path.parent.mkdir(parents=True, exist_ok=True)
+        write_counts(coverage.counts[name], geometry, path)
+
+    print(
+        "Counted {} files; at most {} cover a voxel.".format(len(annotations) - len(failures), total.max()),
+        file=sys.stderr,
+    )
+
+    for path, error in failures:
+        print("{}: {}".format(path, error), file=sys.stderr)
+
+    if failures:
+        print("{} of {} files failed.".format(len(failures), len(annotations)), file=sys.stderr)
+        exit(-1)
+
+
+if __name__ == "__main__":
+    main()
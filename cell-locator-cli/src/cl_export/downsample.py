@@ -0,0 +1,159 @@
+"""
+Derive coarser labelmaps from finer ones, for 'cl-export --resolution' and the
+levels of OME-Zarr labelmaps.
+
+A coarse grid is a block downsampling of a finer one when both share the
+origin and direction, and each coarse spacing is a whole multiple ``f`` of the
+fine spacing; see block_factors(). Coarse voxel ``i`` then takes the most
+common label of the ``f`` fine voxels around its center along each axis,
+``f * i - f // 2`` to ``f * i - f // 2 + f - 1``; with an even ``f`` the block
+reaches half a fine voxel further below the center than above it. Fine voxels
+outside the image count as background. Ties go to the highest label, so an
+annotation that covers exactly half a block is kept rather than dropped.
+
+Only the coarse voxels whose blocks overlap the given fine extents, ex. the
+bounding boxes of the annotations, are computed. Nearly all blocks hold a
+single label, mostly background, so only blocks with more than one label are
+sorted to find their mode.
+"""
+
+import math
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+from cl_export.geometry import AtlasGeometry
+
+# Fine voxels read per chunk of coarse planes; bounds the temporary arrays to a few times this many labels.
+CHUNK_VOXELS = 2 ** 24
+
+
+def block_factors(fine: AtlasGeometry, coarse: AtlasGeometry) -> Optional[Tuple[int, int, int]]:
+    """The whole (x, y, z) factors from ``fine`` to ``coarse`` spacing, or None if ``coarse`` is not a block
+    downsampling of ``fine``.
+    """
+
+    if not np.allclose(fine.origin, coarse.origin) or not np.allclose(fine.direction, coarse.direction):
+        return None
+
+    factors = []
+    for fine_spacing, coarse_spacing in zip(fine.spacing, coarse.spacing):
+        factor = coarse_spacing / fine_spacing
+        if round(factor) < 1 or not math.isclose(factor, round(factor), rel_tol=1e-6):
+            return None
+        factors.append(round(factor))
+
+    return tuple(factors)
+
+
+def block_mode(blocks: np.ndarray) -> np.ndarray:
+    """The most common value in each row of ``blocks``; the highest of them on ties."""
+
+    values = np.sort(blocks, axis=1)
+    positions = np.arange(values.shape[1])
+
+    # the length of the run of equal values up to each position; the longest runs end at the modes.
+    starts = np.ones(values.shape, dtype=bool)
+    starts[:, 1:] = values[:, 1:] != values[:, :-1]
+    lengths = positions - np.maximum.accumulate(np.where(starts, positions, 0), axis=1)
+
+    last = positions[-1] - np.argmax(lengths[:, ::-1], axis=1)
+    return values[np.arange(len(values)), last]
+
+
+def block_modes(region: np.ndarray, factors: Tuple[int, int, int]) -> np.ndarray:
+    """The mode of each block of ``region``, in (z, y, x) order, whose shape is a whole number of blocks.
+
+    ``factors`` are the (x, y, z) block sizes. Blocks start at the first voxel of ``region``; downsample_labels() pads
+    the region so that they are centered on the coarse voxels.
+    """
+
+    fx, fy, fz = factors
+    nz, ny, nx = region.shape
+    shape = (nz // fz, ny // fy, nx // fx)
+
+    blocks = region.reshape(shape[0], fz, shape[1], fy, shape[2], fx).transpose(0, 2, 4, 1, 3, 5)
+    blocks = blocks.reshape(-1, fz * fy * fx)
+
+    labels = blocks.min(axis=1)
+    mixed = labels != blocks.max(axis=1)
+    if mixed.any():
+        labels[mixed] = block_mode(blocks[mixed])
+
+    return labels.reshape(shape)
+
+
+def coarse_extent(
+    extent: List[int], factors: Tuple[int, int, int], shape: Tuple[int, int, int]
+) -> Optional[List[int]]:
+    """The extent of the coarse voxels, of a (z, y, x) ``shape``, whose blocks overlap the fine voxel ``extent``."""
+
+    coarse = []
+    for low, high, factor, size in zip(extent[::2], extent[1::2], factors, reversed(shape)):
+        # fine voxel j is in the block of coarse voxel (j + f // 2) // f.
+        first = max((low + factor // 2) // factor, 0)
+        last = min((high + factor // 2) // factor, size - 1)
+        if first > last:
+            return None
+        coarse += [first, last]
+
+    return coarse
+
+
+def _padded(array: np.ndarray, starts: Tuple[int, ...], shape: Tuple[int, ...]) -> np.ndarray:
+    """The region of ``array`` at ``starts`` with ``shape``, zero where it extends beyond the array."""
+
+    region = np.zeros(shape, dtype=array.dtype)
+    source = tuple(slice(max(start, 0), min(start + n, size)) for start, n, size in zip(starts, shape, array.shape))
+    target = tuple(slice(s.start - start, s.stop - start) for s, start in zip(source, starts))
+    region[target] = array[source]
+    return region
+
+
+def _downsample_extent(fine: np.ndarray, coarse: np.ndarray, factors: Tuple[int, int, int], extent: List[int]):
+    fx, fy, fz = factors
+    x0, x1, y0, y1, z0, z1 = extent
+
+    plane = fz * fy * (y1 - y0 + 1) * fx * (x1 - x0 + 1)
+    depth = max(1, CHUNK_VOXELS // plane)
+
+    for c0 in range(z0, z1 + 1, depth):
+        c1 = min(c0 + depth, z1 + 1)
+        shape = (c1 - c0, y1 - y0 + 1, x1 - x0 + 1)
+
+        region = _padded(
+            fine,
+            (fz * c0 - fz // 2, fy * y0 - fy // 2, fx * x0 - fx // 2),
+            (fz * shape[0], fy * shape[1], fx * shape[2]),
+        )
+        coarse[c0:c1, y0:y1 + 1, x0:x1 + 1] = block_modes(region, factors)
+
+
+def downsample_labels(
+    fine: np.ndarray,
+    coarse: np.ndarray,
+    factors: Tuple[int, int, int],
+    extents: Optional[Iterable[List[int]]] = None,
+) -> List[List[int]]:
+    """Write the block mode of the ``fine`` labels into ``coarse``, both in (z, y, x) order, in place.
+
+    ``factors`` are the (x, y, z) block sizes; see block_factors(). ``coarse`` must be zeroed. If given, ``extents``
+    are fine voxel extents, as in a Block, that hold all the labels of ``fine``; only the coarse voxels whose blocks
+    overlap them are computed. Returns the coarse extents computed.
+    """
+
+    if extents is None:
+        nz, ny, nx = fine.shape
+        extents = [[0, nx - 1, 0, ny - 1, 0, nz - 1]]
+
+    computed = []
+    for extent in extents:
+        extent = coarse_extent(extent, factors, coarse.shape)
+        if extent is not None:
+            _downsample_extent(fine, coarse, factors, extent)
+            computed.append(extent)
+
+    return computed
@@ -1,35 +1,82 @@
 import argparse
+import colorsys
+import functools
+import importlib
 import json
+import math
+import os
 import sys
 
 from pathlib import Path
+from typing import TYPE_CHECKING
+from typing import Callable
 from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
 
-from vtkmodules.vtkAddon import vtkCurveGenerator
-from vtkmodules.vtkCommonCore import VTK_UNSIGNED_CHAR
 from vtkmodules.vtkCommonCore import vtkMath
 from vtkmodules.vtkCommonCore import vtkPoints
+from vtkmodules.vtkCommonDataModel import vtkCellArray
 from vtkmodules.vtkCommonDataModel import vtkImageData
+from vtkmodules.vtkCommonDataModel import vtkPolyData
 from vtkmodules.vtkCommonExecutionModel import vtkPolyDataAlgorithm
-from vtkmodules.vtkCommonMath import vtkMatrix3x3
+from vtkmodules.vtkCommonExecutionModel import vtkTrivialProducer
 from vtkmodules.vtkCommonMath import vtkMatrix4x4
 from vtkmodules.vtkCommonTransforms import vtkTransform
 from vtkmodules.vtkFiltersCore import vtkAppendPolyData
 from vtkmodules.vtkFiltersGeneral import vtkContourTriangulator
 from vtkmodules.vtkFiltersGeneral import vtkTransformPolyDataFilter
 from vtkmodules.vtkFiltersModeling import vtkLinearExtrusionFilter
-from vtkmodules.vtkIOLegacy import vtkPolyDataWriter
-from vtkmodules.vtkImagingStencil import vtkImageStencil
-from vtkmodules.vtkImagingStencil import vtkPolyDataToImageStencil
+from vtkmodules.util.numpy_support import numpy_to_vtk
+from vtkmodules.util.numpy_support import vtk_to_numpy
 
-import SimpleITK as sitk
+# SimpleITK, vtkAddon, and the VTK stencil and IO modules are imported by the functions that use them, so that
+# starting cl-export, and exports that do not need them, do not pay for loading them.
+if TYPE_CHECKING:
+    from vtkmodules.vtkAddon import vtkCurveGenerator
 
-from cl_export.vtk2sitk import vtk2sitk
+from cl_convert import converters
+from cl_convert import model as cl_model
+from cl_export import profiling
+from cl_export.cache import MeshCache
+from cl_export.cache import geometry_key
+from cl_export.cache import load_atlas_geometry
+from cl_export.geometry import AtlasGeometry
+from cl_export.geometry import Block
+from cl_export.meshes import MODEL_SUFFIXES
+from cl_export.meshes import is_model_path
+from cl_export.meshes import write_model
+from cl_export.nrrd import NRRD_SUFFIX
+from cl_export.nrrd import nrrd_header
+from cl_export.omezarr import ZARR_SUFFIX
+from cl_export.omezarr import is_zarr
+from cl_export.omezarr import write_ome_zarr
+from cl_export.profiling import stage
+from cl_export.slab import slab_block
+from cl_export.slab import slab_extent
+from cl_export.sparse import SPARSE_SUFFIX
+from cl_export.sparse import SparseLabelmap
+from cl_export.sparse import is_sparse
 
+ENGINES = ("vtk", "numpy")
+
+# Tessellation of curve segments for models, and whenever no voxel spacing is known.
+POINTS_PER_SEGMENT = 32
+
+# Adaptive tessellation for rasterization: target arc length between tessellated points, relative to the voxel
+# spacing; and the most points for any one segment.
+TESSELLATION_STEP = 0.25
+MAX_POINTS_PER_SEGMENT = 256
+
+
+def make_curve_generator(
+    points: vtkPoints, curve_type: str, points_per_segment: int = POINTS_PER_SEGMENT
+) -> 'vtkCurveGenerator':
+    from vtkmodules.vtkAddon import vtkCurveGenerator
 
-def make_curve(
-    points: vtkPoints, normal: list, curve_type: str
-) -> vtkPolyDataAlgorithm:
     curve_gen = vtkCurveGenerator()
 
     if curve_type == "spline":
@@ -39,12 +86,109 @@ def make_curve(
     else:
         raise ValueError("Unrecognized curve type {!r}".format(curve_type))
 
+    if points_per_segment < 1:
+        raise ValueError("points_per_segment must be positive, not {}".format(points_per_segment))
+
     curve_gen.SetCurveIsClosed(True)
-    curve_gen.SetNumberOfPointsPerInterpolatingSegment(32)
+    curve_gen.SetNumberOfPointsPerInterpolatingSegment(points_per_segment)
     curve_gen.SetInputPoints(points)
 
+    return curve_gen
+
+
+def adaptive_resolution(points: vtkPoints, curve_type: str, spacing: float) -> List[int]:
+    """Number of points to tessellate each segment of a closed curve with, to rasterize it on voxels of ``spacing``.
+
+    Polyline segments are exact with their end points alone. Spline segments get a point every TESSELLATION_STEP voxels
+    of arc length, estimated from a coarse tessellation.
+    """
+
+    count = points.GetNumberOfPoints()
+    if curve_type == "polyline":
+        return [1] * count
+
+    coarse = 8
+    curve_gen = make_curve_generator(points, curve_type, coarse)
+    curve_gen.Update()
+    polygon = vtk_to_numpy(curve_gen.GetOutput().GetPoints().GetData())[:count * coarse]
+    if len(polygon) < count * coarse:
+        return [POINTS_PER_SEGMENT] * count
+
+    closed = np.concatenate([polygon, polygon[:1]])
+    lengths = np.linalg.norm(np.diff(closed, axis=0), axis=1).reshape(count, coarse).sum(axis=1)
+
+    resolution = np.ceil(lengths / (spacing * TESSELLATION_STEP))
+    return np.clip(resolution, 1, MAX_POINTS_PER_SEGMENT).astype(int).tolist()
+
+
+def closed_polyline(polygon: np.ndarray) -> vtkPolyData:
+    points = vtkPoints()
+    points.SetData(numpy_to_vtk(np.ascontiguousarray(polygon, dtype=float), deep=True))
+
+    lines = vtkCellArray()
+    lines.InsertNextCell(len(polygon) + 1)
+    for i in list(range(len(polygon))) + [0]:
+        lines.InsertCellPoint(i)
+
+    polydata = vtkPolyData()
+    polydata.SetPoints(points)
+    polydata.SetLines(lines)
+    return polydata
+
+
+def tessellate_curve(
+    points: vtkPoints, curve_type: str, spacing: Optional[float] = None, points_per_segment: Optional[int] = None
+) -> vtkPolyData:
+    """Tessellate a closed curve into a polyline.
+
+    With ``points_per_segment``, or if ``spacing`` is not given, every segment gets the same number of points;
+    POINTS_PER_SEGMENT by default. Otherwise each segment gets as many points as adaptive_resolution() asks for on
+    voxels of ``spacing``: the curve is tessellated as finely as its longest segment needs, and shorter segments are
+    subsampled.
+    """
+
+    if points_per_segment is not None and points_per_segment < 1:
+        raise ValueError("points_per_segment must be positive, not {}".format(points_per_segment))
+
+    if points_per_segment is not None or not spacing:
+        curve_gen = make_curve_generator(points, curve_type, points_per_segment or POINTS_PER_SEGMENT)
+        curve_gen.Update()
+        return curve_gen.GetOutput()
+
+    resolution = adaptive_resolution(points, curve_type, spacing)
+    dense = max(resolution)
+
+    curve_gen = make_curve_generator(points, curve_type, dense)
+    curve_gen.Update()
+    polygon = vtk_to_numpy(curve_gen.GetOutput().GetPoints().GetData())
+    if len(polygon) < len(resolution) * dense:
+        return curve_gen.GetOutput()
+
+    # segment i starts at point i * dense, on the control point.
+    index = np.concatenate([
+        i * dense + np.arange(count) * dense // count
+        for i, count in enumerate(resolution)
+    ])
+    return closed_polyline(polygon[index])
+
+
+def make_curve(
+    points: vtkPoints,
+    normal: list,
+    curve_type: str,
+    spacing: Optional[float] = None,
+    points_per_segment: Optional[int] = None,
+) -> vtkPolyDataAlgorithm:
+    """Build the closed curve extruded by ``normal``, centered on the curve plane. See tessellate_curve()."""
+
+    if points_per_segment is not None or spacing:
+        curve = vtkTrivialProducer()
+        curve.SetOutput(tessellate_curve(points, curve_type, spacing, points_per_segment))
+    else:
+        curve = make_curve_generator(points, curve_type)
+
     triangulator = vtkContourTriangulator()
-    triangulator.SetInputConnection(curve_gen.GetOutputPort())
+    triangulator.SetInputConnection(curve.GetOutputPort())
 
     # so the result is centered on the curve plane
     offset = list(normal)
@@ -83,120 +227,848 @@ def ras_to_pir(model: vtkPolyDataAlgorithm) -> vtkPolyDataAlgorithm:
     return tform
 
 
-def load_annotation(filename: str) -> Iterator[vtkPolyDataAlgorithm]:
+def annotation_markup(annotation: cl_model.Annotation) -> dict:
+    """The markup of a normalized annotation, with the keys of the latest file format that cl-export reads."""
+
+    return {
+        "name": annotation.name,
+        "markup": {
+            "type": annotation.markup_type,
+            "controlPoints": [{"position": list(point.position)} for point in annotation.points],
+        },
+        "orientation": list(annotation.orientation),
+        "representationType": annotation.representation_type,
+        "thickness": annotation.thickness,
+    }
+
+
+def document_markups(document: cl_model.Document) -> List[dict]:
+    """The markups of the closed curve annotations of ``document``, in order; see annotation_markup().
+
+    Other markup types have no extent to rasterize or model, and are skipped, so they take no label.
+    """
+
+    markups = [
+        annotation_markup(annotation)
+        for annotation in document.annotations
+        if annotation.markup_type == "ClosedCurve"
+    ]
+
+    skipped = len(document.annotations) - len(markups)
+    if skipped:
+        print("Skipping {} annotations that are not closed curves".format(skipped), file=sys.stderr)
+
+    return markups
+
+
+def load_markups(filename: str) -> List[dict]:
+    """Read the markups of an annotation file of any version cl-convert supports; see document_markups().
+
+    The file is normalized in memory with cl_convert.converters.infer_normalize(), so older files need not be converted
+    first.
+    """
+
     with open(filename) as f:
         data = json.load(f)
 
-    for markup in data["markups"]:
-        curve_type = markup["representationType"]
+    _, document = converters.infer_normalize(data)
+    return document_markups(document)
 
-        points = vtkPoints()
-        for control_point in markup["markup"]["controlPoints"]:
-            points.InsertNextPoint(control_point["position"])
 
-        orientation = vtkMatrix4x4()
-        orientation.DeepCopy(markup["orientation"])
+def markup_curve(markup: dict) -> Tuple[vtkPoints, list, str]:
+    """Extract the control points, thickness-scaled plane normal and curve type of a markup."""
 
-        thickness = markup["thickness"]
-        normal = orientation.MultiplyPoint([0, 0, 1, 0])[:3]
-        normal = list(normal)
-        vtkMath.Normalize(normal)
-        vtkMath.MultiplyScalar(normal, thickness)
+    curve_type = markup["representationType"]
 
-        yield make_curve(points, normal, curve_type)
+    points = vtkPoints()
+    for control_point in markup["markup"]["controlPoints"]:
+        points.InsertNextPoint(control_point["position"])
 
+    orientation = vtkMatrix4x4()
+    orientation.DeepCopy(markup["orientation"])
 
-def vtkImageData_like(filename):
-    reader = sitk.ImageFileReader()
-    reader.SetFileName(str(filename))
+    thickness = markup["thickness"]
+    normal = orientation.MultiplyPoint([0, 0, 1, 0])[:3]
+    normal = list(normal)
+    vtkMath.Normalize(normal)
+    vtkMath.MultiplyScalar(normal, thickness)
 
-    reader.LoadPrivateTagsOn()
-    reader.ReadImageInformation()
+    return points, normal, curve_type
 
-    direction = vtkMatrix3x3()
-    direction.DeepCopy(reader.GetDirection())
 
-    image = vtkImageData()
-    image.SetDirectionMatrix(direction)
-    image.SetOrigin(*reader.GetOrigin())
-    image.SetSpacing(*reader.GetSpacing())
-    image.SetDimensions(*reader.GetSize())
+def markup_to_model(
+    markup: dict, spacing: Optional[float] = None, points_per_segment: Optional[int] = None
+) -> vtkPolyDataAlgorithm:
+    return make_curve(*markup_curve(markup), spacing, points_per_segment)
 
-    return image
 
+def markup_to_polygon(
+    markup: dict, pir: bool = False, spacing: Optional[float] = None, points_per_segment: Optional[int] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Tessellate a markup's curve, without triangulating or extruding it. See tessellate_curve().
 
-def apply_stencil(
-    model: vtkPolyDataAlgorithm, image: vtkImageData, val
-) -> vtkImageData:
-    # vtkPolyDataToImageStencil and vtkImageStencil do not respect image Direction. They do respect Origin and Spacing.
-    #
-    # However since the linear part of the transformation comes before the translation part, we must handle Direction
-    # and Origin together. The scaling part comes last, so we can let vtkImageStencil handle Spacing.
-    #
-    # Compute the linear and translational parts of the transform; then use the _inverse_ of that to move the model
-    # into the "local" space of the image.
+    :returns: (polygon, normal) — The (N, 3) curve points and the thickness-scaled plane normal; see slab_block().
+    """
+
+    points, normal, curve_type = markup_curve(markup)
+
+    curve = tessellate_curve(points, curve_type, spacing, points_per_segment)
+    polygon = vtk_to_numpy(curve.GetPoints().GetData()).astype(float)
+    normal = np.asarray(normal, dtype=float)
+
+    if pir:
+        matrix = np.array([
+            [RAS_TO_PIR_MATRIX.GetElement(i, j) for j in range(4)]
+            for i in range(4)
+        ])
+        polygon = polygon @ matrix[:3, :3].T + matrix[:3, 3]
+        normal = matrix[:3, :3] @ normal
+
+    return polygon, normal
+
+
+def build_model(
+    markup: dict,
+    pir: bool = False,
+    spacing: Optional[float] = None,
+    points_per_segment: Optional[int] = None,
+    mesh_cache: Optional[MeshCache] = None,
+) -> vtkPolyDataAlgorithm:
+    """Build the model of a markup, in PIR space if ``pir`` is set; see markup_to_model().
+
+    With ``mesh_cache``, a cached mesh with the same geometry and settings is reused; otherwise the model is built and
+    added to the cache.
+    """
+
+    key = None
+    if mesh_cache is not None:
+        key = geometry_key(markup, pir, spacing, points_per_segment)
+        with stage("mesh_cache_read"):
+            polydata = mesh_cache.get(key)
+        if polydata is not None:
+            model = vtkTrivialProducer()
+            model.SetOutput(polydata)
+            return model
+
+    with stage("make_curve"):
+        model = markup_to_model(markup, spacing, points_per_segment)
+        if pir:
+            model = ras_to_pir(model)
+        model.Update()
+
+    if mesh_cache is not None:
+        with stage("mesh_cache_write"):
+            mesh_cache.put(key, model.GetOutput())
+
+    return model
+
+
+def load_annotation(filename: str) -> Iterator[vtkPolyDataAlgorithm]:
+    for markup in load_markups(filename):
+        yield markup_to_model(markup)
+
+
+def vtkImageData_like(filename):
+    return AtlasGeometry.from_file(filename).to_image()
+
+
+def local_transform(geometry: AtlasGeometry) -> vtkTransform:
+    """The transform from world coordinates to the "local" space of images with ``geometry``; see
+    AtlasGeometry.world_to_local.
+    """
 
     tform = vtkTransform()
-    tform.Translate(image.GetOrigin())
+    tform.SetMatrix(geometry.world_to_local)
+    return tform
+
+
+def world_to_local(image: vtkImageData) -> vtkTransform:
+    return local_transform(AtlasGeometry.from_image(image))
 
-    matrix = vtkMatrix4x4()
-    matrix.DeepCopy(tform.GetMatrix())
 
-    for i in range(3):
-        for j in range(3):
-            matrix.SetElement(i, j, image.GetDirectionMatrix().GetElement(i, j))
+def stencil_extent(bounds, image: vtkImageData) -> Optional[List[int]]:
+    """Compute the voxel extent covered by ``bounds``, given in the "local" space of the image.
 
-    tform.SetMatrix(matrix)
-    tform.Inverse()
+    The extent is padded by one voxel and clipped to the image extent. Returns None if the bounds do not intersect the
+    image.
+    """
+
+    spacing = image.GetSpacing()
+    whole = image.GetExtent()
+
+    extent = []
+    for axis in range(3):
+        lo = math.floor(bounds[2 * axis] / spacing[axis]) - 1
+        hi = math.ceil(bounds[2 * axis + 1] / spacing[axis]) + 1
+        lo = max(lo, whole[2 * axis])
+        hi = min(hi, whole[2 * axis + 1])
+        if lo > hi:
+            return None
+        extent += [lo, hi]
+
+    return extent
+
+
+def stencil_block(
+    model: vtkPolyDataAlgorithm, image: vtkImageData, tform: Optional[vtkTransform] = None
+) -> Optional[Block]:
+    """Rasterize ``model`` within its voxel bounding box in ``image``.
+
+    Only the geometry of ``image`` is used; its scalars need not be allocated. ``tform`` may be passed to reuse a
+    transform previously computed by world_to_local() or local_transform().
+
+    :returns: (extent, mask) — The voxel extent of the bounding box and a boolean mask of the voxels inside the model,
+        in (z, y, x) order; or None if the model does not intersect the image.
+    """
 
     model_local = vtkTransformPolyDataFilter()
     model_local.SetInputConnection(model.GetOutputPort())
-    model_local.SetTransform(tform)
+    model_local.SetTransform(tform or world_to_local(image))
+    model_local.Update()
+
+    extent = stencil_extent(model_local.GetOutput().GetBounds(), image)
+    if extent is None:
+        return None
+
+    from vtkmodules.vtkImagingStencil import vtkImageStencilToImage
+    from vtkmodules.vtkImagingStencil import vtkPolyDataToImageStencil
 
     # Now that the model is in "local" space of the image, we can safely ignore Direction and Origin and use
-    # vtkImageStencil as normal.
+    # vtkPolyDataToImageStencil as normal.
     to_stencil = vtkPolyDataToImageStencil()
     to_stencil.SetInputConnection(model_local.GetOutputPort())
     to_stencil.SetOutputSpacing(image.GetSpacing())
-    to_stencil.SetOutputWholeExtent(image.GetExtent())
+    to_stencil.SetOutputWholeExtent(extent)
+
+    to_mask = vtkImageStencilToImage()
+    to_mask.SetInputConnection(to_stencil.GetOutputPort())
+    to_mask.SetInsideValue(1)
+    to_mask.SetOutsideValue(0)
+    to_mask.SetOutputScalarTypeToUnsignedChar()
+    to_mask.Update()
+
+    x0, x1, y0, y1, z0, z1 = extent
+    mask = vtk_to_numpy(to_mask.GetOutput().GetPointData().GetScalars())
+    mask = mask.reshape(z1 - z0 + 1, y1 - y0 + 1, x1 - x0 + 1).view(bool)
+
+    return extent, mask
+
+
+def labelmap_array(image: vtkImageData) -> np.ndarray:
+    """The labels of ``image`` in (z, y, x) order; a view on its scalars."""
+
+    return vtk_to_numpy(image.GetPointData().GetScalars()).reshape(tuple(reversed(image.GetDimensions())))
+
+
+def paint_array(labels: np.ndarray, block: Optional[Block], val, z_offset: int = 0):
+    """Write ``val`` into the voxels of ``labels``, in (z, y, x) order, selected by ``block``.
+
+    ``z_offset`` is the z index of the first plane of ``labels``, when it holds only a slab of the image.
+    """
+
+    if block is None:
+        return
+
+    extent, mask = block
+    x0, x1, y0, y1, z0, z1 = extent
+    z0, z1 = z0 - z_offset, z1 - z_offset
+
+    labels[z0:z1 + 1, y0:y1 + 1, x0:x1 + 1][mask] = val
+
+
+def paint_block(image: vtkImageData, block: Optional[Block], val):
+    """Write ``val`` into the voxels of ``image`` selected by ``block``, in place."""
+
+    if block is None:
+        return
+
+    # the numpy array is a view on the image scalars; assigning through it writes the labels in place.
+    paint_array(labelmap_array(image), block, val)
+    image.GetPointData().GetScalars().Modified()
+
+
+def apply_stencil(
+    model: vtkPolyDataAlgorithm, image: vtkImageData, val, tform: Optional[vtkTransform] = None
+) -> vtkImageData:
+    """Write ``val`` into the voxels of ``image`` inside ``model``.
+
+    The image scalars are modified in place. Only the voxel bounding box of the model is stencilled, so the cost
+    scales with the size of the annotation rather than the size of the image. When stencilling many models into the
+    same image, pass ``tform`` from local_transform() rather than recomputing it for each one.
+    """
+
+    paint_block(image, stencil_block(model, image, tform), val)
+    return image
+
+
+def markup_rasterizer(
+    geometry: AtlasGeometry,
+    pir: bool,
+    engine: str = "vtk",
+    points_per_segment: Optional[int] = None,
+    mesh_cache: Optional[MeshCache] = None,
+) -> Callable[[dict, Optional[Tuple[int, int]]], Optional[Block]]:
+    """Create a function that rasterizes a markup within its bounding box on ``geometry``.
+
+    The function optionally takes a (z0, z1) range of z indices, inclusive, to rasterize only that slab of the image.
+    Voxels are classified the same way regardless of the range.
+
+    :param engine: ``"vtk"`` to stencil the extruded mesh, as stencil_block(); or ``"numpy"`` to test voxels against
+        the planar polygon directly, as slab_block().
+    :param points_per_segment: Tessellate curves with this many points per segment, rather than adaptively for the
+        spacing of ``geometry``; see tessellate_curve().
+    :param mesh_cache: Reuse cached models with the 'vtk' engine; see build_model(). The 'numpy' engine does not build
+        models.
+    """
+
+    spacing = min(geometry.spacing)
+
+    if engine == "vtk":
+        image = geometry.to_image()
+        tform = local_transform(geometry)
+
+        def rasterize_block(markup: dict, zrange: Optional[Tuple[int, int]] = None) -> Optional[Block]:
+            model = build_model(markup, pir, spacing, points_per_segment, mesh_cache)
+
+            slab = image
+            if zrange is not None:
+                # same origin, spacing and direction; only the extent is restricted.
+                x0, x1, y0, y1, _, _ = image.GetExtent()
+                slab = geometry.to_image()
+                slab.SetExtent(x0, x1, y0, y1, *zrange)
+
+            with stage("apply_stencil"):
+                return stencil_block(model, slab, tform)
+
+    elif engine == "numpy":
+
+        def rasterize_block(markup: dict, zrange: Optional[Tuple[int, int]] = None) -> Optional[Block]:
+            with stage("make_curve"):
+                polygon, normal = markup_to_polygon(markup, pir, spacing, points_per_segment)
+            with stage("slab_block"):
+                return slab_block(polygon, normal, geometry, zrange)
+
+    else:
+        raise ValueError("Unrecognized engine {!r}".format(engine))
+
+    def rasterize(markup: dict, zrange: Optional[Tuple[int, int]] = None) -> Optional[Block]:
+        with stage("rasterize", annotation=markup.get("name"), zrange=zrange):
+            return rasterize_block(markup, zrange)
+
+    return rasterize
+
+
+# Per-process state for rasterization workers; set by _init_worker.
+_worker_rasterize = None
+
+
+def _init_worker(
+    geometry: AtlasGeometry,
+    pir: bool,
+    engine: str,
+    points_per_segment: Optional[int],
+    mesh_cache: Optional[MeshCache],
+):
+    global _worker_rasterize
+    _worker_rasterize = markup_rasterizer(geometry, pir, engine, points_per_segment, mesh_cache)
+
+
+def _worker_rasterize_markup(item: Tuple[dict, Optional[Tuple[int, int]]]) -> Optional[Block]:
+    return _worker_rasterize(*item)
+
+
+def rasterize_markups(
+    markups: List[dict],
+    geometry: AtlasGeometry,
+    pir: bool,
+    jobs: int = 1,
+    engine: str = "vtk",
+    zranges: Optional[List[Optional[Tuple[int, int]]]] = None,
+    points_per_segment: Optional[int] = None,
+    mesh_cache: Optional[MeshCache] = None,
+) -> Iterator[Optional[Block]]:
+    """Rasterize each markup within its bounding box on ``geometry``. See markup_rasterizer().
+
+    With ``jobs > 1``, markups are rasterized in a pool of worker processes. Blocks are always yielded in markup order,
+    so painting them in order preserves the overwrite order (later annotations win).
+
+    :param zranges: If given, the (z0, z1) slab of the image to rasterize each markup in; None for the whole image.
+    """
+
+    items = list(zip(markups, zranges or [None] * len(markups)))
+
+    if jobs <= 1:
+        rasterize = markup_rasterizer(geometry, pir, engine, points_per_segment, mesh_cache)
+        yield from (rasterize(*item) for item in items)
+        return
+
+    initargs = (geometry, pir, engine, points_per_segment, mesh_cache)
+    with profiling.pool(jobs, initializer=_init_worker, initargs=initargs) as pool:
+        yield from profiling.imap(pool, _worker_rasterize_markup, items)
+
+
+def export_model(
+    markups: List[dict],
+    model_path: Path,
+    pir: bool,
+    ascii: bool = False,
+    max_triangles: Optional[int] = None,
+    points_per_segment: Optional[int] = None,
+    mesh_cache: Optional[MeshCache] = None,
+):
+    """Write the models of all ``markups`` to a single file; see cl_export.meshes.write_model()."""
+
+    append = vtkAppendPolyData()
+    for markup in markups:
+        with stage("model", annotation=markup.get("name")):
+            model = build_model(markup, pir, points_per_segment=points_per_segment, mesh_cache=mesh_cache)
+        append.AddInputConnection(model.GetOutputPort())
+
+    with stage("write_model"):
+        write_model(append, model_path, ascii, max_triangles)
+
+
+def split_model_path(model_path: Path, label: int, count: int) -> Path:
+    """Path of the model of annotation ``label`` of ``count``; ex. 'model.vtp' -> 'model-007.vtp'."""
+
+    return model_path.with_name("{}-{:0{}d}{}".format(model_path.stem, label, len(str(count)), model_path.suffix))
+
+
+def _export_split_model(
+    item: Tuple[dict, Path],
+    pir: bool,
+    ascii: bool,
+    max_triangles: Optional[int],
+    points_per_segment: Optional[int],
+    mesh_cache: Optional[MeshCache],
+):
+    markup, path = item
+
+    with stage("model", annotation=markup.get("name")):
+        model = build_model(markup, pir, points_per_segment=points_per_segment, mesh_cache=mesh_cache)
+        with stage("write_model"):
+            write_model(model, path, ascii, max_triangles)
+
+
+def export_split_models(
+    markups: List[dict],
+    model_path: Path,
+    pir: bool,
+    jobs: int = 1,
+    ascii: bool = False,
+    max_triangles: Optional[int] = None,
+    points_per_segment: Optional[int] = None,
+    mesh_cache: Optional[MeshCache] = None,
+) -> List[Path]:
+    """Write the model of each markup to its own file, named by split_model_path(); in parallel with ``jobs > 1``.
+
+    ``max_triangles`` applies to each model.
+
+    :returns: The paths written, in markup order.
+    """
+
+    paths = [split_model_path(model_path, label, len(markups)) for label in range(1, len(markups) + 1)]
+    export = functools.partial(
+        _export_split_model,
+        pir=pir,
+        ascii=ascii,
+        max_triangles=max_triangles,
+        points_per_segment=points_per_segment,
+        mesh_cache=mesh_cache,
+    )
+    items = list(zip(markups, paths))
+
+    if jobs <= 1 or len(items) <= 1:
+        for item in items:
+            export(item)
+    else:
+        with profiling.pool(min(jobs, len(items))) as pool:
+            for _ in profiling.imap(pool, export, items, ordered=False):
+                pass
+
+    return paths
+
+
+# Label types, smallest first, and their SimpleITK pixel types.
+LABEL_TYPES = {
+    np.dtype(np.uint8): "sitkUInt8",
+    np.dtype(np.uint16): "sitkUInt16",
+    np.dtype(np.uint32): "sitkUInt32",
+}
+
+
+def label_dtype(count: int) -> np.dtype:
+    """The smallest label type that holds labels 1 to ``count``."""
+
+    for dtype in LABEL_TYPES:
+        if count <= np.iinfo(dtype).max:
+            return dtype
+
+    raise ValueError("Too many annotations for a labelmap: {}".format(count))
+
+
+def labelmap_dtype(image: vtkImageData) -> np.dtype:
+    return vtk_to_numpy(image.GetPointData().GetScalars()).dtype
+
+
+def label_color(label: int) -> Tuple[int, int, int]:
+    # golden ratio hue steps keep neighbouring labels distinguishable.
+    r, g, b = colorsys.hsv_to_rgb((label * 0.618033988749895) % 1, 0.65, 0.95)
+    return round(r * 255), round(g * 255), round(b * 255)
+
+
+def write_color_table(markups: List[dict], path: Path):
+    """Write a Slicer color table naming each label after its annotation; see export_labelmap()."""
+
+    with open(path, "w") as f:
+        f.write("0 Background 0 0 0 0\n")
+        for label, markup in enumerate(markups, 1):
+            # Slicer does not support spaces in names.
+            name = (markup.get("name") or "Annotation {}".format(label)).replace(" ", "_")
+            f.write("{} {} {} {} {} 255\n".format(label, name, *label_color(label)))
+
+
+def allocate_labelmap(geometry: AtlasGeometry, dtype=np.uint8) -> vtkImageData:
+    """Allocate a zeroed labelmap with ``geometry``, with one of the label types in LABEL_TYPES.
 
-    stencil = vtkImageStencil()
-    stencil.SetInputData(image)
-    stencil.SetStencilConnection(to_stencil.GetOutputPort())
-    stencil.ReverseStencilOn()
-    stencil.SetBackgroundValue(val)
+    The scalars share the buffer of a SimpleITK image, so export_labelmap() writes it without another full-size copy;
+    see sitk2vtk().
+    """
 
-    stencil.Update()
+    import SimpleITK as sitk
+    from cl_export.vtk2sitk import sitk2vtk
 
-    # Up to this point we operated in "local" space for the image; the stencil is done now propagate the
-    # Direction/Origin to the output image.
-    output = stencil.GetOutput()
-    output.SetDirectionMatrix(image.GetDirectionMatrix())
-    output.SetOrigin(image.GetOrigin())
-    output.SetSpacing(image.GetSpacing())
-    output.SetExtent(image.GetExtent())
+    labelmap = sitk.Image(geometry.size, getattr(sitk, LABEL_TYPES[np.dtype(dtype)]))
+    labelmap.SetOrigin(geometry.origin)
+    labelmap.SetSpacing(geometry.spacing)
+    labelmap.SetDirection(geometry.direction)
+    return sitk2vtk(labelmap)
 
-    return output
+
+def rasterize_labelmap(
+    markups: List[dict],
+    image: vtkImageData,
+    pir: bool,
+    jobs: int = 1,
+    engine: str = "vtk",
+    points_per_segment: Optional[int] = None,
+    mesh_cache: Optional[MeshCache] = None,
+) -> List[List[int]]:
+    """Rasterize ``markups`` into ``image``, in place; returns the voxel extents of the labels, one per markup that
+    intersects the image.
+
+    ``image`` must have allocated scalars, as from allocate_labelmap(), of a type that holds one label per markup;
+    see label_dtype(). It is cleared first, so the same image may be reused to export several files.
+    """
+
+    dtype = labelmap_dtype(image)
+    if len(markups) > np.iinfo(dtype).max:
+        raise ValueError("{} annotations do not fit in a {} labelmap".format(len(markups), dtype))
+
+    image.GetPointData().GetScalars().Fill(0)
+
+    geometry = AtlasGeometry.from_image(image)
+    blocks = rasterize_markups(
+        markups, geometry, pir, jobs, engine, points_per_segment=points_per_segment, mesh_cache=mesh_cache
+    )
+
+    extents = []
+    for i, block in enumerate(blocks, 1):
+        with stage("paint"):
+            paint_block(image, block, i)
+        if block is not None:
+            extents.append(block[0])
+
+    return extents
+
+
+def write_labelmap(image: vtkImageData, labelmap_path: Path):
+    import SimpleITK as sitk
+    from cl_export.vtk2sitk import vtk2sitk
+
+    with stage("vtk2sitk"):
+        sitkimg = vtk2sitk(image)
+
+    with stage("write"):
+        writer = sitk.ImageFileWriter()
+        writer.SetFileName(str(labelmap_path))
+        writer.Execute(sitkimg)
+
+
+def export_labelmap(
+    markups: List[dict],
+    image: vtkImageData,
+    labelmap_path: Path,
+    pir: bool,
+    jobs: int = 1,
+    engine: str = "vtk",
+    points_per_segment: Optional[int] = None,
+    mesh_cache: Optional[MeshCache] = None,
+):
+    """Rasterize ``markups`` into ``image`` and write it to ``labelmap_path``; see rasterize_labelmap()."""
+
+    rasterize_labelmap(markups, image, pir, jobs, engine, points_per_segment, mesh_cache)
+    write_labelmap(image, labelmap_path)
+
+
+def resolution_path(labelmap_path: Path, resolution: float) -> Path:
+    """``labelmap_path`` with '{resolution}' replaced by ``resolution``; ex. 'labels_{resolution}.nrrd'."""
+
+    return Path(str(labelmap_path).format(resolution="{:g}".format(resolution)))
+
+
+def export_labelmap_resolutions(
+    markups: List[dict],
+    geometry: AtlasGeometry,
+    labelmap_path: Path,
+    resolutions: List[float],
+    pir: bool,
+    jobs: int = 1,
+    engine: str = "vtk",
+    points_per_segment: Optional[int] = None,
+    mesh_cache: Optional[MeshCache] = None,
+):
+    """Export a labelmap of ``markups`` at each isotropic resolution, to ``labelmap_path`` formatted with
+    resolution_path(); see AtlasGeometry.resampled().
+
+    Resolutions are exported finest first. Each is downsampled from the finest one it is a block downsampling of, so
+    that errors do not compound; this only reads the voxels around the labels, and is cheaper than rasterizing again.
+    See cl_export.downsample. The others, such as 25 µm from 10 µm, are rasterized directly; the finest always is.
+    """
+
+    from cl_export.downsample import block_factors
+    from cl_export.downsample import downsample_labels
+
+    dtype = label_dtype(len(markups))
+
+    # geometry, image and label extents of each exported resolution, finest first.
+    exported = []
+    for resolution in sorted(set(resolutions)):
+        target = geometry.resampled(resolution)
+        with stage("allocate", resolution=resolution):
+            image = allocate_labelmap(target, dtype)
+
+        for finer, source, source_extents in exported:
+            factors = block_factors(finer, target)
+            if factors:
+                with stage("downsample", resolution=resolution, factors=factors):
+                    extents = downsample_labels(
+                        labelmap_array(source), labelmap_array(image), factors, source_extents
+                    )
+                break
+        else:
+            extents = rasterize_labelmap(markups, image, pir, jobs, engine, points_per_segment, mesh_cache)
+
+        write_labelmap(image, resolution_path(labelmap_path, resolution))
+
+        exported.append((target, image, extents))
+
+
+# Bytes held per voxel of a slab, beyond the labels themselves: the block masks and the stencil output.
+SLAB_OVERHEAD = 2
+
+
+def export_labelmap_slabs(
+    markups: List[dict],
+    geometry: AtlasGeometry,
+    labelmap_path: Path,
+    pir: bool,
+    max_memory: int,
+    jobs: int = 1,
+    engine: str = "vtk",
+    points_per_segment: Optional[int] = None,
+    mesh_cache: Optional[MeshCache] = None,
+):
+    """Rasterize ``markups`` and write the labelmap one z-slab at a time, for images that do not fit in memory.
+
+    Slabs are as deep as ``max_memory`` bytes allow, but at least one plane. Each markup is only rasterized in the
+    slabs its bounding box intersects, and each slab is appended to the file as soon as it is painted. The output
+    must be NRRD; it is identical to the file export_labelmap() writes.
+    """
+
+    nx, ny, nz = geometry.size
+    dtype = label_dtype(len(markups))
+
+    depth = max(1, min(nz, max_memory // (nx * ny * (dtype.itemsize + SLAB_OVERHEAD))))
+    slabs = [(z0, min(z0 + depth, nz) - 1) for z0 in range(0, nz, depth)]
+
+    # z range of each markup, padded by a voxel since the engines compute their bounding boxes slightly differently.
+    bounds = []
+    with stage("slab_bounds"):
+        for markup in markups:
+            polygon, normal = markup_to_polygon(markup, pir, min(geometry.spacing), points_per_segment)
+            extent = slab_extent(polygon, normal, geometry)
+            bounds.append((extent[4] - 1, extent[5] + 1) if extent else None)
+
+    tasks = [
+        (label, markup, slab)
+        for slab in slabs
+        for label, (markup, bound) in enumerate(zip(markups, bounds), 1)
+        if bound and bound[0] <= slab[1] and bound[1] >= slab[0]
+    ]
+    blocks = rasterize_markups(
+        [markup for _, markup, _ in tasks],
+        geometry,
+        pir,
+        jobs,
+        engine,
+        [slab for _, _, slab in tasks],
+        points_per_segment,
+        mesh_cache,
+    )
+    results = zip(tasks, blocks)
+    pending = next(results, None)
+
+    with open(labelmap_path, "wb") as f:
+        f.write(nrrd_header(geometry, dtype))
+
+        for z0, z1 in slabs:
+            labels = np.zeros((z1 - z0 + 1, ny, nx), dtype=dtype)
+
+            while pending and pending[0][2] == (z0, z1):
+                (label, _, _), block = pending
+                with stage("paint"):
+                    paint_array(labels, block, label, z0)
+                pending = next(results, None)
+
+            with stage("write", zrange=(z0, z1)):
+                labels.tofile(f)
+
+
+def export_sparse_labelmap(
+    markups: List[dict],
+    geometry: AtlasGeometry,
+    labelmap_path: Path,
+    pir: bool,
+    jobs: int = 1,
+    engine: str = "vtk",
+    points_per_segment: Optional[int] = None,
+    mesh_cache: Optional[MeshCache] = None,
+):
+    """Rasterize ``markups`` and write them as a sparse labelmap; see cl_export.sparse.
+
+    No dense image is allocated, so the cost scales with the number of annotated voxels rather than the atlas size.
+    """
+
+    blocks = rasterize_markups(
+        markups, geometry, pir, jobs, engine, points_per_segment=points_per_segment, mesh_cache=mesh_cache
+    )
+    sparse = SparseLabelmap.from_blocks(enumerate(blocks, 1), geometry, label_dtype(len(markups)))
+
+    with stage("write"):
+        sparse.write(labelmap_path)
+
+
+def export_zarr_labelmap(
+    markups: List[dict],
+    geometry: AtlasGeometry,
+    labelmap_path: Path,
+    pir: bool,
+    levels: int = 1,
+    jobs: int = 1,
+    engine: str = "vtk",
+    points_per_segment: Optional[int] = None,
+    mesh_cache: Optional[MeshCache] = None,
+):
+    """Rasterize ``markups`` and write them as an OME-Zarr labelmap with ``levels`` resolutions; see cl_export.omezarr.
+
+    No dense image is allocated, and only chunks that hold a label are written, ``jobs`` at a time.
+    """
+
+    blocks = rasterize_markups(
+        markups, geometry, pir, jobs, engine, points_per_segment=points_per_segment, mesh_cache=mesh_cache
+    )
+    colors = {label: label_color(label) for label in range(1, len(markups) + 1)}
+
+    with stage("write"):
+        write_ome_zarr(enumerate(blocks, 1), geometry, labelmap_path, label_dtype(len(markups)), levels, jobs, colors)
+
+
+MEMORY_UNITS = {"": 1, "K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+
+
+def positive_int(text: str) -> int:
+    """Parse a positive integer argument."""
+
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid int value: {!r}".format(text))
+
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be positive, not {}".format(value))
+
+    return value
+
+
+def memory_size(text: str) -> int:
+    """Parse a size in bytes with an optional binary unit suffix; ex. '512M', '2G', '1.5G'."""
+
+    text = text.strip().upper().rstrip("B")
+    unit = text[-1:] if text[-1:] in MEMORY_UNITS else ""
+    try:
+        size = float(text[:len(text) - len(unit)])
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid memory size: {!r}".format(text))
+
+    if size <= 0:
+        raise argparse.ArgumentTypeError("memory size must be positive")
+
+    return int(size * MEMORY_UNITS[unit])
 
 
 def _parser():
     parser = argparse.ArgumentParser(
         description='Export Cell Locator annotations to VTK model or labelmap.',
+        epilog=(
+            "To export many annotation files against the same atlas, use 'cl-export batch'. To convert a sparse "
+            "labelmap to a dense image, use 'cl-export expand'. To count annotation voxels per atlas structure, use "
+            "'cl-export stats', and files per voxel with 'cl-export density'. To measure the volume, area and centroid "
+            "of each annotation, use 'cl-export metrics'. To keep the atlas and workers warm between exports, use "
+            "'cl-export serve'. Run any of them with -h for details."
+        ),
     )
     parser.add_argument(
         metavar="annotation",
         dest="annotation_path",
         type=Path,
-        help="Input Cell Locator annotation file (JSON).",
+        help="Input Cell Locator annotation file (JSON), of any version; see 'cl-convert versions'.",
     )
     parser.add_argument(
         "-m",
         "--model",
         dest="model_path",
         type=Path,
-        help="Output path for annotation model. If not provided, model generation is skipped.",
+        help=(
+            "Output path for annotation model. The format is given by the suffix: '.vtk' (legacy), '.vtp' (XML, "
+            "compressed), '.stl' or '.ply'. If not provided, model generation is skipped."
+        ),
         default=None,
     )
+    parser.add_argument(
+        "--split-models",
+        action="store_true",
+        dest="split_models",
+        help=(
+            "If set, write one model per annotation rather than a single model, numbered by label; ex. "
+            "'model-001.vtp'. Models are written in parallel with --jobs."
+        ),
+        default=False,
+    )
+    parser.add_argument(
+        "--max-triangles",
+        dest="max_triangles",
+        type=int,
+        help="If set, decimate each written model to about this many triangles.",
+        default=None,
+    )
+    parser.add_argument(
+        "--ascii",
+        action="store_true",
+        dest="ascii",
+        help="If set, write '.vtk', '.stl' and '.ply' models as text rather than binary.",
+        default=False,
+    )
     parser.add_argument(
         "-l",
         "--labelmap",
@@ -204,7 +1076,54 @@ def _parser():
         type=Path,
         help=(
             "Output path for annotation labelmap. If not provided, labelmap generation is skipped. Requires --atlas "
-            "for spacing information. "
+            "for spacing information. If the path ends with '.npz', a sparse run-length encoded labelmap is written "
+            "instead of a dense image; use 'cl-export expand' to convert it to a dense image. If it ends with "
+            "'{}', ex. 'labels.ome.zarr', an OME-Zarr labelmap is written, with only the chunks that hold a label. "
+        ).format(ZARR_SUFFIX),
+        default=None,
+    )
+    parser.add_argument(
+        "--zarr-levels",
+        dest="zarr_levels",
+        type=int,
+        help=(
+            "Number of resolutions in an OME-Zarr labelmap, each half the resolution of the one before and "
+            "downsampled by block mode. Defaults to 1, the atlas resolution only."
+        ),
+        default=1,
+    )
+    parser.add_argument(
+        "--resolution",
+        dest="resolutions",
+        type=float,
+        nargs="+",
+        help=(
+            "Isotropic resolutions to write the labelmap at, in atlas units; ex. '--resolution 10 25 50 100' for CCF "
+            "atlases. Each has the atlas origin and direction, so it matches the CCF atlas at that resolution. The "
+            "labelmap path must contain '{resolution}'; ex. 'labels_{resolution}.nrrd'. The finest resolution is "
+            "rasterized, and coarser ones whose spacing is a whole multiple of a finer one are downsampled from it by "
+            "block mode. If not provided, the labelmap has the atlas geometry."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        dest="incremental",
+        help=(
+            "If set, record each annotation in '<labelmap>.manifest.json', and on re-export only repaint the voxels "
+            "of annotations that changed, were added or were removed, patching the existing labelmap in place. "
+            "Requires a '{}' labelmap. Combine with --mesh-cache so that models reuse unchanged meshes too."
+        ).format(NRRD_SUFFIX),
+        default=False,
+    )
+    parser.add_argument(
+        "--lut",
+        dest="lut_path",
+        type=Path,
+        help=(
+            "Output path for a Slicer color table naming each label of the labelmap after its annotation; ex. "
+            "'labels.ctbl'. "
         ),
         default=None,
     )
@@ -216,6 +1135,17 @@ def _parser():
         help="Atlas volume or labelmap. Used to set spacing/direction on the output labelmap.",
         default=None,
     )
+    parser.add_argument(
+        "--no-atlas-cache",
+        action="store_false",
+        dest="atlas_cache",
+        help=(
+            "Always read the atlas geometry from the atlas file. By default it is remembered in "
+            "'~/.cache/cl-export/atlas-geometry.json' (under XDG_CACHE_HOME if set), so later exports against an "
+            "unchanged atlas do not open it."
+        ),
+        default=True,
+    )
     parser.add_argument(
         "--pir",
         action="store_true",
@@ -226,11 +1156,98 @@ def _parser():
         ),
         default=False,
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        help=(
+            "Number of worker processes used to rasterize the labelmap and write split models. Use 0 to use all "
+            "available cores."
+        ),
+        default=1,
+    )
+    parser.add_argument(
+        "--engine",
+        dest="engine",
+        choices=ENGINES,
+        help=(
+            "Labelmap rasterization engine. 'vtk' stencils the extruded annotation mesh; 'numpy' tests voxels "
+            "against the annotation plane and polygon directly, which is faster. Defaults to 'vtk'."
+        ),
+        default="vtk",
+    )
+    parser.add_argument(
+        "--points-per-segment",
+        dest="points_per_segment",
+        type=positive_int,
+        help=(
+            "Number of points to tessellate each curve segment with. By default, labelmaps tessellate each segment "
+            "from its arc length so that points are about a quarter voxel apart, and models use {} points per "
+            "segment.".format(POINTS_PER_SEGMENT)
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--max-memory",
+        dest="max_memory",
+        type=memory_size,
+        help=(
+            "Approximate memory budget for the labelmap; ex. '512M' or '2G'. If set, the labelmap is rasterized and "
+            "written in z-slabs that fit the budget rather than held in memory whole. The output is identical. Only "
+            "NRRD labelmaps can be written this way; sparse labelmaps never hold the whole image. "
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--mesh-cache",
+        dest="mesh_cache_dir",
+        type=Path,
+        help=(
+            "Directory of cached annotation meshes, reused by --model and --labelmap. Meshes are keyed by the "
+            "annotation geometry and tessellation settings, so unchanged annotations are not rebuilt on re-export. The "
+            "directory may be shared."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--mesh-cache-size",
+        dest="mesh_cache_size",
+        type=memory_size,
+        help="Size cap of the mesh cache; ex. '512M' or '2G'. Least recently used meshes are evicted first.",
+        default="1G",
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profile_path",
+        type=Path,
+        help=(
+            "Write a timeline of the export stages, per annotation, to this Chrome trace JSON file, and print the time "
+            "and peak resident memory of each stage. Open the trace in chrome://tracing or https://ui.perfetto.dev."
+        ),
+        default=None,
+    )
 
     return parser
 
 
+# Subcommands are dispatched on the first argument; everything else is parsed by _parser().
+SUBCOMMANDS = {
+    "batch": "cl_export.batch",
+    "density": "cl_export.density",
+    "expand": "cl_export.sparse",
+    "metrics": "cl_export.metrics",
+    "serve": "cl_export.serve",
+    "stats": "cl_export.stats",
+}
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        module = importlib.import_module(SUBCOMMANDS[sys.argv[1]])
+        module.main(sys.argv[2:])
+        return
+
     parser = _parser()
     args = parser.parse_args()
 
@@ -241,32 +1258,111 @@ def main():
         )
         exit(-1)
 
-    models = list(load_annotation(args.annotation_path))
+    if args.max_memory and args.labelmap_path and args.labelmap_path.suffix not in (NRRD_SUFFIX, SPARSE_SUFFIX):
+        print(
+            "--max-memory requires a '{}' or '{}' labelmap.".format(NRRD_SUFFIX, SPARSE_SUFFIX),
+            file=sys.stderr,
+        )
+        exit(-1)
+
+    if args.resolutions and not (args.labelmap_path and "{resolution}" in str(args.labelmap_path)):
+        print("--resolution requires a --labelmap path containing '{resolution}'.", file=sys.stderr)
+        exit(-1)
+
+    if args.resolutions and (args.max_memory or is_sparse(args.labelmap_path) or is_zarr(args.labelmap_path)):
+        print("--resolution requires a dense labelmap, without --max-memory; see --zarr-levels.", file=sys.stderr)
+        exit(-1)
+
+    if args.zarr_levels < 1 or (args.zarr_levels > 1 and not (args.labelmap_path and is_zarr(args.labelmap_path))):
+        print("--zarr-levels must be positive, and requires a '{}' labelmap.".format(ZARR_SUFFIX), file=sys.stderr)
+        exit(-1)
+
+    if args.incremental and (
+        args.resolutions or args.max_memory or not (args.labelmap_path and args.labelmap_path.suffix == NRRD_SUFFIX)
+    ):
+        print(
+            "--incremental requires a '{}' labelmap, without --resolution or --max-memory.".format(NRRD_SUFFIX),
+            file=sys.stderr,
+        )
+        exit(-1)
+
+    if args.model_path and not is_model_path(args.model_path):
+        print(
+            "--model must end with one of {}.".format(", ".join(MODEL_SUFFIXES)),
+            file=sys.stderr,
+        )
+        exit(-1)
+
+    if args.profile_path:
+        profiling.start()
+
+    with stage("cl-export", file=str(args.annotation_path)):
+        _export(args)
+
+    if args.profile_path:
+        events = profiling.stop()
+        profiling.write_trace(events, args.profile_path)
+        print(profiling.summarize(events), file=sys.stderr)
 
-    if args.pir:
-        models = [ras_to_pir(model) for model in models]
 
-    if args.model_path:
-        append = vtkAppendPolyData()
-        for model in models:
-            append.AddInputConnection(model.GetOutputPort())
+def _export(args: argparse.Namespace):
+    with stage("load_annotation"):
+        markups = load_markups(args.annotation_path)
 
-        writer = vtkPolyDataWriter()
-        writer.SetFileName(str(args.model_path))
-        writer.SetInputConnection(append.GetOutputPort())
-        writer.Update()
+    pps = args.points_per_segment
+    mesh_cache = MeshCache(args.mesh_cache_dir, args.mesh_cache_size) if args.mesh_cache_dir else None
+
+    if args.model_path and args.split_models:
+        export_split_models(
+            markups,
+            args.model_path,
+            args.pir,
+            args.jobs or os.cpu_count(),
+            args.ascii,
+            args.max_triangles,
+            pps,
+            mesh_cache,
+        )
+    elif args.model_path:
+        export_model(markups, args.model_path, args.pir, args.ascii, args.max_triangles, pps, mesh_cache)
 
     if args.labelmap_path:
-        image = vtkImageData_like(args.atlas_path)
-        image.AllocateScalars(VTK_UNSIGNED_CHAR, 1)
-        image.GetPointData().GetScalars().Fill(0)
+        with stage("read_atlas"):
+            geometry = load_atlas_geometry(args.atlas_path, args.atlas_cache)
+        jobs = args.jobs or os.cpu_count()
 
-        for i, model in enumerate(models, 1):
-            image = apply_stencil(model, image, i)
+        dtype = label_dtype(len(markups))
+        print("Writing {} labels as {}".format(len(markups), dtype), file=sys.stderr)
 
-        writer = sitk.ImageFileWriter()
-        writer.SetFileName(str(args.labelmap_path))
-        writer.Execute(vtk2sitk(image))
+        if args.resolutions:
+            export_labelmap_resolutions(
+                markups, geometry, args.labelmap_path, args.resolutions, args.pir, jobs, args.engine, pps, mesh_cache
+            )
+        elif is_zarr(args.labelmap_path):
+            export_zarr_labelmap(
+                markups, geometry, args.labelmap_path, args.pir, args.zarr_levels, jobs, args.engine, pps, mesh_cache
+            )
+        elif is_sparse(args.labelmap_path):
+            export_sparse_labelmap(
+                markups, geometry, args.labelmap_path, args.pir, jobs, args.engine, pps, mesh_cache
+            )
+        elif args.incremental:
+            from cl_export.incremental import export_labelmap_incremental
+
+            export_labelmap_incremental(
+                markups, geometry, args.labelmap_path, args.pir, jobs, args.engine, pps, mesh_cache
+            )
+        elif args.max_memory:
+            export_labelmap_slabs(
+                markups, geometry, args.labelmap_path, args.pir, args.max_memory, jobs, args.engine, pps, mesh_cache
+            )
+        else:
+            with stage("allocate"):
+                image = allocate_labelmap(geometry, dtype)
+            export_labelmap(markups, image, args.labelmap_path, args.pir, jobs, args.engine, pps, mesh_cache)
+
+    if args.lut_path:
+        write_color_table(markups, args.lut_path)
 
 
 if __name__ == "__main__":
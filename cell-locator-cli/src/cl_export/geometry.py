@@ -0,0 +1,113 @@
+import dataclasses
+import functools
+import math
+
+from dataclasses import dataclass
+from typing import List
+from typing import Tuple
+
+import numpy as np
+
+from vtkmodules.vtkCommonDataModel import vtkImageData
+from vtkmodules.vtkCommonMath import vtkMatrix3x3
+from vtkmodules.vtkCommonMath import vtkMatrix4x4
+from vtkmodules.vtkCommonTransforms import vtkTransform
+
+Block = Tuple[List[int], np.ndarray]
+"""Voxel extent of an annotation's bounding box, and the mask of voxels inside it in (z, y, x) order."""
+
+
+@dataclass(frozen=True)
+class AtlasGeometry:
+    """Origin, spacing, direction and size of an atlas image.
+
+    This is everything needed to allocate a labelmap matching the atlas. Unlike vtkImageData it can be pickled, so it
+    may be sent to worker processes.
+    """
+
+    origin: Tuple[float, float, float]
+    spacing: Tuple[float, float, float]
+    direction: Tuple[float, ...]
+    """Row-major 3x3 direction matrix."""
+    size: Tuple[int, int, int]
+
+    @classmethod
+    def from_file(cls, filename) -> 'AtlasGeometry':
+        import SimpleITK as sitk
+
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(str(filename))
+
+        reader.LoadPrivateTagsOn()
+        reader.ReadImageInformation()
+
+        return cls(
+            origin=tuple(reader.GetOrigin()),
+            spacing=tuple(reader.GetSpacing()),
+            direction=tuple(reader.GetDirection()),
+            size=tuple(reader.GetSize()),
+        )
+
+    @classmethod
+    def from_image(cls, image: vtkImageData) -> 'AtlasGeometry':
+        matrix = image.GetDirectionMatrix()
+        return cls(
+            origin=tuple(image.GetOrigin()),
+            spacing=tuple(image.GetSpacing()),
+            direction=tuple(matrix.GetElement(i, j) for i in range(3) for j in range(3)),
+            size=tuple(image.GetDimensions()),
+        )
+
+    def to_image(self) -> vtkImageData:
+        """Create a vtkImageData with this geometry. Scalars are not allocated."""
+
+        direction = vtkMatrix3x3()
+        direction.DeepCopy(self.direction)
+
+        image = vtkImageData()
+        image.SetDirectionMatrix(direction)
+        image.SetOrigin(*self.origin)
+        image.SetSpacing(*self.spacing)
+        image.SetDimensions(*self.size)
+
+        return image
+
+    def resampled(self, spacing: float) -> 'AtlasGeometry':
+        """This geometry at an isotropic ``spacing``: the same origin and direction, and every voxel whose center is
+        within the extent of this geometry's voxel centers.
+
+        This matches the CCF atlases, whose resolutions share an origin; ex. the 10 µm atlas resampled to 50 µm is
+        the geometry of the 50 µm atlas.
+        """
+
+        # the tolerance absorbs rounding in the ratio of spacings, ex. 1319 * 10 / 25.
+        size = tuple(math.floor((n - 1) * s / spacing + 1e-6) + 1 for n, s in zip(self.size, self.spacing))
+        return dataclasses.replace(self, spacing=(float(spacing),) * 3, size=size)
+
+    @functools.cached_property
+    def world_to_local(self) -> Tuple[float, ...]:
+        """Row-major 4x4 matrix from world coordinates to the "local" space of the image: unrotated, with the origin at
+        zero, but not yet scaled by the spacing.
+
+        vtkPolyDataToImageStencil and vtkImageStencil do not respect image Direction. They do respect Origin and
+        Spacing. However since the linear part of the transformation comes before the translation part, we must handle
+        Direction and Origin together. The scaling part comes last, so we can let vtkImageStencil handle Spacing.
+        """
+
+        # Compute the linear and translational parts of the transform; then use the _inverse_ of that to move models
+        # into the "local" space of the image.
+        tform = vtkTransform()
+        tform.Translate(self.origin)
+
+        matrix = vtkMatrix4x4()
+        matrix.DeepCopy(tform.GetMatrix())
+
+        for i in range(3):
+            for j in range(3):
+                matrix.SetElement(i, j, self.direction[3 * i + j])
+
+        tform.SetMatrix(matrix)
+        tform.Inverse()
+
+        inverse = tform.GetMatrix()
+        return tuple(inverse.GetElement(i, j) for i in range(4) for j in range(4))
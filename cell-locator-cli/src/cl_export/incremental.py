@@ -0,0 +1,271 @@
+"""
+Incremental labelmap export: re-export only the annotations that changed.
+
+Next to an NRRD labelmap, 'cl-export --incremental' writes a manifest,
+'<labelmap>.manifest.json', recording the export settings and, for each
+label, a hash of its annotation and the voxel extent it painted. Hashes are
+those of the mesh cache, so names and other properties that do not change
+the geometry do not count as changes; see cl_export.cache.geometry_key().
+
+On re-export, annotations are compared by label, so inserting or removing an
+annotation changes the label of every annotation after it. The extents of
+changed, added and removed labels, before and after the change, are the
+regions to repaint. Each region is cleared, and every label that paints in
+it, including unchanged labels that overlap it, is painted again in label
+order, so the overwrite order is kept. The rest of the labelmap is not read
+or written; the file is patched in place.
+
+The labelmap is exported in full instead if the manifest is missing or was
+written with other settings, atlas geometry or label type, or if the
+labelmap was modified since. The manifest is removed while the labelmap is
+patched, so an interrupted export is redone in full.
+"""
+
+import json
+import os
+import sys
+import tempfile
+
+from pathlib import Path
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import numpy as np
+
+from cl_export.cache import MeshCache
+from cl_export.cache import geometry_key
+from cl_export.export import allocate_labelmap
+from cl_export.export import label_dtype
+from cl_export.export import paint_block
+from cl_export.export import rasterize_markups
+from cl_export.export import write_labelmap
+from cl_export.geometry import AtlasGeometry
+from cl_export.geometry import Block
+from cl_export.nrrd import nrrd_header
+from cl_export.profiling import stage
+
+MANIFEST_SUFFIX = ".manifest.json"
+
+# Change it when the manifest format changes, to export existing labelmaps in full again.
+MANIFEST_VERSION = 1
+
+
+def manifest_path(labelmap_path: Path) -> Path:
+    """``labelmap_path`` with MANIFEST_SUFFIX appended; ex. 'labels.nrrd' -> 'labels.nrrd.manifest.json'."""
+
+    return labelmap_path.with_name(labelmap_path.name + MANIFEST_SUFFIX)
+
+
+def export_settings(
+    geometry: AtlasGeometry, dtype, pir: bool, engine: str, points_per_segment: Optional[int]
+) -> dict:
+    """Everything besides the annotations that determines the labelmap; a manifest only applies if they match."""
+
+    return {
+        "origin": list(geometry.origin),
+        "spacing": list(geometry.spacing),
+        "direction": list(geometry.direction),
+        "size": list(geometry.size),
+        "dtype": np.dtype(dtype).str,
+        "pir": bool(pir),
+        "engine": engine,
+        "points_per_segment": points_per_segment,
+    }
+
+
+def read_manifest(path: Path, settings: dict, labelmap_path: Path) -> Optional[List[dict]]:
+    """The annotations of the manifest at ``path``, or None if it does not apply to ``settings`` and the labelmap."""
+
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+        stat = os.stat(labelmap_path)
+    except (OSError, ValueError):
+        return None
+
+    if (
+        manifest.get("version") != MANIFEST_VERSION
+        or manifest.get("settings") != settings
+        or manifest.get("labelmap") != {"bytes": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    ):
+        return None
+
+    return manifest["annotations"]
+
+
+def write_manifest(path: Path, settings: dict, keys: List[str], extents: List[Optional[List[int]]], labelmap_path: Path):
+    stat = os.stat(labelmap_path)
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "settings": settings,
+        "labelmap": {"bytes": stat.st_size, "mtime_ns": stat.st_mtime_ns},
+        "annotations": [
+            {"key": key, "extent": [int(value) for value in extent] if extent is not None else None}
+            for key, extent in zip(keys, extents)
+        ],
+    }
+
+    fd, temp = tempfile.mkstemp(suffix=MANIFEST_SUFFIX, dir=path.parent, prefix=".")
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f)
+    os.replace(temp, path)
+
+
+def open_labelmap(labelmap_path: Path, geometry: AtlasGeometry, dtype) -> Optional[np.memmap]:
+    """The labels of the raw NRRD labelmap at ``labelmap_path``, in (z, y, x) order, mapped for patching in place; or
+    None if it does not have ``geometry`` and ``dtype`` exactly as written by cl-export.
+    """
+
+    header = nrrd_header(geometry, dtype)
+    shape = tuple(reversed(geometry.size))
+
+    try:
+        with open(labelmap_path, "rb") as f:
+            if f.read(len(header)) != header:
+                return None
+    except OSError:
+        return None
+
+    if os.path.getsize(labelmap_path) != len(header) + int(np.prod(shape)) * np.dtype(dtype).itemsize:
+        return None
+
+    return np.memmap(labelmap_path, dtype=dtype, mode="r+", offset=len(header), shape=shape)
+
+
+def extent_intersection(extent: List[int], other: List[int]) -> Optional[List[int]]:
+    """The voxels in both extents, or None if they do not overlap."""
+
+    intersection = []
+    for low, high, other_low, other_high in zip(extent[::2], extent[1::2], other[::2], other[1::2]):
+        low, high = max(low, other_low), min(high, other_high)
+        if low > high:
+            return None
+        intersection += [low, high]
+
+    return intersection
+
+
+def _region(extent: List[int]):
+    x0, x1, y0, y1, z0, z1 = extent
+    return slice(z0, z1 + 1), slice(y0, y1 + 1), slice(x0, x1 + 1)
+
+
+def paint_region(labels: np.ndarray, block: Optional[Block], val, region: List[int]):
+    """Write ``val`` into the voxels of ``labels``, in (z, y, x) order, selected by ``block`` within ``region``."""
+
+    if block is None:
+        return
+
+    extent, mask = block
+    overlap = extent_intersection(extent, region)
+    if overlap is None:
+        return
+
+    # the overlap relative to the block.
+    x0, _, y0, _, z0, _ = extent
+    local = [value - origin for value, origin in zip(overlap, (x0, x0, y0, y0, z0, z0))]
+    labels[_region(overlap)][mask[_region(local)]] = val
+
+
+def export_labelmap_incremental(
+    markups: List[dict],
+    geometry: AtlasGeometry,
+    labelmap_path: Path,
+    pir: bool,
+    jobs: int = 1,
+    engine: str = "vtk",
+    points_per_segment: Optional[int] = None,
+    mesh_cache: Optional[MeshCache] = None,
+):
+    """Export ``markups`` to the NRRD labelmap ``labelmap_path``, patching only the regions of annotations that changed
+    since the export recorded in its manifest; see the module documentation.
+    """
+
+    dtype = label_dtype(len(markups))
+    settings = export_settings(geometry, dtype, pir, engine, points_per_segment)
+    keys = [geometry_key(markup, pir, None, points_per_segment) for markup in markups]
+
+    path = manifest_path(labelmap_path)
+    with stage("read_manifest"):
+        previous = read_manifest(path, settings, labelmap_path)
+        labels = open_labelmap(labelmap_path, geometry, dtype) if previous is not None else None
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+    if labels is None:
+        print("Exporting all {} annotations".format(len(markups)), file=sys.stderr)
+
+        with stage("allocate"):
+            image = allocate_labelmap(geometry, dtype)
+
+        extents = []
+        blocks = rasterize_markups(
+            markups, geometry, pir, jobs, engine, points_per_segment=points_per_segment, mesh_cache=mesh_cache
+        )
+        for label, block in enumerate(blocks, 1):
+            with stage("paint"):
+                paint_block(image, block, label)
+            extents.append(block[0] if block is not None else None)
+
+        write_labelmap(image, labelmap_path)
+        write_manifest(path, settings, keys, extents, labelmap_path)
+        return
+
+    changed = [i for i, key in enumerate(keys) if i >= len(previous) or previous[i]["key"] != key]
+    regions = [
+        entry["extent"]
+        for i, entry in enumerate(previous)
+        if (i >= len(keys) or keys[i] != entry["key"]) and entry["extent"] is not None
+    ]
+
+    def rasterize(indices: List[int]) -> Dict[int, Optional[Block]]:
+        blocks = rasterize_markups(
+            [markups[i] for i in indices],
+            geometry,
+            pir,
+            jobs,
+            engine,
+            points_per_segment=points_per_segment,
+            mesh_cache=mesh_cache,
+        )
+        return dict(zip(indices, blocks))
+
+    blocks = rasterize(changed)
+    regions += [block[0] for block in blocks.values() if block is not None]
+
+    # unchanged labels are only repainted where they overlap a region, so that later labels still win.
+    overlapping = [
+        i
+        for i, entry in enumerate(previous[:len(keys)])
+        if i not in blocks
+        and entry["extent"] is not None
+        and any(extent_intersection(entry["extent"], region) for region in regions)
+    ]
+    print(
+        "Re-exporting {} changed and {} overlapping of {} annotations".format(
+            len(changed), len(overlapping), len(markups)
+        ),
+        file=sys.stderr,
+    )
+    blocks.update(rasterize(overlapping))
+
+    with stage("patch", regions=len(regions)):
+        for region in regions:
+            labels[_region(region)] = 0
+        for i in sorted(blocks):
+            for region in regions:
+                paint_region(labels, blocks[i], i + 1, region)
+        labels.flush()
+        del labels
+    # writes through a mapping do not always update the modification time.
+    os.utime(labelmap_path)
+
+    extents = [
+        (blocks[i][0] if blocks[i] is not None else None) if i in blocks else previous[i]["extent"]
+        for i in range(len(markups))
+    ]
+    write_manifest(path, settings, keys, extents, labelmap_path)
@@ -0,0 +1,96 @@
+"""
+Write annotation models in several mesh formats, optionally decimated.
+
+The format is chosen by the file suffix:
+
+- ``.vtk``: VTK legacy polydata; binary unless ``ascii`` is set.
+- ``.vtp``: VTK XML polydata, zlib compressed.
+- ``.stl``: STL; binary unless ``ascii`` is set.
+- ``.ply``: PLY; binary unless ``ascii`` is set.
+"""
+
+from pathlib import Path
+from typing import Optional
+
+from vtkmodules.vtkCommonExecutionModel import vtkPolyDataAlgorithm
+from vtkmodules.vtkFiltersCore import vtkQuadricDecimation
+from vtkmodules.vtkFiltersCore import vtkTriangleFilter
+
+MODEL_SUFFIXES = (".vtk", ".vtp", ".stl", ".ply")
+
+
+def is_model_path(path) -> bool:
+    return Path(path).suffix.lower() in MODEL_SUFFIXES
+
+
+def make_model_writer(path, ascii: bool = False):
+    suffix = Path(path).suffix.lower()
+
+    # each format is in its own VTK module; only import the one that is used.
+    if suffix == ".vtk":
+        from vtkmodules.vtkIOLegacy import vtkPolyDataWriter
+
+        writer = vtkPolyDataWriter()
+        if ascii:
+            writer.SetFileTypeToASCII()
+        else:
+            writer.SetFileTypeToBinary()
+    elif suffix == ".vtp":
+        from vtkmodules.vtkIOXML import vtkXMLPolyDataWriter
+
+        writer = vtkXMLPolyDataWriter()
+        writer.SetDataModeToAppended()
+        writer.EncodeAppendedDataOff()
+        writer.SetCompressorTypeToZLib()
+    elif suffix == ".stl":
+        from vtkmodules.vtkIOGeometry import vtkSTLWriter
+
+        writer = vtkSTLWriter()
+        if ascii:
+            writer.SetFileTypeToASCII()
+        else:
+            writer.SetFileTypeToBinary()
+    elif suffix == ".ply":
+        from vtkmodules.vtkIOPLY import vtkPLYWriter
+
+        writer = vtkPLYWriter()
+        if ascii:
+            writer.SetFileTypeToASCII()
+        else:
+            writer.SetFileTypeToBinary()
+    else:
+        raise ValueError(
+            "Unsupported model format {!r}; expected one of {}".format(suffix, ", ".join(MODEL_SUFFIXES))
+        )
+
+    writer.SetFileName(str(path))
+    return writer
+
+
+def decimate(model: vtkPolyDataAlgorithm, max_triangles: int) -> vtkPolyDataAlgorithm:
+    """Triangulate ``model`` and decimate it to about ``max_triangles`` triangles, if it has more."""
+
+    triangles = vtkTriangleFilter()
+    triangles.SetInputConnection(model.GetOutputPort())
+    triangles.Update()
+
+    count = triangles.GetOutput().GetNumberOfPolys()
+    if count <= max_triangles:
+        return triangles
+
+    decimation = vtkQuadricDecimation()
+    decimation.SetInputConnection(triangles.GetOutputPort())
+    decimation.SetTargetReduction(1 - max_triangles / count)
+    decimation.VolumePreservationOn()
+    return decimation
+
+
+def write_model(model: vtkPolyDataAlgorithm, path, ascii: bool = False, max_triangles: Optional[int] = None):
+    """Write ``model`` to ``path`` in the format given by its suffix, optionally decimated; see decimate()."""
+
+    if max_triangles:
+        model = decimate(model, max_triangles)
+
+    writer = make_model_writer(path, ascii)
+    writer.SetInputConnection(model.GetOutputPort())
+    writer.Update()
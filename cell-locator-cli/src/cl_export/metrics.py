@@ -0,0 +1,363 @@
+"""
+Measure the shape of each annotation: 'cl-export metrics'.
+
+A closed curve annotation is modelled as its tessellated curve, triangulated
+and extruded by ``thickness`` along the plane normal, centered on the plane;
+see export.make_curve(). Metrics are computed on the same tessellated curve,
+so they match the exported models:
+
+- ``file``, ``annotation``, ``name``: the annotation file, the label the
+  annotation has in labelmaps exported from that file, and its name.
+- ``volume``, ``surface_area``: of the extruded model, caps included.
+- ``planar_area``, ``perimeter``: of the curve, in its plane.
+- ``centroid_x``, ``centroid_y``, ``centroid_z``: the center of mass of the
+  extruded model, in RAS or, with --pir, PIR coordinates.
+
+Lengths are in the units of the annotation coordinates; µm for CCF
+annotations.
+
+The model is a prism, so by default the metrics are computed analytically
+from the curve polygon and the thickness vector, which is exact and does not
+build meshes. With the 'mesh' method, volume, surface area and centroid are
+instead integrated over the triangles of the model, as built for 'cl-export
+-m' and shared with it through the mesh cache; the planar metrics are always
+those of the curve. The two only differ for self-intersecting curves, where
+the polygon area counts overlapping loops with their winding number.
+"""
+
+import argparse
+import functools
+import os
+import sys
+
+from pathlib import Path
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+from vtkmodules.vtkFiltersCore import vtkPolyDataNormals
+from vtkmodules.vtkFiltersCore import vtkTriangleFilter
+from vtkmodules.util.numpy_support import vtk_to_numpy
+
+from cl_export import profiling
+from cl_export.batch import collect_annotations
+from cl_export.cache import MeshCache
+from cl_export.export import build_model
+from cl_export.export import load_markups
+from cl_export.export import markup_to_polygon
+from cl_export.export import memory_size
+from cl_export.export import positive_int
+from cl_export.profiling import stage
+from cl_export.stats import TABLE_SUFFIXES
+from cl_export.stats import import_pyarrow
+from cl_export.stats import write_table
+
+COLUMNS = (
+    "file",
+    "annotation",
+    "name",
+    "volume",
+    "surface_area",
+    "planar_area",
+    "perimeter",
+    "centroid_x",
+    "centroid_y",
+    "centroid_z",
+)
+
+METHODS = ("analytic", "mesh")
+
+
+def polygon_metrics(polygon: np.ndarray, normal: np.ndarray) -> Dict[str, float]:
+    """The metrics of the closed ``polygon`` extruded by ``normal`` and centered on its plane.
+
+    :param polygon: (N, 3) curve points, as from export.markup_to_polygon().
+    :param normal: The thickness-scaled plane normal.
+    """
+
+    # the sums below do not depend on the origin; center the points for precision.
+    center = polygon.mean(axis=0)
+    points = polygon - center
+    following = np.roll(points, -1, axis=0)
+
+    crosses = np.cross(points, following)
+    vector_area = 0.5 * crosses.sum(axis=0)
+
+    thickness = np.linalg.norm(normal)
+    if thickness > 0:
+        unit = normal / thickness
+    else:
+        unit = vector_area / (np.linalg.norm(vector_area) or 1)
+
+    # the area of the polygon projected on its plane, by the shoelace formula.
+    fan_areas = 0.5 * crosses @ unit
+    planar_area = abs(fan_areas.sum())
+
+    edges = following - points
+    perimeter = np.linalg.norm(edges, axis=1).sum()
+
+    # the sides are parallelograms spanned by each edge and the normal; for an oblique normal, the volume is the base
+    # area times the height along the plane normal.
+    volume = abs(vector_area @ normal)
+    surface_area = 2 * planar_area + np.linalg.norm(np.cross(edges, normal), axis=1).sum()
+
+    # the prism is centered on the plane, so its centroid is that of the polygon.
+    centroid = center
+    if fan_areas.sum() != 0:
+        centroid = center + (fan_areas @ (points + following)) / (3 * fan_areas.sum())
+
+    return _metrics(volume, surface_area, planar_area, perimeter, centroid)
+
+
+def mesh_metrics(polydata: vtkPolyData) -> Dict[str, float]:
+    """The volume, surface area and centroid of the closed mesh ``polydata``, by the divergence theorem.
+
+    The centroid is left out if the mesh encloses no volume.
+    """
+
+    triangles = vtkTriangleFilter()
+    triangles.SetInputData(polydata)
+    triangles.PassVertsOff()
+    triangles.PassLinesOff()
+
+    # the caps of extruded models are not oriented consistently with the sides; the signed volumes need them to be.
+    oriented = vtkPolyDataNormals()
+    oriented.SetInputConnection(triangles.GetOutputPort())
+    oriented.ConsistencyOn()
+    oriented.AutoOrientNormalsOn()
+    oriented.SplittingOff()
+    oriented.Update()
+
+    output = oriented.GetOutput()
+    if not output.GetNumberOfPolys():
+        return dict(volume=0.0, surface_area=0.0)
+
+    points = vtk_to_numpy(output.GetPoints().GetData()).astype(float)
+    center = points.mean(axis=0)
+    points -= center
+    cells = vtk_to_numpy(output.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    a, b, c = points[cells[:, 0]], points[cells[:, 1]], points[cells[:, 2]]
+
+    surface_area = 0.5 * np.linalg.norm(np.cross(b - a, c - a), axis=1).sum()
+
+    # signed volumes of the tetrahedra from the center to each triangle; the sign follows the triangle orientation.
+    volumes = np.einsum("ij,ij->i", a, np.cross(b, c)) / 6
+    volume = volumes.sum()
+
+    metrics = dict(volume=float(abs(volume)), surface_area=float(surface_area))
+    if volume != 0:
+        centroid = center + (volumes @ (a + b + c)) / (4 * volume)
+        metrics.update(centroid_x=float(centroid[0]), centroid_y=float(centroid[1]), centroid_z=float(centroid[2]))
+
+    return metrics
+
+
+def _metrics(volume, surface_area, planar_area, perimeter, centroid) -> Dict[str, float]:
+    return dict(
+        volume=float(volume),
+        surface_area=float(surface_area),
+        planar_area=float(planar_area),
+        perimeter=float(perimeter),
+        centroid_x=float(centroid[0]),
+        centroid_y=float(centroid[1]),
+        centroid_z=float(centroid[2]),
+    )
+
+
+def markup_metrics(
+    markup: dict,
+    pir: bool = False,
+    method: str = "analytic",
+    points_per_segment: Optional[int] = None,
+    mesh_cache: Optional[MeshCache] = None,
+) -> Dict[str, float]:
+    """The metrics of a markup's model, in PIR space if ``pir`` is set; see the module documentation.
+
+    Curves are tessellated as for models; see export.build_model().
+    """
+
+    with stage("metrics", annotation=markup.get("name")):
+        polygon, normal = markup_to_polygon(markup, pir, points_per_segment=points_per_segment)
+        metrics = polygon_metrics(polygon, normal)
+
+        if method == "mesh":
+            model = build_model(markup, pir, points_per_segment=points_per_segment, mesh_cache=mesh_cache)
+            with stage("mesh_metrics"):
+                metrics.update(mesh_metrics(model.GetOutputDataObject(0)))
+        elif method != "analytic":
+            raise ValueError("Unrecognized method {!r}".format(method))
+
+    return metrics
+
+
+def metrics_rows(
+    annotations: List[Path],
+    pir: bool,
+    method: str = "analytic",
+    jobs: int = 1,
+    points_per_segment: Optional[int] = None,
+    mesh_cache: Optional[MeshCache] = None,
+) -> Tuple[List[Dict], List[Tuple[Path, str]]]:
+    """The rows of the metrics table for the annotation files, one per annotation; and the files that could not be
+    read, with their errors. With ``jobs > 1``, annotations are measured in a pool of worker processes.
+    """
+
+    failures = []
+    markups = []
+    owners = []
+    for path in annotations:
+        try:
+            file_markups = load_markups(path)
+        except Exception as e:
+            failures.append((path, "{}: {}".format(type(e).__name__, e)))
+            continue
+
+        markups.extend(file_markups)
+        owners.extend((path, label) for label in range(1, len(file_markups) + 1))
+
+    measure = functools.partial(
+        markup_metrics, pir=pir, method=method, points_per_segment=points_per_segment, mesh_cache=mesh_cache
+    )
+
+    if jobs <= 1 or len(markups) <= 1:
+        return _rows(markups, owners, map(measure, markups)), failures
+
+    with profiling.pool(min(jobs, len(markups))) as pool:
+        return _rows(markups, owners, profiling.imap(pool, measure, markups)), failures
+
+
+def _rows(markups: List[dict], owners: List[Tuple[Path, int]], metrics) -> List[Dict]:
+    return [
+        dict(file=str(path), annotation=label, name=markup.get("name") or "", **values)
+        for markup, (path, label), values in zip(markups, owners, metrics)
+    ]
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog="cl-export metrics",
+        description=(
+            "Measure the volume, surface area, planar area, perimeter and centroid of each annotation across many "
+            "Cell Locator annotation files. Writes one row per annotation."
+        ),
+    )
+    parser.add_argument(
+        metavar="annotation",
+        dest="annotations",
+        nargs="*",
+        help="Input Cell Locator annotation files (JSON), of any version, or glob patterns; ex. 'specimens/**/*.json'.",
+    )
+    parser.add_argument(
+        "--manifest",
+        dest="manifest_path",
+        type=Path,
+        help="Text file listing input annotation files, one per line. Relative paths are relative to the manifest.",
+        default=None,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output_path",
+        type=Path,
+        help="Output table; '.csv' or '.parquet'. Parquet output requires pyarrow.",
+        required=True,
+    )
+    parser.add_argument(
+        "--method",
+        dest="method",
+        choices=METHODS,
+        help=(
+            "'analytic' to compute the metrics exactly from the curve polygon and thickness, without building meshes; "
+            "or 'mesh' to integrate volume, surface area and centroid over the triangles of the exported model. "
+            "Defaults to 'analytic'."
+        ),
+        default="analytic",
+    )
+    parser.add_argument(
+        "--pir",
+        action="store_true",
+        dest="pir",
+        help=(
+            "If set, read the annotations in PIR format rather than RAS. This should only be necessary for old-style "
+            "CCF annotations. "
+        ),
+        default=False,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        help="Number of worker processes used to measure annotations. Use 0 to use all available cores.",
+        default=1,
+    )
+    parser.add_argument(
+        "--points-per-segment",
+        dest="points_per_segment",
+        type=positive_int,
+        help="Number of points to tessellate each curve segment with. See 'cl-export -h'.",
+        default=None,
+    )
+    parser.add_argument(
+        "--mesh-cache",
+        dest="mesh_cache_dir",
+        type=Path,
+        help=(
+            "Directory of cached annotation meshes, as for 'cl-export', used by the 'mesh' method. Meshes are keyed "
+            "by the annotation geometry and tessellation settings, so unchanged annotations are not rebuilt. The "
+            "directory may be shared."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--mesh-cache-size",
+        dest="mesh_cache_size",
+        type=memory_size,
+        help="Size cap of the mesh cache; ex. '512M' or '2G'. Least recently used meshes are evicted first.",
+        default="1G",
+    )
+
+    return parser
+
+
+def main(argv=None):
+    parser = _parser()
+    args = parser.parse_args(argv)
+
+    if args.output_path.suffix not in TABLE_SUFFIXES:
+        print("--output must end with one of {}.".format(", ".join(TABLE_SUFFIXES)), file=sys.stderr)
+        exit(-1)
+
+    if args.output_path.suffix == ".parquet":
+        import_pyarrow()
+
+    annotations = collect_annotations(args.annotations, args.manifest_path)
+    if not annotations:
+        print("No annotation files given.", file=sys.stderr)
+        exit(-1)
+
+    rows, failures = metrics_rows(
+        annotations,
+        args.pir,
+        args.method,
+        args.jobs or os.cpu_count(),
+        args.points_per_segment,
+        MeshCache(args.mesh_cache_dir, args.mesh_cache_size) if args.mesh_cache_dir else None,
+    )
+
+    write_table(rows, args.output_path, COLUMNS)
+
+    for path, error in failures:
+        print("{}: {}".format(path, error), file=sys.stderr)
+
+    if failures:
+        print("{} of {} files failed.".format(len(failures), len(annotations)), file=sys.stderr)
+        exit(-1)
+
+
+if __name__ == "__main__":
+    main()
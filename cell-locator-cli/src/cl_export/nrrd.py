@@ -0,0 +1,60 @@
+"""
+Write uncompressed NRRD headers, so that labelmaps can be streamed to disk.
+
+The header matches the one SimpleITK writes for an uncompressed image, so a
+file written as this header followed by the raw voxels is identical to one
+written by sitk.WriteImage().
+"""
+
+import numpy as np
+
+from cl_export.geometry import AtlasGeometry
+
+NRRD_SUFFIX = ".nrrd"
+
+NRRD_TYPES = {
+    np.dtype(np.int8): "signed char",
+    np.dtype(np.uint8): "unsigned char",
+    np.dtype(np.int16): "short",
+    np.dtype(np.uint16): "unsigned short",
+    np.dtype(np.int32): "int",
+    np.dtype(np.uint32): "unsigned int",
+    np.dtype(np.int64): "long long int",
+    np.dtype(np.uint64): "unsigned long long int",
+    np.dtype(np.float32): "float",
+    np.dtype(np.float64): "double",
+}
+
+
+def _vector(values) -> str:
+    # ITK prints doubles with 17 significant digits.
+    return "({})".format(",".join("{:.17g}".format(value) for value in values))
+
+
+def nrrd_header(geometry: AtlasGeometry, dtype) -> bytes:
+    """Header of a raw, little-endian, single-component 3D NRRD file with ``geometry``."""
+
+    dtype = np.dtype(dtype)
+    direction = np.asarray(geometry.direction, dtype=float).reshape(3, 3)
+
+    lines = [
+        "NRRD0004",
+        "# Complete NRRD file format specification at:",
+        "# http://teem.sourceforge.net/nrrd/format.html",
+        "type: {}".format(NRRD_TYPES[dtype]),
+        "dimension: 3",
+        "space: left-posterior-superior",
+        "sizes: {}".format(" ".join(str(size) for size in geometry.size)),
+        "space directions: {}".format(
+            " ".join(_vector(direction[:, axis] * geometry.spacing[axis]) for axis in range(3))
+        ),
+        "kinds: domain domain domain",
+    ]
+    if dtype.itemsize > 1:
+        lines.append("endian: little")
+    lines += [
+        "encoding: raw",
+        "space origin: {}".format(_vector(geometry.origin)),
+    ]
+
+    return ("\n".join(lines) + "\n\n").encode("ascii")
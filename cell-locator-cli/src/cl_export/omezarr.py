@@ -0,0 +1,294 @@
+"""
+Write labelmaps as OME-Zarr: chunked, compressed, multiscale label arrays.
+
+The output is a Zarr (v2) group following OME-NGFF 0.4, with one array per
+level: '0' at the atlas resolution and, optionally, '1', '2', ... each half the
+resolution of the one before, downsampled by block mode as in
+cl_export.downsample. Arrays are (z, y, x), in chunks of CHUNK_SIZE voxels a
+side compressed with gzip, which every Zarr reader supports; they are written
+directly, like cl_export.nrrd, so no Zarr package is needed.
+
+Chunks are painted from the annotation blocks that intersect them, and only
+chunks that hold a label are written; readers treat missing chunks as
+background. No dense image is allocated, so the cost scales with the number
+of occupied chunks rather than the atlas size. Chunks are painted, compressed
+and written concurrently by a thread pool.
+
+OME-NGFF 0.4 only describes scale and translation, so the atlas direction
+matrix is kept in the 'cell-locator' attribute of the group, with the origin,
+spacing and size in the conventions of
+:py:class:`cl_export.geometry.AtlasGeometry`.
+"""
+
+import concurrent.futures
+import gzip
+import itertools
+import json
+import shutil
+
+from pathlib import Path
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+from cl_export.downsample import block_modes
+from cl_export.geometry import AtlasGeometry
+from cl_export.geometry import Block
+
+ZARR_SUFFIX = ".zarr"
+
+# Voxels per chunk along each axis.
+CHUNK_SIZE = 128
+
+# numcodecs GZip; fast, since label chunks compress well at any level.
+COMPRESSOR = {"id": "gzip", "level": 1}
+
+# (z, y, x) index of a chunk.
+ChunkKey = Tuple[int, int, int]
+
+# [first, last) voxels along (z, y, x).
+Box = Tuple[Tuple[int, int], Tuple[int, int], Tuple[int, int]]
+
+
+def is_zarr(path) -> bool:
+    return Path(path).suffix == ZARR_SUFFIX
+
+
+def block_chunks(labelled_blocks: Iterable[Tuple[int, Optional[Block]]]) -> Dict[ChunkKey, List[Tuple[int, Block]]]:
+    """The labelled blocks that intersect each chunk, in the order given."""
+
+    chunks = {}
+    for label, block in labelled_blocks:
+        if block is None:
+            continue
+
+        x0, x1, y0, y1, z0, z1 = block[0]
+        for key in itertools.product(
+            range(z0 // CHUNK_SIZE, z1 // CHUNK_SIZE + 1),
+            range(y0 // CHUNK_SIZE, y1 // CHUNK_SIZE + 1),
+            range(x0 // CHUNK_SIZE, x1 // CHUNK_SIZE + 1),
+        ):
+            chunks.setdefault(key, []).append((label, block))
+
+    return chunks
+
+
+def paint_chunk(key: ChunkKey, labelled_blocks: List[Tuple[int, Block]], dtype) -> np.ndarray:
+    """The labels of chunk ``key``, painted from ``labelled_blocks`` in order; later blocks win."""
+
+    chunk = np.zeros((CHUNK_SIZE,) * 3, dtype=dtype)
+    starts = [index * CHUNK_SIZE for index in key]
+
+    for label, (extent, mask) in labelled_blocks:
+        x0, x1, y0, y1, z0, z1 = extent
+        source = []
+        target = []
+        for low, high, start in zip((z0, y0, x0), (z1, y1, x1), starts):
+            first, last = max(low, start), min(high, start + CHUNK_SIZE - 1)
+            source.append(slice(first - low, last - low + 1))
+            target.append(slice(first - start, last - start + 1))
+
+        chunk[tuple(target)][mask[tuple(source)]] = label
+
+    return chunk
+
+
+def occupied_box(chunk: np.ndarray) -> Optional[Box]:
+    """The bounding box of the labels in ``chunk``, or None if it has none."""
+
+    box = []
+    for axis in range(3):
+        occupied = np.flatnonzero(chunk.any(axis=tuple(other for other in range(3) if other != axis)))
+        if not len(occupied):
+            return None
+        box.append((occupied[0], occupied[-1] + 1))
+
+    return tuple(box)
+
+
+def _assemble(chunks: Dict[ChunkKey, Tuple[np.ndarray, Box]], box: Box, dtype) -> np.ndarray:
+    """The region of voxels ``box`` of the level of ``chunks``; zero where there is no chunk."""
+
+    region = np.zeros([high - low for low, high in box], dtype=dtype)
+    for key in itertools.product(*(range(low // CHUNK_SIZE, (high - 1) // CHUNK_SIZE + 1) for low, high in box)):
+        if key not in chunks:
+            continue
+
+        chunk, occupied = chunks[key]
+        source = []
+        target = []
+        for index, (low, high), (first, last) in zip(key, box, occupied):
+            start = index * CHUNK_SIZE
+            first, last = max(start + first, low), min(start + last, high)
+            if first >= last:
+                break
+            source.append(slice(first - start, last - start))
+            target.append(slice(first - low, last - low))
+        else:
+            region[tuple(target)] = chunk[tuple(source)]
+
+    return region
+
+
+def downsample_chunk(chunks: Dict[ChunkKey, Tuple[np.ndarray, Box]], key: ChunkKey, dtype) -> np.ndarray:
+    """Chunk ``key`` of the next level from the chunks of a level, by block mode with a factor of 2.
+
+    Only the blocks that overlap the occupied boxes of ``chunks`` are computed.
+    """
+
+    # coarse voxel i is the mode of fine voxels 2i - 1 and 2i along each axis; see cl_export.downsample.
+    starts = [2 * CHUNK_SIZE * index - 1 for index in key]
+
+    low = [2 * CHUNK_SIZE] * 3
+    high = [0] * 3
+    for fine in itertools.product(*(range(start // CHUNK_SIZE, start // CHUNK_SIZE + 3) for start in starts)):
+        if fine not in chunks:
+            continue
+        for axis, (index, start, (first, last)) in enumerate(zip(fine, starts, chunks[fine][1])):
+            low[axis] = min(low[axis], max(index * CHUNK_SIZE + first - start, 0))
+            high[axis] = max(high[axis], min(index * CHUNK_SIZE + last - start, 2 * CHUNK_SIZE))
+
+    coarse = np.zeros((CHUNK_SIZE,) * 3, dtype=dtype)
+    if any(first >= last for first, last in zip(low, high)):
+        return coarse
+
+    # whole blocks of the region; the region starts on a block.
+    box = [(first // 2, (last + 1) // 2) for first, last in zip(low, high)]
+    region = _assemble(chunks, [(start + 2 * first, start + 2 * last) for start, (first, last) in zip(starts, box)], dtype)
+    coarse[tuple(slice(first, last) for first, last in box)] = block_modes(region, (2, 2, 2))
+    return coarse
+
+
+def _coarse_keys(keys: Iterable[ChunkKey], shape: Tuple[int, int, int]) -> List[ChunkKey]:
+    """The chunks of the next level, of a (z, y, x) ``shape``, whose blocks overlap the chunks ``keys``."""
+
+    coarse = set()
+    for key in keys:
+        # the last voxel of an odd chunk is in the first block of the next coarse chunk.
+        coarse.update(itertools.product(*({index // 2, (index + 1) // 2} for index in key)))
+
+    return sorted(key for key in coarse if all(index * CHUNK_SIZE < size for index, size in zip(key, shape)))
+
+
+def _zarray(shape: Tuple[int, int, int], dtype) -> dict:
+    return {
+        "zarr_format": 2,
+        "shape": list(shape),
+        "chunks": [CHUNK_SIZE] * 3,
+        "dtype": np.dtype(dtype).str,
+        "compressor": COMPRESSOR,
+        "fill_value": 0,
+        "order": "C",
+        "filters": None,
+        "dimension_separator": "/",
+    }
+
+
+def _zattrs(geometry: AtlasGeometry, name: str, levels: int, colors: Optional[Dict[int, Tuple[int, int, int]]]) -> dict:
+    datasets = []
+    for level in range(levels):
+        scale = [spacing * 2 ** level for spacing in reversed(geometry.spacing)]
+        datasets.append(
+            {
+                "path": str(level),
+                "coordinateTransformations": [
+                    {"type": "scale", "scale": scale},
+                    {"type": "translation", "translation": list(reversed(geometry.origin))},
+                ],
+            }
+        )
+
+    attrs = {
+        "multiscales": [
+            {
+                "version": "0.4",
+                "name": name,
+                "axes": [{"name": axis, "type": "space"} for axis in "zyx"],
+                "datasets": datasets,
+                "type": "mode",
+            }
+        ],
+        "image-label": {"version": "0.4"},
+        "cell-locator": {
+            "origin": list(geometry.origin),
+            "spacing": list(geometry.spacing),
+            "direction": list(geometry.direction),
+            "size": list(geometry.size),
+        },
+    }
+    if colors:
+        attrs["image-label"]["colors"] = [
+            {"label-value": label, "rgba": [*color, 255]} for label, color in sorted(colors.items())
+        ]
+
+    return attrs
+
+
+def _write_json(path: Path, data: dict):
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+def _write_chunk(array_path: Path, key: ChunkKey, chunk: np.ndarray):
+    path = array_path.joinpath(*(str(index) for index in key))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(gzip.compress(chunk.tobytes(), compresslevel=COMPRESSOR["level"], mtime=0))
+
+
+def write_ome_zarr(
+    labelled_blocks: Iterable[Tuple[int, Optional[Block]]],
+    geometry: AtlasGeometry,
+    path: Path,
+    dtype,
+    levels: int = 1,
+    threads: int = 1,
+    colors: Optional[Dict[int, Tuple[int, int, int]]] = None,
+):
+    """Write the labelled blocks as an OME-Zarr labelmap with ``geometry`` and ``levels`` resolutions.
+
+    Blocks are painted in the order given, so later blocks win where they overlap. An existing Zarr group at ``path``
+    is replaced. ``colors`` optionally gives the RGB color of each label, for viewers.
+    """
+
+    path = Path(path)
+    if path.exists():
+        if not (path / ".zgroup").exists():
+            raise FileExistsError("{} exists and is not a Zarr group".format(path))
+        shutil.rmtree(path)
+    path.mkdir(parents=True)
+
+    _write_json(path / ".zgroup", {"zarr_format": 2})
+    _write_json(path / ".zattrs", _zattrs(geometry, path.name[:-len(ZARR_SUFFIX)], levels, colors))
+
+    shape = tuple(reversed(geometry.size))
+    chunk_blocks = block_chunks(labelled_blocks)
+
+    def write(level: int, key: ChunkKey, chunk: np.ndarray) -> Optional[Tuple[np.ndarray, Box]]:
+        box = occupied_box(chunk)
+        if box is None:
+            return None
+        _write_chunk(path / str(level), key, chunk)
+        return chunk, box
+
+    with concurrent.futures.ThreadPoolExecutor(max(1, threads)) as executor:
+        keys = sorted(chunk_blocks)
+        for level in range(levels):
+            (path / str(level)).mkdir()
+            _write_json(path / str(level) / ".zarray", _zarray(shape, dtype))
+
+            if level == 0:
+                chunks = executor.map(lambda key: write(0, key, paint_chunk(key, chunk_blocks[key], dtype)), keys)
+            else:
+                chunks = executor.map(lambda key: write(level, key, downsample_chunk(fine_chunks, key, dtype)), keys)
+
+            # keep the chunks of this level only to downsample the next.
+            fine_chunks = {key: chunk for key, chunk in zip(keys, chunks) if chunk is not None}
+            if level == levels - 1:
+                break
+
+            shape = tuple((size - 1) // 2 + 1 for size in shape)
+            keys = _coarse_keys(fine_chunks, shape)
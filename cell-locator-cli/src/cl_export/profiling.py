@@ -0,0 +1,196 @@
+"""
+Time the stages of an export and track memory, for 'cl-export --profile'.
+
+Stages are recorded with stage(), which does nothing unless tracing was
+started with start(). Each stage records its wall time and the resident
+memory high-water mark of its process when it ends. Stages nest, so an
+annotation's 'rasterize' stage contains its 'make_curve' and 'apply_stencil'
+stages.
+
+Worker processes record their own stages. Pools created with pool() and
+mapped with imap() send them back to the parent along with each result, so
+the trace covers all processes.
+
+The trace is written in the Chrome trace event format, which chrome://tracing,
+Perfetto (https://ui.perfetto.dev) and speedscope can open.
+"""
+
+import contextlib
+import functools
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Events recorded in this process since start(); None when not tracing.
+_events: Optional[List[dict]] = None
+
+# Arguments added to every stage; see context().
+_context = {}
+
+
+def start():
+    global _events
+    _events = []
+
+
+def stop() -> List[dict]:
+    """Stop tracing; returns the events recorded."""
+
+    global _events
+    events, _events = _events or [], None
+    return events
+
+
+def tracing() -> bool:
+    return _events is not None
+
+
+def max_rss() -> Optional[float]:
+    """Resident memory high-water mark of this process, in MiB; None where it is not available."""
+
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS.
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+
+@contextlib.contextmanager
+def context(**args):
+    """Add ``args`` to every stage recorded in the body; ex. the annotation file that is being exported."""
+
+    global _context
+    outer = _context
+    _context = dict(outer, **args)
+    try:
+        yield
+    finally:
+        _context = outer
+
+
+@contextlib.contextmanager
+def stage(name: str, **args):
+    """Record the time spent in the body as stage ``name``; ``args`` are shown with it in trace viewers."""
+
+    if _events is None:
+        yield
+        return
+
+    start_ns = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        end_ns = time.perf_counter_ns()
+        _events.append(
+            {
+                "name": name,
+                "cat": "cl-export",
+                "ph": "X",
+                "ts": start_ns / 1000,
+                "dur": (end_ns - start_ns) / 1000,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": dict(_context, **args, max_rss_mb=max_rss()),
+            }
+        )
+
+
+def _init_pool_worker(trace: bool, initializer: Optional[Callable], initargs: tuple):
+    global _events
+    # forked workers inherit the parent's events; start afresh either way.
+    _events = [] if trace else None
+    if initializer:
+        initializer(*initargs)
+
+
+def pool(processes: int, initializer: Optional[Callable] = None, initargs: tuple = ()) -> multiprocessing.Pool:
+    """A multiprocessing.Pool whose workers trace if this process does; use it with imap()."""
+
+    return multiprocessing.Pool(processes, initializer=_init_pool_worker, initargs=(tracing(), initializer, initargs))
+
+
+def _traced_call(func: Callable, item):
+    global _events
+    result = func(item)
+    events, _events = _events, []
+    return result, events
+
+
+def imap(workers: multiprocessing.Pool, func: Callable, items: Iterable, ordered: bool = True) -> Iterator:
+    """pool.imap(), or pool.imap_unordered(), that also collects the stages the workers record."""
+
+    map_items = workers.imap if ordered else workers.imap_unordered
+
+    if _events is None:
+        yield from map_items(func, items)
+        return
+
+    for result, events in map_items(functools.partial(_traced_call, func), items):
+        if _events is not None:
+            _events.extend(events)
+        yield result
+
+
+def write_trace(events: List[dict], path: Path):
+    """Write ``events`` as a Chrome trace JSON file, naming the main process and its workers."""
+
+    pids = sorted({event["pid"] for event in events})
+    metadata = [
+        {
+            "name": "process_name",
+            "ph": "M",
+            "pid": pid,
+            "args": {"name": "cl-export" if pid == os.getpid() else "worker {}".format(pid)},
+        }
+        for pid in pids
+    ]
+
+    with open(path, "w") as f:
+        json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f)
+
+
+def summarize(events: List[dict], slowest: int = 10) -> str:
+    """A table of the time and memory of each stage, and the annotations that took longest."""
+
+    durations = defaultdict(list)
+    rss = defaultdict(float)
+    annotations = defaultdict(float)
+    for event in events:
+        durations[event["name"]].append(event["dur"] / 1000)
+        rss[event["name"]] = max(rss[event["name"]], event["args"].get("max_rss_mb") or 0)
+        if "annotation" in event["args"]:
+            file = event["args"].get("file")
+            annotation = event["args"]["annotation"]
+            annotations["{}: {}".format(file, annotation) if file else annotation] += event["dur"] / 1000
+
+    lines = ["{:<20} {:>7} {:>11} {:>9} {:>9} {:>9}".format("stage", "count", "total (ms)", "mean", "max", "rss (MiB)")]
+    for name, times in sorted(durations.items(), key=lambda item: -sum(item[1])):
+        lines.append(
+            "{:<20} {:>7} {:>11.1f} {:>9.2f} {:>9.2f} {:>9.0f}".format(
+                name, len(times), sum(times), sum(times) / len(times), max(times), rss[name]
+            )
+        )
+
+    if annotations:
+        lines += ["", "slowest annotations (ms)"]
+        for annotation, total in sorted(annotations.items(), key=lambda item: -item[1])[:slowest]:
+            lines.append("{:>11.1f}  {}".format(total, annotation))
+
+    return "\n".join(lines)
@@ -0,0 +1,677 @@
+"""
+A long-running local export service: 'cl-export serve'.
+
+Every cl-export process pays for interpreter startup, the VTK and SimpleITK
+imports and reading the atlas before it does any work. The service pays
+them once, and then runs export, stats and convert jobs posted as JSON over
+HTTP, on localhost or on a Unix socket:
+
+- ``POST /export``: ``{"annotation": path, "atlas": path, "labelmap": path,
+  "model": path, "lut": path, "pir": bool, "engine": "vtk" | "numpy",
+  "points_per_segment": int}``. As 'cl-export', by output suffix; the
+  labelmap requires the atlas, and every output is optional.
+- ``POST /stats``: ``{"annotations": [path, ...], "atlas": path, "mapping":
+  path, "output": path, "pir": bool, "engine": ..., "points_per_segment":
+  int}``. As 'cl-export stats'; the rows are returned unless an output table
+  is given.
+- ``POST /convert``: ``{"document": object | "src": path, "version": "?",
+  "target": "", "dst": path}``. As 'cl-convert convert'; the converted
+  document is returned unless ``dst`` is given.
+- ``GET /metrics``: the queue depth, job counts and latencies by kind, and
+  the bytes of atlas labels and labelmap buffers kept between jobs.
+
+Relative paths are resolved against the working directory of the service.
+Responses are JSON objects; failed jobs have an ``error``. Requests wait for
+their job to finish, so the response says whether the outputs were written.
+
+Jobs are queued and run by a fixed number of worker threads, one job per
+thread, each rasterizing in that thread. Once the queue is full, requests
+are rejected with 503 rather than queued without bound. Atlas geometry, atlas
+labels for stats, and labelmap buffers are kept between jobs, up to a size
+cap each, least recently used first out; atlases are read again if their
+size or modification time changes.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import http.server
+import json
+import os
+import queue
+import signal
+import socketserver
+import statistics
+import sys
+import threading
+import time
+
+from pathlib import Path
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+import SimpleITK as sitk
+
+from cl_convert import converters
+from cl_export.cache import MeshCache
+from cl_export.cache import load_atlas_geometry
+from cl_export.export import ENGINES
+from cl_export.export import allocate_labelmap
+from cl_export.export import export_labelmap
+from cl_export.export import export_model
+from cl_export.export import export_sparse_labelmap
+from cl_export.export import export_zarr_labelmap
+from cl_export.export import label_dtype
+from cl_export.export import load_markups
+from cl_export.export import memory_size
+from cl_export.export import write_color_table
+from cl_export.geometry import AtlasGeometry
+from cl_export.meshes import is_model_path
+from cl_export.omezarr import is_zarr
+from cl_export.sparse import is_sparse
+from cl_export.stats import load_mapping
+from cl_export.stats import read_atlas_labels
+from cl_export.stats import stats_rows
+from cl_export.stats import write_table
+
+# Latencies kept per job kind for /metrics.
+LATENCY_WINDOW = 1000
+
+# Most atlases kept, whatever their size; geometries alone take next to no memory.
+MAX_RESIDENT_ATLASES = 64
+
+
+class RequestError(ValueError):
+    """A request that cannot be run; reported with status 400."""
+
+
+class ResidentAtlases:
+    """Atlas geometries and labels kept in memory, and read again when the atlas file changes.
+
+    At most ``max_bytes`` of labels and MAX_RESIDENT_ATLASES entries are kept; the least recently used are dropped
+    first. Labels larger than ``max_bytes`` are read for each job.
+    """
+
+    def __init__(self, geometry_cache: bool = True, max_bytes: int = 2 << 30):
+        self.geometry_cache = geometry_cache
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, kind: str, path, load: Callable, size: Callable = lambda value: 0):
+        key = (kind, str(Path(path).resolve()))
+        stat = os.stat(key[1])
+        version = (stat.st_size, stat.st_mtime_ns)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == version:
+                self._entries.move_to_end(key)
+                return entry[1]
+
+        value = load(key[1])
+        nbytes = size(value)
+        with self._lock:
+            self._drop(key)
+            if nbytes <= self.max_bytes:
+                self._entries[key] = (version, value, nbytes)
+                self.nbytes += nbytes
+            while self.nbytes > self.max_bytes or len(self._entries) > MAX_RESIDENT_ATLASES:
+                self._drop(next(iter(self._entries)))
+        return value
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.nbytes -= entry[2]
+
+    def geometry(self, path) -> AtlasGeometry:
+        return self._get("geometry", path, lambda path: load_atlas_geometry(path, self.geometry_cache))
+
+    def labels(self, path) -> Tuple[sitk.Image, np.ndarray]:
+        """The atlas image and a (z, y, x) view of its labels, as read by cl_export.stats.read_atlas_labels().
+
+        The view does not keep the image alive, and the entry may be dropped at any time; keep the image while using
+        the labels.
+        """
+
+        return self._get("labels", path, read_atlas_labels, lambda value: value[1].nbytes)
+
+
+class LabelmapBuffers:
+    """Zeroed labelmap images to export into, reused between jobs with the same geometry and label type.
+
+    One free buffer is kept per geometry and label type, up to ``max_bytes`` in all; the least recently released are
+    dropped first.
+    """
+
+    def __init__(self, max_bytes: int = 2 << 30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._free = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(geometry: AtlasGeometry, dtype) -> Tuple[AtlasGeometry, np.dtype]:
+        return geometry, np.dtype(dtype)
+
+    @staticmethod
+    def _size(geometry: AtlasGeometry, dtype) -> int:
+        return int(np.prod(geometry.size)) * np.dtype(dtype).itemsize
+
+    def acquire(self, geometry: AtlasGeometry, dtype):
+        key = self._key(geometry, dtype)
+        with self._lock:
+            image = self._free.pop(key, None)
+            if image is not None:
+                self.nbytes -= self._size(geometry, dtype)
+                return image
+
+        return allocate_labelmap(geometry, dtype)
+
+    def release(self, image, geometry: AtlasGeometry, dtype):
+        key = self._key(geometry, dtype)
+        nbytes = self._size(geometry, dtype)
+        with self._lock:
+            if key in self._free or nbytes > self.max_bytes:
+                return
+
+            self._free[key] = image
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                (geometry, dtype), _ = self._free.popitem(last=False)
+                self.nbytes -= self._size(geometry, dtype)
+
+
+class Metrics:
+    """Job counts and latencies by kind, from being queued to finished."""
+
+    def __init__(self):
+        self.rejected = 0
+        self.running = 0
+        self._counts = collections.defaultdict(collections.Counter)
+        self._latencies = collections.defaultdict(lambda: collections.deque(maxlen=LATENCY_WINDOW))
+        self._lock = threading.Lock()
+
+    def started(self):
+        with self._lock:
+            self.running += 1
+
+    def finished(self, kind: str, ok: bool, queued: float, seconds: float):
+        with self._lock:
+            self.running -= 1
+            self._counts[kind]["completed" if ok else "failed"] += 1
+            self._latencies[kind].append((queued, seconds))
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def summary(self) -> Dict:
+        with self._lock:
+            jobs = {}
+            for kind, counts in self._counts.items():
+                latencies = self._latencies[kind]
+                totals = sorted(queued + seconds for queued, seconds in latencies)
+                jobs[kind] = dict(
+                    counts,
+                    mean_queued=statistics.fmean(queued for queued, _ in latencies),
+                    mean_seconds=statistics.fmean(totals),
+                    p50_seconds=totals[len(totals) // 2],
+                    p95_seconds=totals[min(len(totals) - 1, int(len(totals) * 0.95))],
+                    max_seconds=totals[-1],
+                )
+
+            return {"running": self.running, "rejected": self.rejected, "jobs": jobs}
+
+
+def _path(request: Dict, field: str, required: bool = False) -> Optional[Path]:
+    value = request.get(field)
+    if value is None:
+        if required:
+            raise RequestError("'{}' is required".format(field))
+        return None
+    if not isinstance(value, str):
+        raise RequestError("'{}' must be a path".format(field))
+    return Path(value)
+
+
+def _version(request: Dict, field: str, default: str) -> str:
+    value = request.get(field, default)
+    if not isinstance(value, str):
+        raise RequestError("'{}' must be a version string".format(field))
+    return value
+
+
+def _find_latest(target: str):
+    try:
+        return converters.find_latest(target)
+    except ValueError as e:
+        raise RequestError(str(e))
+
+
+def _options(request: Dict) -> Tuple[bool, str, Optional[int]]:
+    engine = request.get("engine", "vtk")
+    if engine not in ENGINES:
+        raise RequestError("'engine' must be one of {}".format(", ".join(ENGINES)))
+
+    pir = request.get("pir", False)
+    if not isinstance(pir, bool):
+        raise RequestError("'pir' must be true or false")
+
+    # bool is an int, but not a count.
+    pps = request.get("points_per_segment")
+    if pps is not None and (not isinstance(pps, int) or isinstance(pps, bool) or pps < 1):
+        raise RequestError("'points_per_segment' must be a positive integer")
+
+    return pir, engine, pps
+
+
+class Service:
+    """The resident state of 'cl-export serve', and the jobs it runs."""
+
+    def __init__(
+        self,
+        mesh_cache: Optional[MeshCache],
+        geometry_cache: bool = True,
+        atlas_memory: int = 2 << 30,
+        buffer_memory: int = 2 << 30,
+    ):
+        self.mesh_cache = mesh_cache
+        self.atlases = ResidentAtlases(geometry_cache, atlas_memory)
+        self.buffers = LabelmapBuffers(buffer_memory)
+
+    def resident(self) -> Dict:
+        """The bytes of atlas labels and labelmap buffers kept between jobs."""
+
+        return {"atlases": self.atlases.nbytes, "buffers": self.buffers.nbytes}
+
+    def export(self, request: Dict) -> Dict:
+        annotation_path = _path(request, "annotation", required=True)
+        atlas_path = _path(request, "atlas")
+        labelmap_path = _path(request, "labelmap")
+        model_path = _path(request, "model")
+        lut_path = _path(request, "lut")
+        pir, engine, pps = _options(request)
+
+        if labelmap_path and not atlas_path:
+            raise RequestError("'labelmap' requires 'atlas'")
+        if model_path and not is_model_path(model_path):
+            raise RequestError("'model' has an unknown suffix")
+
+        markups = load_markups(annotation_path)
+
+        if model_path:
+            export_model(markups, model_path, pir, points_per_segment=pps, mesh_cache=self.mesh_cache)
+
+        if labelmap_path:
+            geometry = self.atlases.geometry(atlas_path)
+            if is_zarr(labelmap_path):
+                export_zarr_labelmap(
+                    markups,
+                    geometry,
+                    labelmap_path,
+                    pir,
+                    engine=engine,
+                    points_per_segment=pps,
+                    mesh_cache=self.mesh_cache,
+                )
+            elif is_sparse(labelmap_path):
+                export_sparse_labelmap(
+                    markups,
+                    geometry,
+                    labelmap_path,
+                    pir,
+                    engine=engine,
+                    points_per_segment=pps,
+                    mesh_cache=self.mesh_cache,
+                )
+            else:
+                dtype = label_dtype(len(markups))
+                image = self.buffers.acquire(geometry, dtype)
+                try:
+                    export_labelmap(
+                        markups,
+                        image,
+                        labelmap_path,
+                        pir,
+                        engine=engine,
+                        points_per_segment=pps,
+                        mesh_cache=self.mesh_cache,
+                    )
+                finally:
+                    self.buffers.release(image, geometry, dtype)
+
+        if lut_path:
+            write_color_table(markups, lut_path)
+
+        return {"annotations": len(markups)}
+
+    def stats(self, request: Dict) -> Dict:
+        annotations = request.get("annotations")
+        if not isinstance(annotations, list) or not annotations:
+            raise RequestError("'annotations' must be a list of paths")
+        atlas_path = _path(request, "atlas", required=True)
+        mapping_path = _path(request, "mapping")
+        output_path = _path(request, "output")
+        pir, engine, pps = _options(request)
+
+        geometry = self.atlases.geometry(atlas_path)
+        # the image owns the labels; it must outlive the job even if the entry is dropped.
+        image, atlas = self.atlases.labels(atlas_path)
+        mapping = load_mapping(mapping_path) if mapping_path else None
+
+        rows, failures = stats_rows(
+            [Path(path) for path in annotations], geometry, atlas, mapping, pir, 1, engine, pps, self.mesh_cache
+        )
+
+        del image
+
+        result = {"failures": {str(path): error for path, error in failures}}
+        if output_path:
+            write_table(rows, output_path)
+        else:
+            result["rows"] = rows
+        return result
+
+    def convert(self, request: Dict) -> Dict:
+        version = _version(request, "version", "?")
+        target = _version(request, "target", "")
+
+        if "document" in request:
+            data = request["document"]
+        else:
+            with open(_path(request, "src", required=True)) as f:
+                data = json.load(f)
+        dst = _path(request, "dst")
+
+        if not isinstance(data, dict):
+            raise RequestError("The document must be a JSON object")
+
+        if version.lower() in ("?", "infer"):
+            try:
+                version, document = converters.infer_normalize(data)
+            except ValueError as e:
+                raise RequestError(str(e))
+        else:
+            version, converter = _find_latest(version)
+            try:
+                document = converter.normalize(data)
+            except (KeyError, IndexError, AttributeError, TypeError) as e:
+                raise RequestError("The document is not version {}: {}: {}".format(version, type(e).__name__, e))
+
+        target, converter = _find_latest(target)
+        data = converter.specialize(document)
+
+        result = {"version": version, "target": target}
+        if dst:
+            dst.parent.mkdir(exist_ok=True, parents=True)
+            with open(dst, "w") as f:
+                json.dump(data, f)
+        else:
+            result["document"] = data
+        return result
+
+
+class Job:
+    def __init__(self, kind: str, request: Dict):
+        self.kind = kind
+        self.request = request
+        self.queued = time.perf_counter()
+        self.future = concurrent.futures.Future()
+
+
+class JobQueue:
+    """A bounded queue of jobs, run by ``workers`` threads."""
+
+    def __init__(self, service: Service, workers: int, size: int):
+        self.service = service
+        self.metrics = Metrics()
+        self._queue = queue.Queue(size)
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, kind: str, request: Dict) -> Optional[Job]:
+        """Queue a job; None if the queue is full."""
+
+        job = Job(kind, request)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            self.metrics.reject()
+            return None
+        return job
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            started = time.perf_counter()
+            self.metrics.started()
+
+            ok = False
+            try:
+                result = getattr(self.service, job.kind)(job.request)
+                ok = True
+            except Exception as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+            finally:
+                finished = time.perf_counter()
+                self.metrics.finished(job.kind, ok, started - job.queued, finished - started)
+
+
+def _json_default(value):
+    # numpy scalars in stats rows.
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("{} is not JSON serializable".format(type(value).__name__))
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    server_version = "cl-export"
+
+    # POST paths and the Service methods that run them.
+    JOBS = {"/export": "export", "/stats": "stats", "/convert": "convert"}
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address.
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "local"
+
+    def _respond(self, status: int, body: Dict, headers: Optional[Dict] = None):
+        data = json.dumps(body, default=_json_default).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        jobs = self.server.jobs
+        if self.path == "/metrics":
+            summary = jobs.metrics.summary()
+            self._respond(200, dict(summary, queue_depth=jobs.depth(), resident_bytes=jobs.service.resident()))
+        else:
+            self._respond(404, {"error": "Unknown path {}".format(self.path)})
+
+    def do_POST(self):
+        kind = self.JOBS.get(self.path)
+        if kind is None:
+            self._respond(404, {"error": "Unknown path {}".format(self.path)})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            self._respond(400, {"error": "Invalid JSON: {}".format(e)})
+            return
+        if not isinstance(request, dict):
+            self._respond(400, {"error": "The request must be a JSON object"})
+            return
+
+        job = self.server.jobs.submit(kind, request)
+        if job is None:
+            self._respond(503, {"error": "The queue is full"}, {"Retry-After": "1"})
+            return
+
+        try:
+            result = job.future.result()
+        except RequestError as e:
+            self._respond(400, {"error": str(e)})
+        except Exception as e:
+            self._respond(500, {"error": "{}: {}".format(type(e).__name__, e)})
+        else:
+            self._respond(200, dict(result, seconds=time.perf_counter() - job.queued))
+
+
+class HTTPServer(http.server.ThreadingHTTPServer):
+    def __init__(self, address, jobs: JobQueue):
+        super().__init__(address, Handler)
+        self.jobs = jobs
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, jobs: JobQueue):
+        super().__init__(str(path), Handler)
+        self.jobs = jobs
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog="cl-export serve",
+        description=(
+            "Run export, stats and convert jobs posted as JSON to a local HTTP service, keeping the atlas, label "
+            "buffers and workers warm between jobs. POST to /export, /stats or /convert; GET /metrics for the queue "
+            "depth, job latencies and resident memory. See the cl_export.serve module documentation for the request "
+            "fields."
+        ),
+    )
+    parser.add_argument(
+        "--host",
+        dest="host",
+        help="Address to listen on. Defaults to 127.0.0.1; the service has no authentication.",
+        default="127.0.0.1",
+    )
+    parser.add_argument(
+        "--port",
+        dest="port",
+        type=int,
+        help="Port to listen on. Defaults to 8765.",
+        default=8765,
+    )
+    parser.add_argument(
+        "--socket",
+        dest="socket_path",
+        type=Path,
+        help="Listen on this Unix socket rather than on --host and --port.",
+        default=None,
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        dest="workers",
+        type=int,
+        help="Number of jobs run at once. Use 0 to use all available cores. Defaults to 0.",
+        default=0,
+    )
+    parser.add_argument(
+        "--queue-size",
+        dest="queue_size",
+        type=int,
+        help="Most jobs waiting to run; further requests are rejected with 503. Defaults to 64.",
+        default=64,
+    )
+    parser.add_argument(
+        "--no-atlas-cache",
+        action="store_false",
+        dest="atlas_cache",
+        help="Read atlas geometry from the atlas files rather than the cache shared with 'cl-export'.",
+        default=True,
+    )
+    parser.add_argument(
+        "--atlas-memory",
+        dest="atlas_memory",
+        type=memory_size,
+        help=(
+            "Most memory kept for atlas labels between stats jobs; ex. '512M' or '2G'. Least recently used atlases are "
+            "dropped first. Defaults to 2G."
+        ),
+        default="2G",
+    )
+    parser.add_argument(
+        "--buffer-memory",
+        dest="buffer_memory",
+        type=memory_size,
+        help=(
+            "Most memory kept for labelmap buffers between export jobs, one per atlas geometry and label type; ex. "
+            "'512M' or '2G'. Least recently used buffers are dropped first. Defaults to 2G."
+        ),
+        default="2G",
+    )
+    parser.add_argument(
+        "--mesh-cache",
+        dest="mesh_cache_dir",
+        type=Path,
+        help="Directory of cached annotation meshes, as for 'cl-export --mesh-cache'.",
+        default=None,
+    )
+    parser.add_argument(
+        "--mesh-cache-size",
+        dest="mesh_cache_size",
+        type=memory_size,
+        help="Size cap of the mesh cache; ex. '512M' or '2G'. Least recently used meshes are evicted first.",
+        default="1G",
+    )
+
+    return parser
+
+
+def main(argv=None):
+    parser = _parser()
+    args = parser.parse_args(argv)
+
+    if args.queue_size < 1:
+        print("--queue-size must be positive.", file=sys.stderr)
+        exit(-1)
+
+    mesh_cache = MeshCache(args.mesh_cache_dir, args.mesh_cache_size) if args.mesh_cache_dir else None
+    service = Service(mesh_cache, args.atlas_cache, args.atlas_memory, args.buffer_memory)
+    jobs = JobQueue(service, args.workers or os.cpu_count(), args.queue_size)
+
+    if args.socket_path:
+        if args.socket_path.is_socket():
+            args.socket_path.unlink()
+        server = UnixHTTPServer(args.socket_path, jobs)
+        print("Serving on {}".format(args.socket_path), file=sys.stderr)
+    else:
+        server = HTTPServer((args.host, args.port), jobs)
+        print("Serving on http://{}:{}".format(*server.server_address[:2]), file=sys.stderr)
+
+    # stop on SIGTERM, as from service managers, as on Ctrl-C.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket_path:
+            args.socket_path.unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Rasterize annotations directly with numpy, without building VTK meshes.
+
+A closed curve annotation is a planar polygon extruded by ``thickness`` along
+the plane normal, centered on the plane. Rather than triangulating, extruding
+and stencilling that mesh, test each voxel center in the slab's bounding box:
+it is inside if its signed distance to the plane is within ``thickness / 2``
+and its projection onto the plane is inside the polygon.
+"""
+
+import math
+from typing import List
+from typing import Optional
+
+import numpy as np
+
+from cl_export.geometry import AtlasGeometry
+from cl_export.geometry import Block
+
+
+def _plane_basis(normal: np.ndarray):
+    """Orthonormal in-plane axes (u, v) for a unit normal."""
+
+    helper = np.array([1.0, 0.0, 0.0]) if abs(normal[0]) < 0.9 else np.array([0.0, 1.0, 0.0])
+    u = np.cross(normal, helper)
+    u /= np.linalg.norm(u)
+    v = np.cross(normal, u)
+    return u, v
+
+
+def points_in_polygon(pu: np.ndarray, pv: np.ndarray, polygon: np.ndarray) -> np.ndarray:
+    """Even-odd point in polygon test, vectorized over the points.
+
+    Points are sorted by ``pv`` so that each edge only tests the band of points it can cross; the cost is close to
+    linear in the number of points rather than points × edges.
+
+    :param pu: First coordinate of the query points.
+    :param pv: Second coordinate of the query points.
+    :param polygon: (N, 2) polygon vertices; the polygon is implicitly closed.
+    """
+
+    order = np.argsort(pv, kind="stable")
+    su = pu[order]
+    sv = pv[order]
+    parity = np.zeros(len(order), dtype=bool)
+
+    x0, y0 = polygon[:, 0], polygon[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+
+    for ax, ay, bx, by in zip(x0, y0, x1, y1):
+        if ay == by:
+            continue
+
+        # the edge crosses the horizontal ray from points with min(ay, by) <= pv < max(ay, by)
+        start, stop = np.searchsorted(sv, sorted((ay, by)), side="left")
+        if start == stop:
+            continue
+
+        band = slice(start, stop)
+        x = ax + (sv[band] - ay) * (bx - ax) / (by - ay)
+        parity[band] ^= su[band] < x
+
+    inside = np.empty_like(parity)
+    inside[order] = parity
+    return inside
+
+
+def slab_extent(polygon: np.ndarray, normal: np.ndarray, geometry: AtlasGeometry, zrange=None) -> Optional[List[int]]:
+    """Voxel bounding box of an extruded polygon, padded by one voxel and clipped to the image; as stencil_extent().
+
+    :param zrange: (z0, z1) — If given, further clip the extent to these z indices, inclusive.
+
+    :returns: The extent, or None if the slab does not intersect the image.
+    """
+
+    origin = np.asarray(geometry.origin)
+    spacing = np.asarray(geometry.spacing)
+    direction = np.asarray(geometry.direction).reshape(3, 3)
+
+    corners = np.concatenate([polygon - normal / 2, polygon + normal / 2])
+    index = np.linalg.solve(direction, (corners - origin).T).T / spacing
+
+    whole = [0, geometry.size[0] - 1, 0, geometry.size[1] - 1, 0, geometry.size[2] - 1]
+    if zrange is not None:
+        whole[4:] = max(whole[4], zrange[0]), min(whole[5], zrange[1])
+
+    extent = []
+    for axis in range(3):
+        lo = max(math.floor(index[:, axis].min()) - 1, whole[2 * axis])
+        hi = min(math.ceil(index[:, axis].max()) + 1, whole[2 * axis + 1])
+        if lo > hi:
+            return None
+        extent += [lo, hi]
+
+    return extent
+
+
+def slab_block(polygon, normal, geometry: AtlasGeometry, zrange=None) -> Optional[Block]:
+    """Rasterize an extruded planar polygon within its voxel bounding box.
+
+    :param polygon: (N, 3) world coordinates of the tessellated closed curve.
+    :param normal: Plane normal scaled to the annotation thickness, as used by make_curve().
+    :param geometry: Geometry of the output labelmap.
+    :param zrange: (z0, z1) — If given, only rasterize voxels with these z indices, inclusive.
+
+    :returns: (extent, mask) — As stencil_block(); or None if the slab does not intersect the image.
+    """
+
+    polygon = np.asarray(polygon, dtype=float)
+    if len(polygon) > 1 and np.allclose(polygon[0], polygon[-1]):
+        polygon = polygon[:-1]
+
+    normal = np.asarray(normal, dtype=float)
+    thickness = np.linalg.norm(normal)
+    if len(polygon) < 3 or thickness == 0:
+        return None
+
+    n = normal / thickness
+    u, v = _plane_basis(n)
+    center = polygon.mean(axis=0)
+
+    extent = slab_extent(polygon, normal, geometry, zrange)
+    if extent is None:
+        return None
+
+    origin = np.asarray(geometry.origin)
+    spacing = np.asarray(geometry.spacing)
+    direction = np.asarray(geometry.direction).reshape(3, 3)
+
+    x0, x1, y0, y1, z0, z1 = extent
+    i = np.arange(x0, x1 + 1)
+    j = np.arange(y0, y1 + 1)
+    k = np.arange(z0, z1 + 1)
+
+    # world position of voxel (i, j, k) is origin + direction @ (spacing * (i, j, k)), so its coordinates in the
+    # (u, v, n) frame of the plane are separable in i, j, k.
+    axes = direction * spacing
+    base = origin - center
+
+    def frame_coordinate(w, i, j, k):
+        step = w @ axes
+        return base @ w + step[0] * i + step[1] * j + step[2] * k
+
+    distance = frame_coordinate(
+        n,
+        i[np.newaxis, np.newaxis, :],
+        j[np.newaxis, :, np.newaxis],
+        k[:, np.newaxis, np.newaxis],
+    )
+    mask = np.abs(distance) <= thickness / 2
+
+    ck, cj, ci = np.nonzero(mask)
+    if len(ck):
+        ci, cj, ck = ci + x0, cj + y0, ck + z0
+        pu = frame_coordinate(u, ci, cj, ck)
+        pv = frame_coordinate(v, ci, cj, ck)
+
+        rel = polygon - center
+        planar = np.stack([rel @ u, rel @ v], axis=1)
+
+        mask[mask] = points_in_polygon(pu, pv, planar)
+
+    return extent, mask
@@ -0,0 +1,177 @@
+"""
+Sparse labelmaps: run-length encoded label voxels with the atlas geometry.
+
+A few hundred thin annotation slabs cover a tiny fraction of an atlas, so
+rather than a dense volume the labels are stored as runs over the linear
+(x-fastest) voxel index. Runs are sorted by start index and never overlap;
+each run has a single label. Files are ``.npz`` archives with the arrays:
+
+- ``starts``, ``lengths``, ``labels``: the runs.
+- ``origin``, ``spacing``, ``direction``, ``size``: the atlas geometry, as
+  in :py:class:`cl_export.geometry.AtlasGeometry`.
+"""
+
+import argparse
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
+from typing import Iterable
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import SimpleITK as sitk
+
+from cl_export.geometry import AtlasGeometry
+from cl_export.geometry import Block
+
+SPARSE_SUFFIX = ".npz"
+
+
+def is_sparse(path) -> bool:
+    return Path(path).suffix == SPARSE_SUFFIX
+
+
+@dataclass
+class SparseLabelmap:
+    geometry: AtlasGeometry
+    starts: np.ndarray
+    lengths: np.ndarray
+    labels: np.ndarray
+
+    @classmethod
+    def from_blocks(
+        cls, blocks: Iterable[Tuple[int, Optional[Block]]], geometry: AtlasGeometry, dtype=None
+    ) -> "SparseLabelmap":
+        """Encode labelled blocks; later blocks overwrite earlier ones, as paint_block().
+
+        Labels are stored as ``dtype``, or the smallest type that holds them.
+        """
+
+        nx, ny, nz = geometry.size
+
+        all_indices = []
+        all_labels = []
+        for label, block in blocks:
+            if block is None:
+                continue
+
+            extent, mask = block
+            x0, x1, y0, y1, z0, z1 = extent
+            z, y, x = np.nonzero(mask)
+            all_indices.append(((z + z0) * ny + (y + y0)) * nx + (x + x0))
+            all_labels.append(np.full(len(z), label))
+
+        if not all_indices:
+            empty = np.zeros(0, dtype=np.int64)
+            return cls(geometry, empty, empty, np.zeros(0, dtype=dtype or np.uint8))
+
+        indices = np.concatenate(all_indices).astype(np.int64)
+        labels = np.concatenate(all_labels)
+        labels = labels.astype(dtype or np.min_scalar_type(labels.max()))
+
+        # a stable sort keeps voxels written by the same index in painting order; keep the last of each.
+        order = np.argsort(indices, kind="stable")
+        indices = indices[order]
+        labels = labels[order]
+        last = np.append(indices[1:] != indices[:-1], True)
+        indices = indices[last]
+        labels = labels[last]
+
+        breaks = np.flatnonzero((np.diff(indices) != 1) | (np.diff(labels) != 0)) + 1
+        starts = np.concatenate([[0], breaks])
+        stops = np.append(breaks, len(indices))
+
+        return cls(geometry, indices[starts], stops - starts, labels[starts])
+
+    @classmethod
+    def read(cls, path) -> "SparseLabelmap":
+        with np.load(path) as data:
+            geometry = AtlasGeometry(
+                origin=tuple(data["origin"].tolist()),
+                spacing=tuple(data["spacing"].tolist()),
+                direction=tuple(data["direction"].tolist()),
+                size=tuple(data["size"].tolist()),
+            )
+            return cls(geometry, data["starts"], data["lengths"], data["labels"])
+
+    def write(self, path):
+        np.savez_compressed(
+            path,
+            starts=self.starts,
+            lengths=self.lengths,
+            labels=self.labels,
+            origin=np.asarray(self.geometry.origin),
+            spacing=np.asarray(self.geometry.spacing),
+            direction=np.asarray(self.geometry.direction),
+            size=np.asarray(self.geometry.size),
+        )
+
+    def voxels(self, label: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Expand the runs to linear voxel indices and their labels; optionally only for one label."""
+
+        starts, lengths, labels = self.starts, self.lengths, self.labels
+        if label is not None:
+            keep = labels == label
+            starts, lengths, labels = starts[keep], lengths[keep], labels[keep]
+
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return np.repeat(starts, lengths) + offsets, np.repeat(labels, lengths)
+
+    def to_array(self, dtype=None) -> np.ndarray:
+        """Expand to a dense array in (z, y, x) order."""
+
+        nx, ny, nz = self.geometry.size
+        array = np.zeros(nx * ny * nz, dtype=dtype or self.labels.dtype)
+        indices, labels = self.voxels()
+        array[indices] = labels
+        return array.reshape(nz, ny, nx)
+
+    def to_sitk(self, dtype=None) -> 'sitk.Image':
+        import SimpleITK as sitk
+
+        image = sitk.GetImageFromArray(self.to_array(dtype))
+        image.SetOrigin(self.geometry.origin)
+        image.SetSpacing(self.geometry.spacing)
+        image.SetDirection(self.geometry.direction)
+        return image
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog="cl-export expand",
+        description="Expand a sparse labelmap written by 'cl-export' to a dense image.",
+    )
+    parser.add_argument(
+        metavar="sparse",
+        dest="sparse_path",
+        type=Path,
+        help="Input sparse labelmap ({}).".format(SPARSE_SUFFIX),
+    )
+    parser.add_argument(
+        metavar="labelmap",
+        dest="labelmap_path",
+        type=Path,
+        help="Output dense labelmap; ex. 'labels.nrrd'.",
+    )
+
+    return parser
+
+
+def main(argv=None):
+    parser = _parser()
+    args = parser.parse_args(argv)
+
+    import SimpleITK as sitk
+
+    labelmap = SparseLabelmap.read(args.sparse_path)
+
+    writer = sitk.ImageFileWriter()
+    writer.SetFileName(str(args.labelmap_path))
+    writer.Execute(labelmap.to_sitk())
+
+
+if __name__ == "__main__":
+    main()
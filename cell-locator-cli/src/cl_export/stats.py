@@ -0,0 +1,345 @@
+"""
+Count the atlas voxels under each annotation, per structure: 'cl-export stats'.
+
+Each annotation is rasterized within its bounding box, as for a labelmap,
+and the contiguous atlas labels under its mask are counted with bincount.
+Annotations are counted independently, so overlapping annotations both count
+the voxels they share. The output has one row per annotation and structure:
+
+- ``file``, ``annotation``, ``name``: the annotation file, the label the
+  annotation has in labelmaps exported from that file, and its name.
+- ``structure``, ``allen_id``: the contiguous atlas label, and its Allen
+  structure id from the slicer2allen mapping if one is given.
+- ``voxels``, ``volume``: the voxels of the annotation in the structure, and
+  their volume in the atlas units cubed; µm³ for CCF atlases.
+- ``fraction``: the fraction of the annotation's voxels in the structure.
+- ``dominant``: whether this is the structure with the most voxels of the
+  annotation, ignoring the background label 0.
+
+Annotations that do not intersect the atlas get a single row with no
+structure and no voxels.
+"""
+
+import argparse
+import csv
+import json
+import math
+import os
+import sys
+
+from pathlib import Path
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+import SimpleITK as sitk
+
+from cl_export.batch import collect_annotations
+from cl_export.cache import MeshCache
+from cl_export.export import ENGINES
+from cl_export.export import load_markups
+from cl_export.export import memory_size
+from cl_export.export import positive_int
+from cl_export.export import rasterize_markups
+from cl_export.geometry import AtlasGeometry
+from cl_export.geometry import Block
+
+COLUMNS = ("file", "annotation", "name", "structure", "allen_id", "voxels", "volume", "fraction", "dominant")
+
+TABLE_SUFFIXES = (".csv", ".parquet")
+
+
+def load_mapping(path) -> np.ndarray:
+    """Load a slicer2allen mapping as a lookup table from contiguous label to Allen structure id."""
+
+    with open(path) as f:
+        mapping = {int(key): int(value) for key, value in json.load(f).items()}
+
+    lookup = np.zeros(max(mapping) + 1, dtype=np.int64)
+    lookup[list(mapping)] = list(mapping.values())
+    return lookup
+
+
+def read_atlas_labels(path) -> Tuple[sitk.Image, np.ndarray]:
+    """Read a contiguous atlas labelmap; returns the image and a (z, y, x) view of its labels."""
+
+    image = sitk.ReadImage(str(path))
+    labels = sitk.GetArrayViewFromImage(image)
+
+    if not np.issubdtype(labels.dtype, np.integer):
+        raise ValueError("Atlas labels must be integers, not {}".format(labels.dtype))
+
+    # the view does not keep the image alive; callers must.
+    return image, labels
+
+
+def block_structures(block: Block, atlas: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Count the atlas labels under ``block``; returns the labels present and their voxel counts."""
+
+    extent, mask = block
+    x0, x1, y0, y1, z0, z1 = extent
+
+    labels = atlas[z0:z1 + 1, y0:y1 + 1, x0:x1 + 1][mask]
+    counts = np.bincount(labels.astype(np.intp, copy=False))
+
+    structures = np.flatnonzero(counts)
+    return structures, counts[structures]
+
+
+def annotation_rows(
+    file: str,
+    label: int,
+    name: str,
+    block: Optional[Block],
+    atlas: np.ndarray,
+    voxel_volume: float,
+    mapping: Optional[np.ndarray],
+) -> Iterator[Dict]:
+    """The rows of the stats table for one annotation; see the module documentation."""
+
+    row = dict(file=file, annotation=label, name=name)
+
+    structures, counts = block_structures(block, atlas) if block else ([], [])
+    if not len(structures):
+        yield dict(row, structure=None, allen_id=None, voxels=0, volume=0.0, fraction=0.0, dominant=False)
+        return
+
+    total = counts.sum()
+
+    dominant = None
+    foreground = np.flatnonzero(structures != 0)
+    if len(foreground):
+        dominant = structures[foreground[np.argmax(counts[foreground])]]
+
+    for structure, count in zip(structures.tolist(), counts.tolist()):
+        allen_id = None
+        if mapping is not None:
+            allen_id = int(mapping[structure]) if structure < len(mapping) else None
+
+        yield dict(
+            row,
+            structure=structure,
+            allen_id=allen_id,
+            voxels=count,
+            volume=count * voxel_volume,
+            fraction=count / total,
+            dominant=structure == dominant,
+        )
+
+
+def stats_rows(
+    annotations: List[Path],
+    geometry: AtlasGeometry,
+    atlas: np.ndarray,
+    mapping: Optional[np.ndarray],
+    pir: bool,
+    jobs: int = 1,
+    engine: str = "vtk",
+    points_per_segment: Optional[int] = None,
+    mesh_cache: Optional[MeshCache] = None,
+) -> Tuple[List[Dict], List[Tuple[Path, str]]]:
+    """The rows of the stats table for the annotation files, against the ``atlas`` labels with ``geometry``; and the
+    files that could not be read, with their errors.
+    """
+
+    failures = []
+    markups = []
+    owners = []
+    for path in annotations:
+        try:
+            file_markups = load_markups(path)
+        except Exception as e:
+            failures.append((path, "{}: {}".format(type(e).__name__, e)))
+            continue
+
+        markups.extend(file_markups)
+        owners.extend((path, label) for label in range(1, len(file_markups) + 1))
+
+    voxel_volume = math.prod(geometry.spacing)
+    blocks = rasterize_markups(
+        markups, geometry, pir, jobs, engine, points_per_segment=points_per_segment, mesh_cache=mesh_cache
+    )
+
+    rows = []
+    for markup, (path, label), block in zip(markups, owners, blocks):
+        name = markup.get("name") or ""
+        rows.extend(annotation_rows(str(path), label, name, block, atlas, voxel_volume, mapping))
+
+    return rows, failures
+
+
+def import_pyarrow():
+    """Import pyarrow for Parquet tables; exits with an install hint if it is missing."""
+
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise SystemExit("Parquet output requires pyarrow; install cell-locator-cli[parquet].")
+
+    return pyarrow
+
+
+def write_table(rows: List[Dict], path: Path, columns: Tuple[str, ...] = COLUMNS):
+    """Write rows to a CSV or Parquet file, by suffix. Parquet output requires pyarrow."""
+
+    if path.suffix == ".parquet":
+        pyarrow = import_pyarrow()
+        table = pyarrow.Table.from_pydict({column: [row[column] for row in rows] for column in columns})
+        pyarrow.parquet.write_table(table, str(path))
+        return
+
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog="cl-export stats",
+        description=(
+            "Count the atlas voxels under each annotation, per atlas structure, across many Cell Locator annotation "
+            "files. Writes one row per annotation and structure."
+        ),
+    )
+    parser.add_argument(
+        metavar="annotation",
+        dest="annotations",
+        nargs="*",
+        help="Input Cell Locator annotation files (JSON) or glob patterns; ex. 'specimens/**/*.json'.",
+    )
+    parser.add_argument(
+        "--manifest",
+        dest="manifest_path",
+        type=Path,
+        help="Text file listing input annotation files, one per line. Relative paths are relative to the manifest.",
+        default=None,
+    )
+    parser.add_argument(
+        "-a",
+        "--atlas",
+        dest="atlas_path",
+        type=Path,
+        help="Contiguous atlas labelmap; ex. 'ccf_annotation_25_contiguous.nrrd'.",
+        required=True,
+    )
+    parser.add_argument(
+        "--mapping",
+        dest="mapping_path",
+        type=Path,
+        help=(
+            "slicer2allen mapping from contiguous atlas labels to Allen structure ids; ex. "
+            "'ccf_annotation_color_slicer2allen_mapping.json'. If not provided, the allen_id column is empty."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output_path",
+        type=Path,
+        help="Output table; '.csv' or '.parquet'. Parquet output requires pyarrow.",
+        required=True,
+    )
+    parser.add_argument(
+        "--pir",
+        action="store_true",
+        dest="pir",
+        help=(
+            "If set, read the annotations in PIR format rather than RAS. This should only be necessary for old-style "
+            "CCF annotations. "
+        ),
+        default=False,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        help="Number of worker processes used to rasterize annotations. Use 0 to use all available cores.",
+        default=1,
+    )
+    parser.add_argument(
+        "--engine",
+        dest="engine",
+        choices=ENGINES,
+        help="Rasterization engine. See 'cl-export -h'. Defaults to 'vtk'.",
+        default="vtk",
+    )
+    parser.add_argument(
+        "--points-per-segment",
+        dest="points_per_segment",
+        type=positive_int,
+        help="Number of points to tessellate each curve segment with. See 'cl-export -h'.",
+        default=None,
+    )
+    parser.add_argument(
+        "--mesh-cache",
+        dest="mesh_cache_dir",
+        type=Path,
+        help=(
+            "Directory of cached annotation meshes, as for 'cl-export'. Meshes are keyed by the annotation geometry "
+            "and tessellation settings, so unchanged annotations are not rebuilt. The directory may be shared."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--mesh-cache-size",
+        dest="mesh_cache_size",
+        type=memory_size,
+        help="Size cap of the mesh cache; ex. '512M' or '2G'. Least recently used meshes are evicted first.",
+        default="1G",
+    )
+
+    return parser
+
+
+def main(argv=None):
+    parser = _parser()
+    args = parser.parse_args(argv)
+
+    if args.output_path.suffix not in TABLE_SUFFIXES:
+        print("--output must end with one of {}.".format(", ".join(TABLE_SUFFIXES)), file=sys.stderr)
+        exit(-1)
+
+    if args.output_path.suffix == ".parquet":
+        import_pyarrow()
+
+    annotations = collect_annotations(args.annotations, args.manifest_path)
+    if not annotations:
+        print("No annotation files given.", file=sys.stderr)
+        exit(-1)
+
+    geometry = AtlasGeometry.from_file(args.atlas_path)
+    image, atlas = read_atlas_labels(args.atlas_path)
+    mapping = load_mapping(args.mapping_path) if args.mapping_path else None
+
+    rows, failures = stats_rows(
+        annotations,
+        geometry,
+        atlas,
+        mapping,
+        args.pir,
+        args.jobs or os.cpu_count(),
+        args.engine,
+        args.points_per_segment,
+        MeshCache(args.mesh_cache_dir, args.mesh_cache_size) if args.mesh_cache_dir else None,
+    )
+
+    write_table(rows, args.output_path)
+
+    for path, error in failures:
+        print("{}: {}".format(path, error), file=sys.stderr)
+
+    if failures:
+        print("{} of {} files failed.".format(len(failures), len(annotations)), file=sys.stderr)
+        exit(-1)
+
+
+if __name__ == "__main__":
+    main()
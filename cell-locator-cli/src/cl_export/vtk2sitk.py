@@ -1,38 +1,115 @@
+"""
+Convert images between VTK and SimpleITK.
+
+SimpleITK images own their pixel buffer, so while a vtkImageData can share the
+buffer of a SimpleITK image, the reverse is not possible. sitk2vtk() returns a
+view by default; vtk2sitk() returns the shared SimpleITK image for images that
+came from sitk2vtk(), and otherwise copies the pixels once, directly into the
+new SimpleITK image.
+"""
+
+from typing import Optional
+
+import numpy as np
+
+from vtkmodules.vtkCommonDataModel import vtkImageData
+from vtkmodules.vtkCommonMath import vtkMatrix3x3
+from vtkmodules.util.numpy_support import numpy_to_vtk
+from vtkmodules.util.numpy_support import vtk_to_numpy
+
 import SimpleITK as sitk
-import vtk
-import vtk.util.numpy_support as vtknp
+
+
+def _buffer_address(array: np.ndarray) -> int:
+    return array.__array_interface__["data"][0]
+
+
+def _shared_sitk_image(scalars) -> Optional[sitk.Image]:
+    """The SimpleITK image whose buffer ``scalars`` still share, if any; see sitk2vtk()."""
+
+    sitkimg = getattr(scalars, "_sitk_image", None)
+    if sitkimg is None or scalars.GetNumberOfValues() == 0:
+        return None
+
+    # the VTK array may have been reallocated since, ex. by SetNumberOfTuples().
+    if _buffer_address(vtk_to_numpy(scalars)) != _buffer_address(sitk.GetArrayViewFromImage(sitkimg)):
+        return None
+
+    return sitkimg
 
 
 def vtk2sitk(vtkimg, debug=False):
-    """Takes a VTK image, returns a SimpleITK image."""
+    """Takes a VTK image, returns a SimpleITK image.
+
+    Images created by sitk2vtk() share their buffer with a SimpleITK image; that image is returned, updated to the
+    geometry of ``vtkimg``, and no pixels are copied. Otherwise the pixels are copied once.
+    """
     sd = vtkimg.GetPointData().GetScalars()
-    npdata = vtknp.vtk_to_numpy(sd)
+    components = sd.GetNumberOfComponents()
 
     dims = list(vtkimg.GetDimensions())
     origin = vtkimg.GetOrigin()
     spacing = vtkimg.GetSpacing()
 
+    sitkimg = _shared_sitk_image(sd)
+
     if debug:
         print("dims:", dims)
         print("origin:", origin)
         print("spacing:", spacing)
+        print("components:", components)
+        print("shared:", sitkimg is not None)
 
-        print("numpy type:", npdata.dtype)
-        print("numpy shape:", npdata.shape)
+    if sitkimg is None:
+        npdata = vtk_to_numpy(sd)
+        shape = dims[::-1] + ([components] if components > 1 else [])
+        npdata = npdata.reshape(shape)
+        if debug:
+            print("numpy type:", npdata.dtype)
+            print("numpy shape:", npdata.shape)
+
+        sitkimg = sitk.GetImageFromArray(npdata, isVector=components > 1)
 
-    dims.reverse()
-    npdata.shape = tuple(dims)
-    if debug:
-        print("new shape:", npdata.shape)
-    sitkimg = sitk.GetImageFromArray(npdata)
     sitkimg.SetSpacing(spacing)
     sitkimg.SetOrigin(origin)
 
-    if vtk.vtkVersion.GetVTKMajorVersion() >= 9:
-        direction = vtkimg.GetDirectionMatrix()
-        d = []
-        for y in range(3):
-            for x in range(3):
-                d.append(direction.GetElement(y, x))
-        sitkimg.SetDirection(d)
+    direction = vtkimg.GetDirectionMatrix()
+    sitkimg.SetDirection([direction.GetElement(y, x) for y in range(3) for x in range(3)])
     return sitkimg
+
+
+def sitk2vtk(sitkimg: sitk.Image, copy: bool = False) -> vtkImageData:
+    """Takes a SimpleITK image, returns a VTK image.
+
+    Unless ``copy`` is set, the VTK scalars share the pixel buffer of ``sitkimg``, so writes through either image are
+    visible in both; vtk2sitk() returns ``sitkimg`` again for such an image. Multi-component images become scalars with
+    one component per pixel component.
+    """
+
+    if sitkimg.GetDimension() != 3:
+        raise ValueError("Expected a 3D image, not {}D.".format(sitkimg.GetDimension()))
+
+    components = sitkimg.GetNumberOfComponentsPerPixel()
+
+    if copy:
+        npdata = sitk.GetArrayFromImage(sitkimg)
+    else:
+        npdata = sitk.GetArrayViewFromImage(sitkimg)
+
+    npdata = npdata.reshape(-1, components) if components > 1 else npdata.reshape(-1)
+    scalars = numpy_to_vtk(npdata, deep=False)
+    if not copy:
+        # the array view does not keep the SimpleITK image alive; the VTK array must.
+        scalars._sitk_image = sitkimg
+
+    direction = vtkMatrix3x3()
+    direction.DeepCopy(sitkimg.GetDirection())
+
+    vtkimg = vtkImageData()
+    vtkimg.SetDimensions(*sitkimg.GetSize())
+    vtkimg.SetOrigin(*sitkimg.GetOrigin())
+    vtkimg.SetSpacing(*sitkimg.GetSpacing())
+    vtkimg.SetDirectionMatrix(direction)
+    vtkimg.GetPointData().SetScalars(scalars)
+
+    return vtkimg
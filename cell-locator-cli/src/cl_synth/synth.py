@@ -0,0 +1,518 @@
+"""
+Generate synthetic annotation documents and atlas volumes for load testing.
+
+Production specimens cannot be shared, so these tools produce inputs with a
+realistic shape and scale instead. Output is fully determined by ``--seed``;
+the same arguments always produce byte-identical files.
+"""
+
+import argparse
+import gzip
+import json
+import math
+import sys
+import dataclasses
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, Tuple
+
+import numpy as np
+
+from cl_convert import converters
+from cl_convert import model
+
+Vector3f = Tuple[float, float, float]
+
+# sizes (in index order) and isotropic spacing (in um) of the CCFv3 volumes.
+CCF_GEOMETRIES = {
+    'ccf10': ((1320, 800, 1140), 10.0),
+    'ccf25': ((528, 320, 456), 25.0),
+    'ccf50': ((264, 160, 228), 50.0),
+    'ccf100': ((132, 80, 114), 100.0),
+}
+
+
+def _rotation(axis: int, degrees: float) -> np.ndarray:
+    c, s = math.cos(math.radians(degrees)), math.sin(math.radians(degrees))
+    i, j = (axis + 1) % 3, (axis + 2) % 3
+    rot = np.eye(3)
+    rot[i, i], rot[i, j], rot[j, i], rot[j, j] = c, -s, s, c
+    return rot
+
+
+# direction matrices available for the synthetic volumes. 'oblique' is fixed
+# (not seeded) so that annotations and atlases generated separately agree.
+DIRECTIONS = {
+    'identity': np.eye(3),
+    'oblique': _rotation(2, 30) @ _rotation(0, 20),
+}
+
+# same as cl_export.export.RAS_TO_PIR_MATRIX; used to emit coordinates that
+# land inside the atlas when exported with ``cl-export --pir``.
+RAS_TO_PIR_MATRIX = np.array([
+    [.0, +1, .0, .0],
+    [.0, .0, -1, .0],
+    [-1, .0, .0, -1],
+    [.0, .0, .0, +1],
+])
+PIR_TO_RAS_MATRIX = np.linalg.inv(RAS_TO_PIR_MATRIX)
+
+# plane normal for each named plane, as an index axis in RAS and PIR space.
+PLANE_AXES = {
+    'sagittal': {'ras': 0, 'pir': 2},
+    'coronal': {'ras': 1, 'pir': 0},
+    'axial': {'ras': 2, 'pir': 1},
+}
+
+# approximate physical size (in um) of one synthetic atlas structure "cell".
+STRUCTURE_CELL_SIZE = 200.0
+
+NRRD_TYPES = {
+    np.dtype('uint8'): 'uint8',
+    np.dtype('uint16'): 'uint16',
+    np.dtype('uint32'): 'uint32',
+}
+
+
+@dataclass
+class Geometry:
+    """Image geometry of a synthetic volume, using ITK conventions."""
+
+    size: Tuple[int, int, int]
+    spacing: Vector3f
+    origin: Vector3f = (0.0, 0.0, 0.0)
+    direction: np.ndarray = dataclasses.field(default_factory=lambda: np.eye(3))
+
+    @classmethod
+    def ccf(cls, name: str, direction: str = 'identity') -> 'Geometry':
+        size, spacing = CCF_GEOMETRIES[name]
+        return cls(size, (spacing,) * 3, direction=DIRECTIONS[direction])
+
+    def index_to_world(self, index) -> np.ndarray:
+        return np.asarray(self.origin) + self.direction @ (np.asarray(self.spacing) * index)
+
+
+def _uniform(rng: np.random.Generator, bounds: Tuple[float, float]) -> float:
+    lo, hi = bounds
+    return float(rng.uniform(lo, hi)) if hi > lo else float(lo)
+
+
+def _plane_frame(rng: np.random.Generator, planes: str, space: str) -> np.ndarray:
+    """Return a rotation whose columns are the in-plane axes and the plane normal."""
+
+    if planes == 'oblique':
+        q, r = np.linalg.qr(rng.normal(size=(3, 3)))
+        q = q * np.sign(np.diag(r))
+        if np.linalg.det(q) < 0:
+            q[:, 0] = -q[:, 0]
+        return q
+
+    if planes == 'random':
+        planes = str(rng.choice(sorted(PLANE_AXES)))
+
+    k = PLANE_AXES[planes][space]
+    frame = np.zeros((3, 3))
+    frame[(k + 1) % 3, 0] = 1
+    frame[(k + 2) % 3, 1] = 1
+    frame[k, 2] = 1
+    return frame
+
+
+def _orientation(frame: np.ndarray, center: np.ndarray, pir: bool) -> np.ndarray:
+    orientation = np.eye(4)
+    orientation[:3, :3] = frame
+    orientation[:3, 3] = center
+    if pir:
+        orientation = PIR_TO_RAS_MATRIX @ orientation
+    return orientation
+
+
+def generate_document(
+        rng: np.random.Generator,
+        geometry: Geometry,
+        curves: int = 10,
+        points: int = 8,
+        fiducials: int = 0,
+        thickness: Tuple[float, float] = (50, 50),
+        radius: Tuple[float, float] = (250, 750),
+        planes: str = 'random',
+        representation: str = 'spline',
+        pir: bool = False,
+) -> model.Document:
+    """Generate a normalized document with random closed curves and fiducials.
+
+    Annotation centers are drawn from the central 60% of the volume described
+    by ``geometry``. Control points form star-shaped polygons with limited
+    jitter so that the resulting curves do not self-intersect.
+
+    :param pir: If set, emit RAS coordinates that land inside ``geometry``
+        when exported with ``cl-export --pir``.
+    """
+
+    doc = model.Document()
+    space = 'pir' if pir else 'ras'
+
+    def random_center():
+        index = rng.uniform(0.2, 0.8, size=3) * np.asarray(geometry.size)
+        return geometry.index_to_world(index)
+
+    for i in range(1, curves + 1):
+        frame = _plane_frame(rng, planes, space)
+        center = random_center()
+        orientation = _orientation(frame, center, pir)
+
+        # jitter evenly spaced control points only slightly; larger jitter lets
+        # the interpolating spline overshoot and loop over itself.
+        base = _uniform(rng, radius)
+        step = 2 * math.pi / points
+        angles = step * (np.arange(points) + rng.uniform(-0.25, 0.25, size=points))
+        radii = base * rng.uniform(0.8, 1.0, size=points)
+        local = np.stack([radii * np.cos(angles), radii * np.sin(angles), np.zeros(points), np.ones(points)])
+        positions = (orientation @ local)[:3].T
+
+        ann = model.Annotation()
+        ann.name = f'Annotation {i}'
+        ann.markup_type = 'ClosedCurve'
+        if representation == 'mixed':
+            ann.representation_type = str(rng.choice(['spline', 'polyline']))
+        else:
+            ann.representation_type = representation
+        ann.thickness = _uniform(rng, thickness)
+        ann.orientation = tuple(orientation.ravel().tolist())
+        ann.points = [model.Point(tuple(p)) for p in positions.tolist()]
+        doc.annotations.append(ann)
+
+    for i in range(1, fiducials + 1):
+        frame = _plane_frame(rng, planes, space)
+        orientation = _orientation(frame, random_center(), pir)
+
+        ann = model.Annotation()
+        ann.name = f'Point {i}'
+        ann.markup_type = 'Point'
+        ann.orientation = tuple(orientation.ravel().tolist())
+        ann.points = [model.Point(tuple(orientation[:3, 3].tolist()))]
+        doc.annotations.append(ann)
+
+    return doc
+
+
+def label_dtype(labels: int) -> np.dtype:
+    """Smallest unsigned integer type that can hold ``labels`` distinct ids."""
+
+    for dtype in NRRD_TYPES:
+        if labels <= np.iinfo(dtype).max:
+            return dtype
+    raise ValueError(f'too many labels: {labels}')
+
+
+def _structure_cells(rng: np.random.Generator, geometry: Geometry, labels: int) -> Tuple[np.ndarray, int]:
+    """Partition a coarse grid into ``labels - 1`` Voronoi structures inside an ellipsoid "brain".
+
+    :returns: (cells, factor) — the coarse label grid in (z, y, x) order and
+        the number of voxels per coarse cell along each axis.
+    """
+
+    factor = max(1, round(STRUCTURE_CELL_SIZE / min(geometry.spacing)))
+    shape = tuple(math.ceil(s / factor) for s in reversed(geometry.size))
+
+    grid = np.stack(np.meshgrid(*(np.arange(n) + 0.5 for n in shape), indexing='ij'), axis=-1)
+    grid = grid.reshape(-1, 3).astype(np.float32)
+
+    half = np.asarray(shape, dtype=np.float32) / 2
+    inside = (((grid - half) / (0.9 * half)) ** 2).sum(axis=1) <= 1
+
+    cells = np.zeros(len(grid), dtype=label_dtype(labels))
+    candidates = grid[inside]
+    if labels > 1 and len(candidates):
+        seeds = candidates[rng.choice(len(candidates), size=min(labels - 1, len(candidates)), replace=False)]
+        nearest = np.empty(len(candidates), dtype=np.int64)
+        seeds_sq = (seeds ** 2).sum(axis=1)
+        for start in range(0, len(candidates), 16384):
+            chunk = candidates[start:start + 16384]
+            dist = seeds_sq - 2 * chunk @ seeds.T
+            nearest[start:start + len(chunk)] = dist.argmin(axis=1)
+        cells[inside] = nearest + 1
+
+    return cells.reshape(shape), factor
+
+
+def generate_atlas(
+        rng: np.random.Generator,
+        geometry: Geometry,
+        labels: int = 670,
+        kind: str = 'labelmap',
+        slab: int = 16,
+) -> Iterator[np.ndarray]:
+    """Generate a synthetic atlas, yielding it in z-slabs of ``slab`` slices.
+
+    The volume is never fully materialized so that CCF 10um atlases can be
+    generated with bounded memory.
+
+    :param labels: Number of label ids, including the background label 0.
+    :param kind: ``'labelmap'`` for contiguous structure ids, or
+        ``'template'`` for a uint16 average-template-like intensity volume.
+    """
+
+    cells, factor = _structure_cells(rng, geometry, labels)
+    nx, ny, nz = geometry.size
+    yi = np.arange(ny) // factor
+    xi = np.arange(nx) // factor
+
+    # per-label mean intensity for templates; derived from rng state so it
+    # is deterministic but independent of the slab size.
+    means = rng.integers(200, 4000, size=labels).astype(np.float32)
+    means[0] = 20
+    noise_seed = int(rng.integers(2 ** 31))
+
+    for z0 in range(0, nz, slab):
+        z = np.arange(z0, min(z0 + slab, nz)) // factor
+        block = cells[np.ix_(z, yi, xi)]
+
+        if kind == 'labelmap':
+            yield block
+        elif kind == 'template':
+            values = means[block]
+            for dz in range(len(z)):
+                noise = np.random.default_rng([noise_seed, z0 + dz]).normal(0, 40, size=values.shape[1:])
+                values[dz] += noise
+            yield np.clip(values, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+        else:
+            raise ValueError(f'Unrecognized atlas kind {kind!r}')
+
+
+def generate_mapping(rng: np.random.Generator, labels: int) -> dict:
+    """Generate a plausible slicer2allen mapping for contiguous label ids.
+
+    Like the Allen ontology, most ids are small and a minority are 9-digit ids.
+    """
+
+    large = labels // 5
+    small = labels - 1 - large
+    ids = np.concatenate([
+        1 + rng.choice(max(small, 1200), size=small, replace=False),
+        100_000_000 + rng.choice(520_000_000, size=large, replace=False),
+    ])
+    ids.sort()
+    mapping = {'0': '0'}
+    mapping.update({str(idx): str(value) for idx, value in enumerate(ids.tolist(), start=1)})
+    return mapping
+
+
+def write_nrrd(path: Path, geometry: Geometry, dtype, slabs: Iterator[np.ndarray], compress: bool = True):
+    """Write z-slabs to an NRRD file with the given geometry, streaming the data."""
+
+    dtype = np.dtype(dtype)
+    directions = ' '.join(
+        '({})'.format(','.join(repr(float(v)) for v in geometry.direction[:, i] * geometry.spacing[i]))
+        for i in range(3)
+    )
+    header = [
+        'NRRD0004',
+        f'type: {NRRD_TYPES[dtype]}',
+        'dimension: 3',
+        'space: left-posterior-superior',
+        'sizes: {} {} {}'.format(*geometry.size),
+        f'space directions: {directions}',
+        'kinds: domain domain domain',
+        'endian: little',
+        f'encoding: {"gzip" if compress else "raw"}',
+        'space origin: ({})'.format(','.join(repr(float(v)) for v in geometry.origin)),
+    ]
+
+    with open(path, 'wb') as f:
+        f.write(('\n'.join(header) + '\n\n').encode('ascii'))
+
+        # mtime=0 keeps the gzip stream byte-identical between runs
+        stream = gzip.GzipFile(fileobj=f, mode='wb', mtime=0) if compress else f
+        for slab in slabs:
+            stream.write(np.ascontiguousarray(slab, dtype=dtype.newbyteorder('<')).tobytes())
+        if compress:
+            stream.close()
+
+
+def _range(text: str) -> Tuple[float, float]:
+    lo, _, hi = text.partition(':')
+    return float(lo), float(hi or lo)
+
+
+def annotation(args):
+    count = args.count
+    if count > 1 and '{' not in str(args.dst):
+        raise SystemExit("--count greater than 1 requires a '{i}' field in dst, e.g. 'corpus/specimen-{i:04d}.json'")
+
+    if args.curves + args.fiducials < 1:
+        raise SystemExit('at least one curve or fiducial is required')
+
+    v, vc = converters.find_latest(args.target)
+    if args.fiducials and v.startswith('v0.0.0'):
+        raise SystemExit(f'version {v!r} does not support point annotations')
+
+    geometry = Geometry.ccf(args.geometry, args.direction)
+
+    # convert boolean indent to json.dump argument
+    indent = 2 if args.indent else None
+
+    for i in range(count):
+        rng = np.random.default_rng([args.seed, i])
+        doc = generate_document(
+            rng, geometry,
+            curves=args.curves,
+            points=args.points,
+            fiducials=args.fiducials,
+            thickness=args.thickness,
+            radius=args.radius,
+            planes=args.planes,
+            representation=args.representation,
+            pir=args.pir,
+        )
+        data = vc.specialize(doc)
+
+        # if dst is '-', use stdout
+        if args.dst != Path('-'):
+            dst = Path(str(args.dst).format(i=i))
+            dst.parent.mkdir(exist_ok=True, parents=True)
+            with dst.open('w') as f:
+                json.dump(data, f, indent=indent)
+        else:
+            json.dump(data, sys.stdout, indent=indent)
+            print()
+
+
+def atlas(args):
+    geometry = Geometry.ccf(args.geometry, args.direction)
+
+    rng = np.random.default_rng(args.seed)
+    dtype = label_dtype(args.labels) if args.kind == 'labelmap' else np.dtype('uint16')
+
+    args.dst.parent.mkdir(exist_ok=True, parents=True)
+    slabs = generate_atlas(rng, geometry, labels=args.labels, kind=args.kind)
+    write_nrrd(args.dst, geometry, dtype, slabs, compress=args.compress)
+
+    if args.mapping:
+        mapping = generate_mapping(np.random.default_rng([args.seed, 1]), args.labels)
+        args.mapping.parent.mkdir(exist_ok=True, parents=True)
+        with args.mapping.open('w') as f:
+            json.dump(mapping, f, sort_keys=True, indent=4)
+
+
+def _parser():
+    parser = argparse.ArgumentParser(description=(
+        'Generate synthetic annotation files and atlas volumes for load testing. Output is deterministic for a given '
+        'seed.'
+    ))
+
+    subs = parser.add_subparsers(dest='cmd', title='subcommands', required=True)
+
+    def add_geometry_arguments(sub):
+        sub.add_argument(
+            '-g', '--geometry', choices=list(CCF_GEOMETRIES), default='ccf25',
+            help='CCF atlas geometry. Defaults to ccf25.',
+        )
+        sub.add_argument(
+            '--direction', choices=list(DIRECTIONS), default='identity',
+            help='Direction matrix of the atlas geometry. Defaults to identity.',
+        )
+        sub.add_argument(
+            '-s', '--seed', type=int, default=0,
+            help='Random seed. Defaults to 0.',
+        )
+
+    sub_annotation = subs.add_parser(
+        'annotation',
+        help='Generate annotation files.',
+    )
+    sub_annotation.add_argument(
+        'dst', type=Path,
+        help=(
+            "Destination JSON file. Use '-' to write to stdout. With --count, a format string with an '{i}' field; "
+            "ex. 'corpus/specimen-{i:04d}.json'."
+        ),
+    )
+    sub_annotation.add_argument(
+        '-c', '--count', type=int, default=1,
+        help='Number of files to generate. Defaults to 1.',
+    )
+    sub_annotation.add_argument(
+        '-t', '--target', default='',
+        help='Target file version. Defaults to the latest version.',
+    )
+    add_geometry_arguments(sub_annotation)
+    sub_annotation.add_argument(
+        '--curves', type=int, default=10,
+        help='Number of closed curve annotations per file. Defaults to 10.',
+    )
+    sub_annotation.add_argument(
+        '--points', type=int, default=8,
+        help='Number of control points per curve. Defaults to 8.',
+    )
+    sub_annotation.add_argument(
+        '--fiducials', type=int, default=0,
+        help='Number of point annotations per file. Requires version v0.1.0 or later. Defaults to 0.',
+    )
+    sub_annotation.add_argument(
+        '--thickness', type=_range, default=(50.0, 50.0), metavar='MIN[:MAX]',
+        help='Curve thickness, or range of thicknesses, in um. Defaults to 50.',
+    )
+    sub_annotation.add_argument(
+        '--radius', type=_range, default=(250.0, 750.0), metavar='MIN[:MAX]',
+        help='Curve radius, or range of radii, in um. Defaults to 250:750.',
+    )
+    sub_annotation.add_argument(
+        '--planes', choices=['axial', 'coronal', 'sagittal', 'random', 'oblique'], default='random',
+        help=(
+            "Orientation of annotation planes. 'random' picks one of the axis-aligned planes per annotation; "
+            "'oblique' picks an arbitrary rotation. Defaults to random."
+        ),
+    )
+    sub_annotation.add_argument(
+        '--representation', choices=['spline', 'polyline', 'mixed'], default='spline',
+        help='Curve representation type. Defaults to spline.',
+    )
+    sub_annotation.add_argument(
+        '--pir', action='store_true', default=False,
+        help='Emit RAS coordinates that fall inside the atlas when exported with `cl-export --pir`.',
+    )
+    sub_annotation.add_argument(
+        '--no-indent', dest='indent', action='store_false', default=True,
+        help='Do not indent output JSON.',
+    )
+    sub_annotation.set_defaults(func=annotation)
+
+    sub_atlas = subs.add_parser(
+        'atlas',
+        help='Generate an atlas labelmap or template volume.',
+    )
+    sub_atlas.add_argument(
+        'dst', type=Path,
+        help='Destination NRRD file.',
+    )
+    add_geometry_arguments(sub_atlas)
+    sub_atlas.add_argument(
+        '--kind', choices=['labelmap', 'template'], default='labelmap',
+        help='Generate a contiguous labelmap or an average template volume. Defaults to labelmap.',
+    )
+    sub_atlas.add_argument(
+        '--labels', type=int, default=670,
+        help='Number of label ids, including background. Defaults to 670.',
+    )
+    sub_atlas.add_argument(
+        '--mapping', type=Path, default=None,
+        help='Also write a slicer2allen label mapping JSON file to this path.',
+    )
+    sub_atlas.add_argument(
+        '--raw', dest='compress', action='store_false', default=True,
+        help='Write raw rather than gzip encoded data.',
+    )
+    sub_atlas.set_defaults(func=atlas)
+
+    return parser
+
+
+def main():
+    parser = _parser()
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
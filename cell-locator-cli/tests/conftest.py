@@ -0,0 +1,58 @@
+"""
+Shared fixtures: small synthetic annotations and atlas geometries from cl_synth.
+
+Everything is generated from fixed seeds, so tests are deterministic, and at
+CCF 50 or 100 µm, so they run in seconds.
+"""
+
+from typing import List
+
+import numpy as np
+import pytest
+
+from cl_export.export import document_markups
+from cl_export.geometry import AtlasGeometry
+from cl_synth import synth
+
+
+def atlas_geometry(name: str = "ccf50", direction: str = "oblique") -> AtlasGeometry:
+    """The geometry of the synthetic atlas 'cl-synth atlas --geometry <name> --direction <direction>' writes."""
+
+    geometry = synth.Geometry.ccf(name, direction)
+    return AtlasGeometry(
+        origin=tuple(float(value) for value in geometry.origin),
+        spacing=tuple(float(value) for value in geometry.spacing),
+        direction=tuple(geometry.direction.ravel().tolist()),
+        size=tuple(geometry.size),
+    )
+
+
+def synthetic_markups(
+    name: str = "ccf50",
+    direction: str = "oblique",
+    seed: int = 0,
+    curves: int = 6,
+    planes: str = "random",
+    representation: str = "spline",
+    pir: bool = False,
+    thickness=(30, 300),
+    radius=(250, 750),
+) -> List[dict]:
+    """The markups of a synthetic document whose annotations land inside atlas_geometry(name, direction)."""
+
+    document = synth.generate_document(
+        np.random.default_rng(seed),
+        synth.Geometry.ccf(name, direction),
+        curves=curves,
+        planes=planes,
+        representation=representation,
+        pir=pir,
+        thickness=thickness,
+        radius=radius,
+    )
+    return document_markups(document)
+
+
+@pytest.fixture
+def oblique_geometry() -> AtlasGeometry:
+    return atlas_geometry("ccf50", "oblique")
@@ -0,0 +1,151 @@
+"""
+The 'numpy' engine classifies the voxels the 'vtk' engine does.
+
+The 'vtk' engine stencils models with single-precision points, so a voxel
+center within their rounding of an annotation's boundary (a face of its slab,
+or an edge of its curve) may land on either side. Such ties are rare, about
+one voxel in 300,000; the engines must agree everywhere else.
+"""
+
+import numpy as np
+import pytest
+
+from cl_export.export import markup_to_polygon
+from cl_export.export import rasterize_markups
+
+from conftest import synthetic_markups
+
+SEEDS = range(5)
+
+# Farthest a tie voxel center may be from the annotation boundary, in µm. Single precision rounds CCF coordinates,
+# up to about 1e4 µm, by up to about 1e-3 µm; ties seen are about 1e-4 µm from the boundary.
+TIE_DISTANCE = 1e-3
+
+# Voxels that may differ between the engines, as a fraction of the labelled voxels; a single tie in a document of
+# a few thousand voxels is about 2e-4.
+TOLERANCE = 1e-3
+
+
+def voxel_centers(geometry, extent, mask: np.ndarray) -> np.ndarray:
+    """World coordinates of the voxels of ``mask``, a (z, y, x) mask over ``extent``."""
+
+    k, j, i = np.nonzero(mask)
+    index = np.stack([i + extent[0], j + extent[2], k + extent[4]], axis=1)
+    direction = np.asarray(geometry.direction).reshape(3, 3)
+    return np.asarray(geometry.origin) + (index * np.asarray(geometry.spacing)) @ direction.T
+
+
+def boundary_distance(points: np.ndarray, polygon: np.ndarray, normal: np.ndarray) -> np.ndarray:
+    """Distance of each point to the boundary of ``polygon`` extruded by ``normal``: to the nearer slab face, or to the
+    nearest edge of the polygon in its plane.
+    """
+
+    thickness = np.linalg.norm(normal)
+    unit = normal / thickness
+    center = polygon.mean(axis=0)
+
+    height = (points - center) @ unit
+    faces = np.abs(np.abs(height) - thickness / 2)
+
+    projected = points - np.outer(height, unit)
+    a = polygon[np.newaxis]
+    edge = np.roll(polygon, -1, axis=0)[np.newaxis] - a
+    offset = projected[:, np.newaxis] - a
+    t = np.clip(np.einsum("pek,pek->pe", offset, np.broadcast_to(edge, offset.shape)) / (edge ** 2).sum(axis=2), 0, 1)
+    edges = np.linalg.norm(offset - t[..., np.newaxis] * edge, axis=2).min(axis=1)
+
+    return np.minimum(faces, edges)
+
+
+def assert_same_blocks(markups, geometry, pir, expected, actual, points_per_segment=None):
+    """The blocks must match but for tie voxels on an annotation boundary, within TOLERANCE of the labelled voxels."""
+
+    expected = list(expected)
+    actual = list(actual)
+    assert len(expected) == len(actual)
+
+    labelled = different = 0
+    for label, (markup, vtk_block, numpy_block) in enumerate(zip(markups, expected, actual), 1):
+        if vtk_block is None:
+            assert numpy_block is None, "annotation {}".format(label)
+            continue
+
+        assert numpy_block is not None, "annotation {}".format(label)
+        extent = list(vtk_block[0])
+        assert extent == list(numpy_block[0]), "annotation {}".format(label)
+
+        labelled += np.count_nonzero(vtk_block[1])
+        mismatch = vtk_block[1] != numpy_block[1]
+        if not mismatch.any():
+            continue
+
+        different += np.count_nonzero(mismatch)
+        polygon, normal = markup_to_polygon(markup, pir, min(geometry.spacing), points_per_segment)
+        distance = boundary_distance(voxel_centers(geometry, extent, mismatch), polygon, np.asarray(normal))
+        assert distance.max() < TIE_DISTANCE, "annotation {}: voxels {} µm from its boundary differ".format(
+            label, distance.max()
+        )
+
+    assert labelled > 0
+    assert different <= TOLERANCE * labelled
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("pir", [False, True], ids=["ras", "pir"])
+@pytest.mark.parametrize("representation", ["spline", "polyline"])
+@pytest.mark.parametrize("planes", ["coronal", "sagittal", "oblique"])
+def test_engines_agree(oblique_geometry, planes, representation, pir, seed):
+    markups = synthetic_markups(seed=seed, planes=planes, representation=representation, pir=pir)
+
+    assert_same_blocks(
+        markups,
+        oblique_geometry,
+        pir,
+        rasterize_markups(markups, oblique_geometry, pir, engine="vtk"),
+        rasterize_markups(markups, oblique_geometry, pir, engine="numpy"),
+    )
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("points_per_segment", [None, 4, 32])
+def test_engines_agree_with_points_per_segment(oblique_geometry, points_per_segment, seed):
+    markups = synthetic_markups(seed=seed, representation="spline")
+
+    assert_same_blocks(
+        markups,
+        oblique_geometry,
+        False,
+        rasterize_markups(markups, oblique_geometry, False, engine="vtk", points_per_segment=points_per_segment),
+        rasterize_markups(markups, oblique_geometry, False, engine="numpy", points_per_segment=points_per_segment),
+        points_per_segment,
+    )
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_engines_agree_in_slabs(oblique_geometry, seed):
+    markups = synthetic_markups(seed=seed)
+    zranges = [(z0, z0 + 7) for z0 in range(0, oblique_geometry.size[2], 8)]
+
+    vtk_blocks = []
+    numpy_blocks = []
+    for zrange in zranges:
+        vtk_blocks += rasterize_markups(markups, oblique_geometry, False, engine="vtk", zranges=[zrange] * len(markups))
+        numpy_blocks += rasterize_markups(
+            markups, oblique_geometry, False, engine="numpy", zranges=[zrange] * len(markups)
+        )
+
+    assert_same_blocks(markups * len(zranges), oblique_geometry, False, vtk_blocks, numpy_blocks)
+
+
+def test_boundary_distance():
+    square = np.array([[0.0, 0.0, 0.0], [10.0, 0.0, 0.0], [10.0, 10.0, 0.0], [0.0, 10.0, 0.0]])
+    normal = np.array([0.0, 0.0, 4.0])
+    points = np.array([[5.0, 5.0, 0.0], [5.0, 5.0, 2.0], [5.0, 0.0, 1.0], [12.0, 5.0, -3.0]])
+
+    np.testing.assert_allclose(boundary_distance(points, square, normal), [2.0, 0.0, 0.0, 1.0])
+
+
+def test_engines_rasterize_something(oblique_geometry):
+    blocks = list(rasterize_markups(synthetic_markups(seed=1), oblique_geometry, False, engine="numpy"))
+
+    assert all(block is not None and block[1].any() for block in blocks)
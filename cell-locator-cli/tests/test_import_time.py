@@ -0,0 +1,118 @@
+"""
+Importing cl-export stays fast.
+
+Batch schedulers start many short cl-export processes, and every one of them
+pays for the modules imported at startup. Each entry point is imported in a
+fresh interpreter with ``python -X importtime``; its cumulative import time,
+the fastest of several imports as the least disturbed by other load, must
+stay within the budget, and it must not import the modules that are
+deferred to the code paths that need them: SimpleITK, vtkAddon, the VTK
+stencil and IO modules, or the monolithic ``vtk`` package.
+
+The budget is machine dependent, so it may be set, in milliseconds, with
+CL_IMPORT_BUDGET_MS; the deferred modules are not. CL_IMPORT_REPEAT sets the
+number of imports. See benchmarks/import_time.py.
+"""
+
+import importlib.util
+import json
+import os
+import re
+import subprocess
+import sys
+import textwrap
+
+from typing import List
+from typing import Tuple
+
+import pytest
+
+MODULES = ("cl_export.export", "cl_export.batch")
+
+BUDGET = float(os.environ.get("CL_IMPORT_BUDGET_MS", 500))
+
+REPEAT = int(os.environ.get("CL_IMPORT_REPEAT", 5))
+
+DEFERRED = re.compile(r"^(SimpleITK|vtk|vtkmodules\.vtkAddon|vtkmodules\.vtkImagingStencil|vtkmodules\.vtkIO\w*)$")
+
+IMPORT_TIME = re.compile(r"^import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)$")
+
+# import cl_export.export and, given arguments, run 'cl-export <argv>'; then list the modules loaded.
+MODULES_SCRIPT = textwrap.dedent(
+    """
+    import json
+    import sys
+
+    from cl_export.export import main
+
+    argv = json.loads(sys.argv[1])
+    if argv:
+        sys.argv = ["cl-export"] + argv
+        try:
+            main()
+        except SystemExit:
+            pass
+    print(json.dumps(sorted(sys.modules)))
+    """
+)
+
+
+def _run(args: List[str], **kwargs) -> subprocess.CompletedProcess:
+    # only the directory of the package under test; every extra sys.path entry slows down each import.
+    package = os.path.dirname(os.path.dirname(importlib.util.find_spec("cl_export").origin))
+    env = dict(os.environ, PYTHONPATH=package)
+    return subprocess.run([sys.executable, "-W", "ignore"] + args, env=env, capture_output=True, text=True, **kwargs)
+
+
+def import_time(module: str) -> Tuple[float, List[str]]:
+    """Import ``module`` in a fresh interpreter; returns its cumulative import time in ms, and all modules imported."""
+
+    result = _run(["-X", "importtime", "-c", "import {}".format(module)], check=True)
+
+    total = None
+    imported = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if not match:
+            continue
+        imported.append(match.group(3))
+        if match.group(3) == module:
+            total = int(match.group(1)) / 1000
+
+    return total, imported
+
+
+def loaded_modules(argv: List[str]) -> List[str]:
+    """The modules in ``sys.modules`` after importing cl_export.export and running 'cl-export <argv>', if any, in a
+    fresh interpreter.
+    """
+
+    output = _run(["-c", MODULES_SCRIPT, json.dumps(argv)], check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def deferred(modules: List[str]) -> List[str]:
+    return sorted({name for name in modules if DEFERRED.match(name)})
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_import_time_within_budget(module):
+    fastest = min(import_time(module)[0] for _ in range(REPEAT))
+
+    assert fastest <= BUDGET, "{} took {:.1f} ms to import; the budget is {:g} ms".format(module, fastest, BUDGET)
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_import_defers_modules(module):
+    total, imported = import_time(module)
+
+    assert total is not None
+    assert deferred(imported) == []
+
+
+@pytest.mark.parametrize("argv", [[], ["-h"], ["batch", "-h"]], ids=["import", "help", "batch-help"])
+def test_help_defers_modules(argv):
+    modules = loaded_modules(argv)
+
+    assert "cl_export.export" in modules
+    assert deferred(modules) == []
@@ -0,0 +1,126 @@
+"""
+The resident state and request checks of 'cl-export serve'; see cl_export.serve.
+"""
+
+import gc
+import json
+
+import numpy as np
+import pytest
+
+import SimpleITK as sitk
+
+from cl_convert import converters
+from cl_export import serve
+from cl_export.serve import RequestError
+from cl_export.serve import ResidentAtlases
+from cl_export.serve import Service
+from cl_synth import synth
+
+
+def write_atlas(path, seed: int = 0):
+    geometry = synth.Geometry.ccf("ccf100", "oblique")
+    slabs = synth.generate_atlas(np.random.default_rng(seed), geometry, labels=50)
+    synth.write_nrrd(path, geometry, np.uint16, slabs, compress=False)
+    return path
+
+
+def write_annotation(path, seed: int = 0):
+    document = synth.generate_document(
+        np.random.default_rng(seed), synth.Geometry.ccf("ccf100", "oblique"), curves=4, thickness=(100, 500)
+    )
+    _, converter = converters.find_latest()
+    with open(path, "w") as f:
+        json.dump(converter.specialize(document), f)
+    return path
+
+
+def churn(nbytes: int):
+    """Allocate and touch memory, so freed buffers are reused."""
+
+    for _ in range(8):
+        np.full(nbytes // 8 + 1, 0x5A5A5A5A5A5A5A5A, dtype=np.uint64)
+    gc.collect()
+
+
+@pytest.fixture
+def atlas_path(tmp_path):
+    return write_atlas(tmp_path / "atlas.nrrd")
+
+
+def test_labels_outlive_dropped_entry(atlas_path):
+    expected = sitk.GetArrayFromImage(sitk.ReadImage(str(atlas_path)))
+
+    # smaller than the atlas: the labels are read for each job and not kept.
+    atlases = ResidentAtlases(max_bytes=1000)
+    image, labels = atlases.labels(atlas_path)
+    assert atlases.nbytes == 0
+
+    churn(labels.nbytes)
+    np.testing.assert_array_equal(labels, expected)
+
+
+def test_labels_outlive_eviction(tmp_path, atlas_path):
+    other_path = write_atlas(tmp_path / "other.nrrd", seed=1)
+    expected = sitk.GetArrayFromImage(sitk.ReadImage(str(atlas_path)))
+
+    # room for one atlas: reading the other evicts the first.
+    atlases = ResidentAtlases(max_bytes=expected.nbytes)
+    image, labels = atlases.labels(atlas_path)
+    atlases.labels(other_path)
+    assert atlases.nbytes == expected.nbytes
+
+    churn(labels.nbytes)
+    np.testing.assert_array_equal(labels, expected)
+
+
+def test_stats_with_atlas_over_cap(monkeypatch, tmp_path, atlas_path):
+    annotations = [str(write_annotation(tmp_path / "a{}.json".format(seed), seed)) for seed in range(3)]
+    request = {"annotations": annotations, "atlas": str(atlas_path)}
+
+    expected = Service(None, geometry_cache=False, atlas_memory=1 << 30).stats(request)
+    assert expected["rows"] and not expected["failures"]
+
+    # other jobs allocate while this one counts.
+    stats_rows = serve.stats_rows
+
+    def churning_stats_rows(annotations, geometry, atlas, *args):
+        churn(atlas.nbytes)
+        return stats_rows(annotations, geometry, atlas, *args)
+
+    monkeypatch.setattr(serve, "stats_rows", churning_stats_rows)
+
+    assert Service(None, geometry_cache=False, atlas_memory=1000).stats(request) == expected
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"points_per_segment": -3},
+        {"points_per_segment": 0},
+        {"points_per_segment": "abc"},
+        {"points_per_segment": 2.5},
+        {"points_per_segment": True},
+        {"pir": "false"},
+        {"pir": 1},
+        {"engine": "gpu"},
+    ],
+    ids=lambda options: "-".join("{}={}".format(*item) for item in options.items()),
+)
+def test_invalid_options_are_request_errors(tmp_path, atlas_path, options):
+    annotation = str(write_annotation(tmp_path / "a.json"))
+    service = Service(None, geometry_cache=False)
+
+    with pytest.raises(RequestError):
+        service.export(dict(options, annotation=annotation, model=str(tmp_path / "a.vtp")))
+    with pytest.raises(RequestError):
+        service.stats(dict(options, annotations=[annotation], atlas=str(atlas_path)))
+    assert not (tmp_path / "a.vtp").exists()
+
+
+def test_valid_options(tmp_path):
+    annotation = str(write_annotation(tmp_path / "a.json"))
+    request = dict(annotation=annotation, model=str(tmp_path / "a.vtp"), pir=False, points_per_segment=4)
+
+    assert Service(None, geometry_cache=False).export(request) == {"annotations": 4}
+    assert (tmp_path / "a.vtp").exists()
@@ -0,0 +1,157 @@
+"""
+Adaptive curve tessellation is as accurate as a fine fixed tessellation, and
+does less work than the fixed 32 points per segment used before it where
+voxels are coarse; --points-per-segment 32 gives the labelmaps of the fixed
+tessellation.
+"""
+
+import numpy as np
+import pytest
+
+from cl_export import api
+from cl_export.export import _parser
+from cl_export.export import local_transform
+from cl_export.export import markup_curve
+from cl_export.export import markup_to_model
+from cl_export.export import markup_to_polygon
+from cl_export.export import ras_to_pir
+from cl_export.export import rasterize_markups
+from cl_export.export import stencil_block
+from cl_export.export import tessellate_curve
+from cl_export.slab import slab_block
+
+from conftest import atlas_geometry
+from conftest import synthetic_markups
+
+# Points per segment of the reference tessellation; the most adaptive_resolution() gives any segment.
+REFERENCE_POINTS_PER_SEGMENT = 256
+
+# Voxels that may differ from the reference, as a fraction of the labelled voxels.
+TOLERANCE = 1e-3
+
+# Voxels that may differ from the reference, as a fraction of its labelled boundary voxels; for small annotations on
+# coarse grids, where most labelled voxels are on a boundary.
+BOUNDARY_TOLERANCE = 1e-2
+
+# Points and model cells of small curves on a coarse grid, as a fraction of those of 32 points per segment.
+WORK_RATIO = 0.5
+
+
+def boundary(labels: np.ndarray) -> np.ndarray:
+    """The voxels of ``labels`` with a 6-neighbor of another label."""
+
+    edges = np.zeros(labels.shape, dtype=bool)
+    for axis in range(3):
+        step = np.swapaxes(labels, 0, axis)
+        edge = np.swapaxes(edges, 0, axis)
+        changed = step[1:] != step[:-1]
+        edge[1:] |= changed
+        edge[:-1] |= changed
+
+    return edges
+
+
+def assert_matches_reference(reference: np.ndarray, labels: np.ndarray, coarse: bool = False):
+    """Differences must be on the reference boundaries, and within TOLERANCE, or BOUNDARY_TOLERANCE if ``coarse``."""
+
+    edges = boundary(reference)
+    labelled = np.count_nonzero(reference)
+    assert labelled > 0
+
+    different = reference != labels
+    if coarse:
+        assert np.count_nonzero(different) <= BOUNDARY_TOLERANCE * np.count_nonzero(edges & (reference > 0))
+    else:
+        assert np.count_nonzero(different) <= TOLERANCE * labelled
+    assert not (different & ~edges).any(), "differences away from the annotation boundaries"
+
+
+def model_cells(model) -> int:
+    model.Update()
+    return model.GetOutput().GetNumberOfCells()
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+@pytest.mark.parametrize("representation", ["spline", "polyline"])
+@pytest.mark.parametrize("resolution", ["ccf25", "ccf50"])
+def test_adaptive_matches_reference(resolution, representation, seed):
+    geometry = atlas_geometry(resolution, "oblique")
+    markups = synthetic_markups(resolution, seed=seed, curves=8, representation=representation)
+
+    reference, _ = api.rasterize(markups, geometry, points_per_segment=REFERENCE_POINTS_PER_SEGMENT)
+    adaptive, _ = api.rasterize(markups, geometry)
+
+    if representation == "polyline":
+        # straight segments are exact with their end points alone.
+        assert np.count_nonzero(reference) > 0
+        np.testing.assert_array_equal(reference, adaptive)
+    else:
+        assert_matches_reference(reference, adaptive)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2, 3, 4, 5])
+def test_adaptive_does_less_work_on_coarse_grids(seed):
+    geometry = atlas_geometry("ccf100", "oblique")
+    markups = synthetic_markups("ccf100", seed=seed, curves=8, radius=(200, 500), thickness=(100, 500))
+    spacing = min(geometry.spacing)
+
+    curves = [markup_curve(markup) for markup in markups]
+    adaptive_points = sum(tessellate_curve(points, kind, spacing).GetNumberOfPoints() for points, _, kind in curves)
+    fixed_points = sum(tessellate_curve(points, kind, None, 32).GetNumberOfPoints() for points, _, kind in curves)
+    assert adaptive_points < WORK_RATIO * fixed_points
+
+    # fewer points give fewer triangles to extrude and stencil.
+    adaptive_cells = sum(model_cells(markup_to_model(markup, spacing)) for markup in markups)
+    fixed_cells = sum(model_cells(markup_to_model(markup, None, 32)) for markup in markups)
+    assert adaptive_cells < WORK_RATIO * fixed_cells
+
+    reference, _ = api.rasterize(markups, geometry, points_per_segment=REFERENCE_POINTS_PER_SEGMENT)
+    adaptive, _ = api.rasterize(markups, geometry)
+    assert_matches_reference(reference, adaptive, coarse=True)
+
+
+@pytest.mark.parametrize("pir", [False, True], ids=["ras", "pir"])
+@pytest.mark.parametrize("representation", ["spline", "polyline"])
+@pytest.mark.parametrize("resolution", ["ccf25", "ccf50"])
+def test_points_per_segment_32_reproduces_fixed_tessellation(resolution, representation, pir):
+    geometry = atlas_geometry(resolution, "oblique")
+    markups = synthetic_markups(resolution, seed=2, representation=representation, pir=pir)
+
+    image = geometry.to_image()
+    tform = local_transform(geometry)
+
+    # models without a spacing or points per segment are built as before adaptive tessellation.
+    expected = []
+    for markup in markups:
+        model = markup_to_model(markup)
+        if pir:
+            model = ras_to_pir(model)
+        model.Update()
+        expected.append(stencil_block(model, image, tform))
+
+    actual = list(rasterize_markups(markups, geometry, pir, engine="vtk", points_per_segment=32))
+
+    for label, (old, new) in enumerate(zip(expected, actual), 1):
+        assert list(old[0]) == list(new[0]), "annotation {}".format(label)
+        np.testing.assert_array_equal(old[1], new[1], err_msg="annotation {}".format(label))
+
+    expected = [slab_block(*markup_to_polygon(markup, pir), geometry) for markup in markups]
+    actual = list(rasterize_markups(markups, geometry, pir, engine="numpy", points_per_segment=32))
+
+    for label, (old, new) in enumerate(zip(expected, actual), 1):
+        assert list(old[0]) == list(new[0]), "annotation {}".format(label)
+        np.testing.assert_array_equal(old[1], new[1], err_msg="annotation {}".format(label))
+
+
+@pytest.mark.parametrize("points_per_segment", [0, -3])
+def test_points_per_segment_must_be_positive(points_per_segment):
+    points, _, curve_type = markup_curve(synthetic_markups(curves=1)[0])
+
+    # VTK crashes on negative counts; they must not reach it.
+    with pytest.raises(ValueError):
+        tessellate_curve(points, curve_type, points_per_segment=points_per_segment)
+    with pytest.raises(ValueError):
+        tessellate_curve(points, curve_type, spacing=50.0, points_per_segment=points_per_segment)
+
+    with pytest.raises(SystemExit):
+        _parser().parse_args(["a.json", "-m", "a.vtp", "--points-per-segment", str(points_per_segment)])
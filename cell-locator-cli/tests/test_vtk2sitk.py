@@ -0,0 +1,196 @@
+"""
+Zero-copy conversion between SimpleITK and VTK images; see cl_export.vtk2sitk.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+import pytest
+
+import SimpleITK as sitk
+
+from vtkmodules.util.numpy_support import numpy_to_vtk
+from vtkmodules.util.numpy_support import vtk_to_numpy
+from vtkmodules.vtkCommonDataModel import vtkImageData
+
+from cl_export.vtk2sitk import sitk2vtk
+from cl_export.vtk2sitk import vtk2sitk
+
+SIZE = (7, 5, 3)
+ORIGIN = (-10.0, 20.0, 3.5)
+SPACING = (0.5, 1.0, 2.0)
+DIRECTION = (0.0, 1.0, 0.0, 0.0, 0.0, -1.0, -1.0, 0.0, 0.0)
+
+# numpy type and components per pixel.
+PIXEL_TYPES = {
+    "int8": (np.int8, 1),
+    "uint16": (np.uint16, 1),
+    "int32": (np.int32, 1),
+    "uint64": (np.uint64, 1),
+    "float32": (np.float32, 1),
+    "float64": (np.float64, 1),
+    "vector-uint8": (np.uint8, 3),
+    "vector-float32": (np.float32, 3),
+}
+
+
+def buffer_address(array: np.ndarray) -> int:
+    return array.__array_interface__["data"][0]
+
+
+def make_image(dtype=np.uint16, components: int = 1) -> sitk.Image:
+    shape = tuple(reversed(SIZE)) + ((components,) if components > 1 else ())
+    pixels = (np.arange(int(np.prod(shape))).reshape(shape) % 100).astype(dtype)
+
+    image = sitk.GetImageFromArray(pixels, isVector=components > 1)
+    image.SetOrigin(ORIGIN)
+    image.SetSpacing(SPACING)
+    image.SetDirection(DIRECTION)
+    return image
+
+
+def assert_same_image(expected: sitk.Image, actual: sitk.Image):
+    np.testing.assert_array_equal(sitk.GetArrayViewFromImage(expected), sitk.GetArrayViewFromImage(actual))
+    assert actual.GetPixelID() == expected.GetPixelID()
+    assert actual.GetNumberOfComponentsPerPixel() == expected.GetNumberOfComponentsPerPixel()
+    assert actual.GetSize() == expected.GetSize()
+    np.testing.assert_allclose(actual.GetOrigin(), expected.GetOrigin())
+    np.testing.assert_allclose(actual.GetSpacing(), expected.GetSpacing())
+    np.testing.assert_allclose(actual.GetDirection(), expected.GetDirection())
+
+
+def test_round_trip_shares_buffer():
+    image = make_image(np.uint16)
+    address = buffer_address(sitk.GetArrayViewFromImage(image))
+
+    vtkimg = sitk2vtk(image)
+    assert buffer_address(vtk_to_numpy(vtkimg.GetPointData().GetScalars())) == address
+
+    result = vtk2sitk(vtkimg)
+    assert buffer_address(sitk.GetArrayViewFromImage(result)) == address
+
+    # writes through the VTK image are visible in the SimpleITK image.
+    vtk_to_numpy(vtkimg.GetPointData().GetScalars())[0] = 12345
+    assert sitk.GetArrayViewFromImage(result).flat[0] == 12345
+
+
+def test_view_keeps_image_alive():
+    vtkimg = sitk2vtk(make_image(np.int32))
+
+    expected = np.arange(np.prod(SIZE)) % 100
+    np.testing.assert_array_equal(vtk_to_numpy(vtkimg.GetPointData().GetScalars()), expected)
+
+
+def test_reallocated_array_is_copied():
+    image = make_image(np.uint16)
+    vtkimg = sitk2vtk(image)
+
+    scalars = vtkimg.GetPointData().GetScalars()
+    before = buffer_address(vtk_to_numpy(scalars))
+    scalars.ReserveTuples(4 * scalars.GetNumberOfTuples())
+    assert buffer_address(vtk_to_numpy(scalars)) != before
+
+    result = vtk2sitk(vtkimg)
+    assert buffer_address(sitk.GetArrayViewFromImage(result)) != buffer_address(sitk.GetArrayViewFromImage(image))
+    assert_same_image(image, result)
+
+
+@pytest.mark.parametrize("copy", [False, True], ids=["view", "copy"])
+@pytest.mark.parametrize("dtype,components", PIXEL_TYPES.values(), ids=PIXEL_TYPES.keys())
+def test_round_trip(dtype, components, copy):
+    image = make_image(dtype, components)
+
+    vtkimg = sitk2vtk(image, copy=copy)
+    scalars = vtkimg.GetPointData().GetScalars()
+    assert scalars.GetNumberOfComponents() == image.GetNumberOfComponentsPerPixel()
+    assert vtkimg.GetDimensions() == SIZE
+    np.testing.assert_allclose(vtkimg.GetOrigin(), ORIGIN)
+    np.testing.assert_allclose(vtkimg.GetSpacing(), SPACING)
+
+    result = vtk2sitk(vtkimg)
+    assert_same_image(image, result)
+
+    shared = buffer_address(sitk.GetArrayViewFromImage(result)) == buffer_address(sitk.GetArrayViewFromImage(image))
+    assert shared != copy
+
+
+@pytest.mark.parametrize("components", [1, 3])
+def test_vtk_image_is_copied(components):
+    pixels = (np.arange(np.prod(SIZE) * components) % 100).astype(np.float32)
+
+    vtkimg = vtkImageData()
+    vtkimg.SetDimensions(*SIZE)
+    vtkimg.SetOrigin(*ORIGIN)
+    vtkimg.SetSpacing(*SPACING)
+    vtkimg.SetDirectionMatrix(DIRECTION)
+    vtkimg.GetPointData().SetScalars(numpy_to_vtk(pixels.reshape(-1, components) if components > 1 else pixels))
+
+    result = vtk2sitk(vtkimg)
+
+    expected_shape = tuple(reversed(SIZE)) + ((components,) if components > 1 else ())
+    np.testing.assert_array_equal(sitk.GetArrayViewFromImage(result), pixels.reshape(expected_shape))
+    assert result.GetNumberOfComponentsPerPixel() == components
+    np.testing.assert_allclose(result.GetDirection(), DIRECTION)
+
+
+# allocate a labelmap as export_labelmap() does, touch every page as painting would, and convert it for writing.
+PEAK_SCRIPT = textwrap.dedent(
+    """
+    import json
+    import sys
+
+    import numpy as np
+    import SimpleITK as sitk
+
+    from vtkmodules.util.numpy_support import vtk_to_numpy
+    from vtkmodules.vtkCommonCore import VTK_UNSIGNED_SHORT
+
+    from cl_export.export import allocate_labelmap
+    from cl_export.geometry import AtlasGeometry
+    from cl_export.vtk2sitk import vtk2sitk
+
+    size = tuple(json.loads(sys.argv[1]))
+    shared = sys.argv[2] == "shared"
+    geometry = AtlasGeometry((0.0, 0.0, 0.0), (1.0, 1.0, 1.0), (1.0, 0, 0, 0, 1.0, 0, 0, 0, 1.0), size)
+
+    # unlike ru_maxrss, VmHWM is not inherited from the parent process.
+    def peak():
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:"))
+
+    before = peak()
+    if shared:
+        image = allocate_labelmap(geometry, np.uint16)
+    else:
+        # a labelmap allocated by VTK, as before buffers were shared.
+        image = geometry.to_image()
+        image.AllocateScalars(VTK_UNSIGNED_SHORT, 1)
+    vtk_to_numpy(image.GetPointData().GetScalars())[:] = 1
+    sitkimg = vtk2sitk(image)
+    assert sitk.GetArrayViewFromImage(sitkimg).all()
+
+    print(json.dumps({"peak": peak() - before}))
+    """
+)
+
+
+def peak_memory(size, mode: str) -> int:
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    output = subprocess.run(
+        [sys.executable, "-c", PEAK_SCRIPT, json.dumps(size), mode], check=True, capture_output=True, text=True, env=env
+    ).stdout
+    return json.loads(output.splitlines()[-1])["peak"]
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="reads the peak memory from /proc/self/status")
+def test_peak_memory_is_one_volume():
+    size = (512, 512, 256)
+    volume = 2 * int(np.prod(size))
+
+    # less than 1.25 volumes when shared; a copy needs two.
+    assert peak_memory(size, "shared") < 1.25 * volume
+    assert peak_memory(size, "copied") > 1.75 * volume